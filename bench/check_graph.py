@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+#Topology checks of export_graph.build_graph on small hand made networks, exit code 1 when one fails:
+#  * T-junction: the junction vertex of the through street was dropped by simplification, the side street
+#    ends on it, so the graph is connected only if the through segment is split at the junction
+#  * ends closer than GRAPH_SNAP on both sides of a multiple of GRAPH_SNAP are one node
+#
+#  python3 bench/check_graph.py
+
+import os
+import sys
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from export_graph import GRAPH_SNAP, build_graph, count_components
+
+log = print
+
+
+def make_edges(segments):
+    """fetch_edges() format from (way_id, xa, ya, xb, yb), flat ground"""
+    s = np.array(segments, dtype=np.float64).reshape(-1, 5)
+    n = len(s)
+    return {
+        'segment_id': np.arange(1, n + 1), 'way_id': s[:, 0].astype(np.int64),
+        'xa': s[:, 1], 'ya': s[:, 2], 'xb': s[:, 3], 'yb': s[:, 4],
+        'length': np.hypot(s[:, 3] - s[:, 1], s[:, 4] - s[:, 2]), 'slope': np.zeros(n),
+        'h_a': np.zeros(n), 'h_b': np.zeros(n),
+    }
+
+
+def check_t_junction():
+    #way 1: (0, 0) - (70, 0.8) - (200, 0), the middle vertex is simplified away (0.8 m < 2 m), segmentized by 50 m
+    #way 2 starts at the shared node (70, 0.8) and goes north
+    edges = make_edges([
+        (1, 0, 0, 50, 0), (1, 50, 0, 100, 0), (1, 100, 0, 150, 0), (1, 150, 0, 200, 0),
+        (2, 70, 0.8, 70, 50.4), (2, 70, 50.4, 70, 100),
+    ])
+    junctions = {'way_id': np.array([1, 2]), 'x': np.array([70.0, 70.0]), 'y': np.array([0.8, 0.8])}
+    graph = build_graph(edges, junctions)
+    parts = count_components(graph)
+    #the split keeps the length of the through street
+    length = graph['length'][graph['segment_id'] == 2].sum() / 2
+    ok = parts == 1 and len(graph['node_x']) == 8 and np.isclose(length, 50)
+    log(f"T-junction: {parts} connected parts, {len(graph['node_x'])} nodes, split segment {length:.2f} m - {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def check_snap_across_cells():
+    #two ways meeting at ends 0.4 * GRAPH_SNAP apart, straddling x = 0.5 * GRAPH_SNAP (rounding to a grid would split them)
+    x = 0.5 * GRAPH_SNAP
+    edges = make_edges([(1, -10, 0, x - 0.2 * GRAPH_SNAP, 0), (2, x + 0.2 * GRAPH_SNAP, 0, 10, 0)])
+    graph = build_graph(edges)
+    parts = count_components(graph)
+    ok = parts == 1 and len(graph['node_x']) == 3
+    log(f"Ends across a cell boundary: {parts} connected parts, {len(graph['node_x'])} nodes - {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    results = [check_t_junction(), check_snap_across_cells()]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
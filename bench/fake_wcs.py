@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+#Local stand-in for the geoportal WCS services, so the pipeline can be benchmarked without touching mapy.geoportal.gov.pl.
+#Answers GetCoverage like the real services: NMT (DTM coverages) as image/tiff, NMPT as the multipart
+#with result.asc, result.asc.aux.xml and result.prj which extract_multipart / convert.py expect.
+#Terrain is synthetic but continuous across tiles (hills in global coordinates), NMPT adds "trees",
+#so doubt maps have something to find. Latency and failure rate are configurable.
+
+import io
+import os
+import random
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+log = print
+
+#Seconds every response is delayed by (the real service takes several seconds per tile)
+FAKE_WCS_LATENCY = float(os.getenv('FAKE_WCS_LATENCY', 0.2))
+#Part of the requests answered with 503, to exercise retries
+FAKE_WCS_FAILURE_RATE = float(os.getenv('FAKE_WCS_FAILURE_RATE', 0))
+FAKE_WCS_PORT = int(os.getenv('FAKE_WCS_PORT', 8089))
+
+BOUNDARY = b'wcs'
+
+
+def terrain(xmin, ymax, width, height, pixel_size, surface=False):
+    """Heights (float32, first row northernmost) of the pixels of the extent"""
+    x = xmin + (np.arange(width) + 0.5) * pixel_size
+    y = ymax - (np.arange(height) + 0.5) * pixel_size
+    xx, yy = np.meshgrid(x, y)
+    h = 220 + 25 * np.sin(xx / 350.0) * np.cos(yy / 470.0) + 0.01 * (xx - 566000) + 4 * np.sin(xx / 53.0 + yy / 71.0)
+    if surface:
+        #tree crowns: rough bumps of 8-20 m, placed deterministically per tile
+        rng = np.random.RandomState(int(xmin * 7 + ymax) % (2 ** 31))
+        for _ in range(int(width * height / 4000)):
+            cx, cy = rng.randint(0, width), rng.randint(0, height)
+            r = rng.randint(3, 8)
+            y0, y1, x0, x1 = max(cy - r, 0), min(cy + r, height), max(cx - r, 0), min(cx + r, width)
+            h[y0:y1, x0:x1] += rng.uniform(8, 20) + rng.normal(0, 1.5, (y1 - y0, x1 - x0))
+    return h.astype(np.float32)
+
+
+def geotiff_body(data, xmin, ymax, pixel_size):
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_origin
+    with MemoryFile() as mem:
+        with mem.open(driver='GTiff', height=data.shape[0], width=data.shape[1], count=1, dtype=data.dtype,
+                      crs='EPSG:2180', transform=from_origin(xmin, ymax, pixel_size, pixel_size)) as dst:
+            dst.write(data, 1)
+        return mem.read()
+
+
+def _part(filename, body, content_type='text/plain'):
+    return (b'--' + BOUNDARY + b'\r\n'
+            + f'Content-Type: {content_type}\r\nContent-Disposition: attachment; filename={filename}\r\n\r\n'.encode()
+            + body + b'\r\n')
+
+
+def aaigrid_multipart_body(data, xmin, ymin, pixel_size):
+    from rasterio.crs import CRS
+    buf = io.BytesIO()
+    buf.write(f'ncols {data.shape[1]}\nnrows {data.shape[0]}\nxllcorner {xmin}\nyllcorner {ymin}\n'
+              f'cellsize {pixel_size}\nNODATA_value -9999\n'.encode())
+    np.savetxt(buf, data, fmt='%.2f')
+    aux = b'<PAMDataset>\n  <PAMRasterBand band="1">\n  </PAMRasterBand>\n</PAMDataset>'
+    prj = CRS.from_epsg(2180).to_wkt(version='WKT1_ESRI').encode()
+    return (_part('result.asc', buf.getvalue())
+            + _part('result.asc.aux.xml', aux, 'text/xml')
+            + _part('result.prj', prj)
+            + b'--' + BOUNDARY + b'--\r\n')
+
+
+@lru_cache(maxsize=256)
+def coverage_body(coverage_id, response_format, xmin, xmax, ymin, ymax, scale_factor):
+    """(content type, body) of a GetCoverage response, cached: generating a tile costs more than serving it"""
+    pixel_size = 1.0 / scale_factor
+    width = int(round((xmax - xmin) / pixel_size))
+    height = int(round((ymax - ymin) / pixel_size))
+    data = terrain(xmin, ymax, width, height, pixel_size, surface=not coverage_id.startswith('DTM'))
+    if response_format == 'image/x-aaigrid':
+        return f'multipart/mixed; boundary={BOUNDARY.decode()}', aaigrid_multipart_body(data, xmin, ymin, pixel_size)
+    if response_format == 'image/tiff':
+        return 'image/tiff', geotiff_body(data, xmin, ymax, pixel_size)
+    raise ValueError(f'Unsupported FORMAT {response_format}')
+
+
+def parse_get_coverage(url):
+    """(coverage_id, format, xmin, xmax, ymin, ymax, scale_factor) of a GetCoverage url made by downloader.wcs_url"""
+    q = parse_qs(urlparse(url).query)
+    subsets = {s[0]: [float(v) for v in s[2:-1].split(',')] for s in q['SUBSET']}
+    (xmin, xmax), (ymin, ymax) = subsets['x'], subsets['y']
+    return q['COVERAGEID'][0], q['FORMAT'][0], xmin, xmax, ymin, ymax, float(q.get('SCALEFACTOR', ['1'])[0])
+
+
+class FakeWCSHandler(BaseHTTPRequestHandler):
+    latency = FAKE_WCS_LATENCY
+    failure_rate = FAKE_WCS_FAILURE_RATE
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+    requests = 0
+    failures = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        with self.rng_lock:
+            type(self).requests += 1
+            fail = self.rng.random() < self.failure_rate
+            if fail:
+                type(self).failures += 1
+        if fail:
+            self.send_error(503, 'Service temporarily unavailable (fake)')
+            return
+        try:
+            content_type, body = coverage_body(*parse_get_coverage(self.path))
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f'Bad GetCoverage request: {e}')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=FAKE_WCS_PORT, latency=FAKE_WCS_LATENCY, failure_rate=FAKE_WCS_FAILURE_RATE):
+    """Serves in a daemon thread, returns (server, base url)"""
+    handler = type('Handler', (FakeWCSHandler,), dict(latency=latency, failure_rate=failure_rate, rng=random.Random(0)))
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, name='fake-wcs', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/wcs'
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else FAKE_WCS_PORT
+    server, url = start_server(port)
+    log(f"Fake WCS at {url}, latency {FAKE_WCS_LATENCY} s, failure rate {FAKE_WCS_FAILURE_RATE}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+#Load test of query_service.py: concurrent clients with keep-alive connections send a mix of
+#/near, /along and /bbox requests, latency percentiles (p50, p90, p99, max) and throughput are reported per endpoint.
+#
+#  python3 bench/load_query.py                               - in-process service over a synthetic street grid
+#  python3 bench/load_query.py --url http://127.0.0.1:8090   - running service (query points taken from /health bounds)
+#  python3 bench/load_query.py --hot 100                     - queries drawn from 100 distinct ones, exercises the cache
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+log = print
+
+#centre of the synthetic grid (Kraków), its size and street spacing in meters
+SYNTHETIC_CENTRE = (19.94, 50.06)
+SYNTHETIC_SIZE = 5000
+STREET_SPACING = 100
+SEGMENT_LENGTH = 50
+
+
+def synthetic_segments(size=SYNTHETIC_SIZE, spacing=STREET_SPACING, seg_len=SEGMENT_LENGTH, centre=SYNTHETIC_CENTRE):
+    """Grid of straight streets cut into seg_len segments, with smooth random heights, in the load_segments() format"""
+    lon0, lat0 = centre
+    m_lon = 1 / (math.radians(1) * 6371008.8 * math.cos(math.radians(lat0)))
+    m_lat = 1 / (math.radians(1) * 6371008.8)
+    steps = np.arange(0, size, seg_len, dtype=np.float64)
+    lines = np.arange(spacing / 2, size, spacing)
+    #horizontal streets then vertical ones, (x, y) of segment ends in meters from the lower left corner
+    ha = np.stack(np.meshgrid(steps, lines), axis=-1).reshape(-1, 2)
+    va = ha[:, ::-1]
+    a = np.concatenate([ha, va])
+    b = a + np.concatenate([np.tile([seg_len, 0], (len(ha), 1)), np.tile([0, seg_len], (len(va), 1))])
+    height = lambda p: 20 * np.sin(p[:, 0] / 700) * np.cos(p[:, 1] / 900) + 0.004 * p[:, 0]
+    delta_h = height(b) - height(a)
+    n = len(a)
+    way = np.concatenate([np.repeat(np.arange(len(lines)), len(steps)), len(lines) + np.repeat(np.arange(len(lines)), len(steps))])
+    return {
+        'segment_id': np.arange(1, n + 1), 'way_id': way.astype(np.int64), 'name': [f'ulica {w}' for w in way],
+        'slope': np.abs(delta_h) / seg_len, 'delta_h': delta_h, 'length': np.full(n, float(seg_len)),
+        'lon_a': lon0 + (a[:, 0] - size / 2) * m_lon, 'lat_a': lat0 + (a[:, 1] - size / 2) * m_lat,
+        'lon_b': lon0 + (b[:, 0] - size / 2) * m_lon, 'lat_b': lat0 + (b[:, 1] - size / 2) * m_lat,
+    }
+
+
+def make_queries(bounds, n, mix, rng):
+    """n request paths inside bounds (min_lon, min_lat, max_lon, max_lat), endpoints chosen from mix"""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    #about 100 m in degrees
+    d_lat = 100 / 111_195
+    d_lon = d_lat / math.cos(math.radians((min_lat + max_lat) / 2))
+    point = lambda: (rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat))
+    queries = []
+    for _ in range(n):
+        kind = rng.choice(mix)
+        lon, lat = point()
+        if kind == 'near':
+            queries.append(('near', f'/near?lon={lon:.6f}&lat={lat:.6f}&radius=50'))
+        elif kind == 'bbox':
+            queries.append(('bbox', f'/bbox?bbox={lon:.6f},{lat:.6f},{lon + 2 * d_lon:.6f},{lat + 2 * d_lat:.6f}'))
+        else:
+            #a route of 5 legs, ~100 m each, along the grid
+            pts = [(lon, lat)]
+            for _ in range(5):
+                lon += rng.choice([-d_lon, 0, d_lon])
+                lat += rng.choice([-d_lat, 0, d_lat])
+                pts.append((lon, lat))
+            line = ';'.join(f'{x:.6f},{y:.6f}' for x, y in pts)
+            queries.append(('along', f'/along?line={line}&buffer=10'))
+    return queries
+
+
+def client(url, queries, latencies, errors, lock):
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+    local = []
+    failed = 0
+    for kind, path in queries:
+        t0 = time.perf_counter()
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        local.append((kind, time.perf_counter() - t0))
+        if response.status != 200:
+            failed += 1
+    conn.close()
+    with lock:
+        latencies.extend(local)
+        errors[0] += failed
+
+
+def report(latencies, elapsed):
+    log(f"{'endpoint':<8} {'requests':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind in sorted({k for k, _ in latencies}) + ['all']:
+        values = np.array([t for k, t in latencies if kind in ('all', k)]) * 1000
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        log(f"{kind:<8} {len(values):>9} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} {values.max():>8.2f}")
+    log(f"{len(latencies) / elapsed:.0f} requests/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', help='running query service; default: in-process over synthetic streets')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mix', default='near,along,bbox', help='comma separated endpoints, repeat one to weight it')
+    parser.add_argument('--hot', type=int, default=0, help='draw requests from this many distinct queries (0 - all distinct)')
+    parser.add_argument('--cache', type=int, default=None, help='cache size of the in-process service')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    url = args.url
+    if not url:
+        import query_service
+        t0 = time.monotonic()
+        index = query_service.SegmentIndex(synthetic_segments())
+        log(f"Indexed {index.n} synthetic segments in {time.monotonic() - t0:.2f} s")
+        cache = query_service.QUERY_CACHE_SIZE if args.cache is None else args.cache
+        _, url = query_service.start_server(index, port=0, cache_size=cache)
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+    conn.request('GET', '/health')
+    health = json.loads(conn.getresponse().read())
+    conn.close()
+
+    rng = random.Random(args.seed)
+    mix = args.mix.split(',')
+    if args.hot:
+        pool = make_queries(health['bounds'], args.hot, mix, rng)
+        queries = [rng.choice(pool) for _ in range(args.requests)]
+    else:
+        queries = make_queries(health['bounds'], args.requests, mix, rng)
+
+    latencies, errors, lock = [], [0], threading.Lock()
+    threads = [threading.Thread(target=client, args=(url, queries[i::args.concurrency], latencies, errors, lock))
+               for i in range(args.concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    log(f"{health['segments']} segments, {args.requests} requests, concurrency {args.concurrency}, {errors[0]} errors")
+    report(latencies, elapsed)
+    sys.exit(1 if errors[0] else 0)
+
+
+if __name__ == '__main__':
+    main()
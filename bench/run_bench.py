@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+#Benchmarks of the pipeline stages against the local fake WCS (fake_wcs.py) and a local PostGIS.
+#Every stage runs in its own process, so its peak RSS is measured separately; results are
+#tiles/s (segments/s for the slope computation) and peak RSS in MB, optionally compared with a saved baseline.
+#
+#  python3 bench/run_bench.py                                  - all stages, 3x3 tiles
+#  python3 bench/run_bench.py --save bench/baseline.json       - remember the results
+#  python3 bench/run_bench.py --baseline bench/baseline.json   - exit code 1 if a stage got slower than --tolerance
+#
+#Database stages use BENCH_PGDATABASE (default osm_bench, created if missing), never the real one,
+#and are skipped when PostGIS can't be reached.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+log = print
+
+BENCH_PGDATABASE = os.getenv('BENCH_PGDATABASE', 'osm_bench')
+STAGES = ['download', 'extract', 'convert', 'roughness', 'upload', 'slopes_sql', 'slopes_python']
+DB_STAGES = {'upload', 'slopes_sql', 'slopes_python'}
+#lower left corner of the benchmarked area (EPSG:2180), somewhere in Kraków
+ORIGIN = (566000, 243000)
+#street grid of the synthetic ways
+STREET_SPACING = 100
+
+#fast retries, the fake server fails on purpose only
+RETRY_TIMES_SEC = [0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+
+
+def bench_tiles(grid, tile_size):
+    from tiles import TILE_SIZE
+    tile_size = tile_size or TILE_SIZE
+    return [(ORIGIN[0] + i * tile_size, ORIGIN[0] + (i + 1) * tile_size, ORIGIN[1] + j * tile_size, ORIGIN[1] + (j + 1) * tile_size)
+            for i in range(grid) for j in range(grid)]
+
+
+def response_path(model, xmin, ymin):
+    return os.path.join('responses', f'{model}_{xmin}_{ymin}.response')
+
+
+## Stages, run in the child process inside the work directory; each returns (items, unit, extra)
+
+def stage_download(args, tiles):
+    from downloader import wcs_url, download_with_retry, HostRateLimiter, Throughput
+    from tiles import MODELS, SCALE_FACTOR
+    os.makedirs('responses', exist_ok=True)
+    rate_limiter = HostRateLimiter(args.min_request_interval)
+    throughput = Throughput()
+    jobs = []
+    for model, cfg in MODELS.items():
+        for xmin, xmax, ymin, ymax in tiles:
+            url = wcs_url(args.url, cfg['coverage_id'], cfg['response_format'], xmin, xmax, ymin, ymax, SCALE_FACTOR)
+            jobs.append((url, response_path(model, xmin, ymin)))
+    with ThreadPoolExecutor(args.workers) as pool:
+        list(pool.map(lambda job: download_with_retry(*job, retry_times_sec=RETRY_TIMES_SEC, rate_limiter=rate_limiter,
+                                                      throughput=throughput, log=lambda *a, **k: None), jobs))
+    return len(jobs), 'tiles', dict(bytes=throughput.bytes, retries=throughput.retries)
+
+
+def stage_extract(args, tiles):
+    from extract_multipart import extract_multipart
+    import contextlib, io
+    out_dir = tempfile.mkdtemp(dir='.')
+    for xmin, _, ymin, _ in tiles:
+        #extract_multipart prints every part, which would be timed too
+        with contextlib.redirect_stdout(io.StringIO()):
+            paths = extract_multipart(response_path('NMPT', xmin, ymin), out_dir, expected_parts=['result.asc', 'result.asc.aux.xml', 'result.prj'])
+        for path in paths:
+            os.remove(path)
+    os.rmdir(out_dir)
+    return len(tiles), 'tiles', {}
+
+
+def stage_convert(args, tiles):
+    from convert import aaigrid_multipart_to_geotiff, validate_tile
+    from tiles import MODELS, SCALE_FACTOR, tif_path_of
+    for model, cfg in MODELS.items():
+        os.makedirs(cfg['out_dir'], exist_ok=True)
+        for xmin, xmax, ymin, ymax in tiles:
+            tif_path = tif_path_of(cfg['out_dir'], args.tile_size, SCALE_FACTOR, xmin, ymin)
+            if cfg['response_format'] == 'image/x-aaigrid':
+                aaigrid_multipart_to_geotiff(response_path(model, xmin, ymin), tif_path, expected_bounds=(xmin, ymin, xmax, ymax))
+            else:
+                shutil.copyfile(response_path(model, xmin, ymin), tif_path)
+            validate_tile(tif_path, xmin, xmax, ymin, ymax)
+    return len(tiles) * len(MODELS), 'tiles', {}
+
+
+def stage_roughness(args, tiles):
+    from treefinder import treefiend
+    from tiles import MODELS, SCALE_FACTOR, tif_path_of, doubt_tif_path_of, neighbour_paths
+    out_dir = MODELS['NMPT']['out_dir']
+    for xmin, _, ymin, _ in tiles:
+        neighbours = neighbour_paths(out_dir, xmin, ymin, args.tile_size, SCALE_FACTOR)
+        treefiend.generate_roughness_job(tif_path_of(out_dir, args.tile_size, SCALE_FACTOR, xmin, ymin),
+                                         doubt_tif_path_of(out_dir, args.tile_size, SCALE_FACTOR, xmin, ymin), neighbours)
+    return len(tiles), 'tiles', {}
+
+
+def stage_upload(args, tiles):
+    from raster_upload import upload_rasters_copy
+    from tiles import MODELS, SCALE_FACTOR, tif_path_of, doubt_tif_path_of
+    n = 0
+    for cfg in MODELS.values():
+        paths = [tif_path_of(cfg['out_dir'], args.tile_size, SCALE_FACTOR, xmin, ymin) for xmin, _, ymin, _ in tiles]
+        upload_rasters_copy(cfg['raster_table'], paths)
+        n += len(paths)
+        if 'doubt_table' in cfg:
+            paths = [doubt_tif_path_of(cfg['out_dir'], args.tile_size, SCALE_FACTOR, xmin, ymin) for xmin, _, ymin, _ in tiles]
+            upload_rasters_copy(cfg['doubt_table'], paths)
+            n += len(paths)
+    return n, 'tiles', {}
+
+
+def create_bench_ways(conn, tiles):
+    """Replaces ways with a grid of named residential streets every STREET_SPACING m over the tiles"""
+    left = min(t[0] for t in tiles)
+    right = max(t[1] for t in tiles)
+    bottom = min(t[2] for t in tiles)
+    top = max(t[3] for t in tiles)
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS ways CASCADE")
+        cur.execute("""CREATE TABLE ways (way_id BIGSERIAL PRIMARY KEY, kind TEXT, name TEXT, bridge TEXT, layer INT4,
+                       geom geometry(LineString, 3857))""")
+        cur.execute("""
+            INSERT INTO ways (kind, name, geom)
+            SELECT 'residential', 'ulica ' || n, ST_Transform(ST_SetSRID(line, 2180), 3857)
+            FROM (
+                SELECT row_number() OVER () AS n, line FROM (
+                    SELECT ST_MakeLine(ST_MakePoint(x, %(bottom)s + 1), ST_MakePoint(x, %(top)s - 1)) AS line
+                    FROM generate_series(%(left)s + %(step)s / 2, %(right)s, %(step)s) x
+                    UNION ALL
+                    SELECT ST_MakeLine(ST_MakePoint(%(left)s + 1, y), ST_MakePoint(%(right)s - 1, y))
+                    FROM generate_series(%(bottom)s + %(step)s / 2, %(top)s, %(step)s) y
+                ) lines
+            ) numbered
+        """, dict(left=left, right=right, bottom=bottom, top=top, step=STREET_SPACING))
+        cur.execute("CREATE INDEX ON ways USING gist (geom)")
+    conn.commit()
+
+
+def stage_slopes_sql(args, tiles):
+    from db import get_connection
+    from slope_engine import ensure_schema
+    conn = get_connection()
+    create_bench_ways(conn, tiles)
+    ensure_schema(conn)
+    t0 = time.monotonic()
+    with conn.cursor() as cur:
+        cur.execute("CALL compute_slope_static()")
+        cur.execute("SELECT count(*) FROM slope_static")
+        n = cur.fetchone()[0]
+    conn.commit()
+    return n, 'segments', dict(compute_s=round(time.monotonic() - t0, 3))
+
+
+def stage_slopes_python(args, tiles):
+    from db import get_connection
+    from slope_engine import ensure_schema, compute_slope_static_python
+    conn = get_connection()
+    create_bench_ways(conn, tiles)
+    ensure_schema(conn)
+    n = compute_slope_static_python(conn)
+    return n, 'segments', {}
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process. VmHWM belongs to the address space created by exec, while ru_maxrss
+    on Linux also counts the parent's memory copied by fork, which would hide the stage behind the parent.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    #kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(args):
+    """Child process: runs one stage, prints its result as the last line of stdout"""
+    from tiles import TILE_SIZE
+    #stages name and find tiles (neighbours included) by the benchmarked size
+    args.tile_size = args.tile_size or TILE_SIZE
+    tiles = bench_tiles(args.grid, args.tile_size)
+    os.chdir(args.work)
+    stage = globals()['stage_' + args.stage]
+    t0 = time.monotonic()
+    items, unit, extra = stage(args, tiles)
+    elapsed = time.monotonic() - t0
+    print('BENCH_RESULT ' + json.dumps(dict(stage=args.stage, items=items, unit=unit, seconds=elapsed, peak_rss_mb=peak_rss_mb(), **extra)))
+
+
+## Parent: server, database, child processes, report
+
+def ensure_bench_db():
+    """None if BENCH_PGDATABASE is usable (created when missing), otherwise the reason it isn't"""
+    try:
+        import psycopg2
+    except ImportError:
+        return 'psycopg2 not installed'
+    from db import PGHOST, PGPORT, PGUSER, PGPASSWORD
+    try:
+        conn = psycopg2.connect(host=PGHOST, port=PGPORT, user=PGUSER, dbname='postgres', password=PGPASSWORD, connect_timeout=5)
+    except psycopg2.OperationalError as e:
+        return f'PostGIS not reachable: {str(e).strip()}'
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (BENCH_PGDATABASE,))
+        if cur.fetchone() is None:
+            log(f"Creating database {BENCH_PGDATABASE}")
+            cur.execute(f'CREATE DATABASE "{BENCH_PGDATABASE}"')
+    conn.close()
+    conn = psycopg2.connect(host=PGHOST, port=PGPORT, user=PGUSER, dbname=BENCH_PGDATABASE, password=PGPASSWORD)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis_raster")
+    conn.close()
+    return None
+
+
+def spawn_stage(args, stage, url):
+    """Runs the stage in a child process (fresh interpreter, so peak RSS is the stage's own), returns its result"""
+    cmd = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--work', args.work, '--url', url,
+           '--grid', str(args.grid), '--workers', str(args.workers), '--min-request-interval', str(args.min_request_interval)]
+    if args.tile_size:
+        cmd += ['--tile-size', str(args.tile_size)]
+    env = dict(os.environ, PGDATABASE=BENCH_PGDATABASE, TILE_CACHE_DB=os.path.join(args.work, 'cache.sqlite'))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, text=True)
+    lines = proc.stdout.splitlines()
+    results = [l for l in lines if l.startswith('BENCH_RESULT ')]
+    if proc.returncode != 0 or not results:
+        log('\n'.join(lines[-30:]))
+        raise Exception(f"Stage {stage} failed with exit code {proc.returncode}")
+    result = json.loads(results[-1][len('BENCH_RESULT '):])
+    result['rate'] = result['items'] / max(result['seconds'], 1e-9)
+    return result
+
+
+def report(results, baseline=None, tolerance=0.1):
+    """Table of the results; returns stages whose rate dropped (or peak RSS grew) by more than tolerance vs baseline"""
+    regressions = []
+    lines = [f"  {'stage':<14} {'items':>8} {'seconds':>9} {'rate':>16} {'peak RSS MB':>12}  vs baseline"]
+    for r in results:
+        if r.get('skipped'):
+            lines.append(f"  {r['stage']:<14} skipped: {r['skipped']}")
+            continue
+        rate = f"{r['rate']:.2f} {r['unit']}/s"
+        line = f"  {r['stage']:<14} {r['items']:>8} {r['seconds']:>9.2f} {rate:>16} {r['peak_rss_mb']:>12.1f}"
+        base = (baseline or {}).get(r['stage'])
+        if base and not base.get('skipped'):
+            rate_change = r['rate'] / base['rate'] - 1
+            rss_change = r['peak_rss_mb'] / base['peak_rss_mb'] - 1
+            regressed = rate_change < -tolerance or rss_change > tolerance
+            line += f"  rate {rate_change:+.0%}, RSS {rss_change:+.0%}" + ('  REGRESSION' if regressed else '')
+            if regressed:
+                regressions.append(r['stage'])
+        lines.append(line)
+    log('\n'.join(lines))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the pipeline stages against a local fake WCS')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated, of: ' + ','.join(STAGES))
+    parser.add_argument('--grid', type=int, default=3, help='benchmark grid x grid tiles of every model')
+    parser.add_argument('--tile-size', type=int, default=None, help='tile size in meters (default tiles.TILE_SIZE)')
+    parser.add_argument('--workers', type=int, default=4, help='download threads')
+    parser.add_argument('--min-request-interval', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=None, help='seconds per response of the fake WCS (FAKE_WCS_LATENCY)')
+    parser.add_argument('--failure-rate', type=float, default=None, help='part of failed responses (FAKE_WCS_FAILURE_RATE)')
+    parser.add_argument('--work', default=None, help='work directory, a temporary one by default')
+    parser.add_argument('--save', default=None, help='write results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    #child process
+    parser.add_argument('--stage', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--url', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args)
+        return 0
+
+    import fake_wcs
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}")
+    own_work = args.work is None
+    args.work = os.path.abspath(args.work or tempfile.mkdtemp(prefix='bench_'))
+    latency = fake_wcs.FAKE_WCS_LATENCY if args.latency is None else args.latency
+    failure_rate = fake_wcs.FAKE_WCS_FAILURE_RATE if args.failure_rate is None else args.failure_rate
+    server, url = fake_wcs.start_server(0, latency, failure_rate)
+
+    tiles = bench_tiles(args.grid, args.tile_size)
+    if 'download' in stages:
+        #responses are generated before the clock starts, the download measures transfer and latency only
+        from tiles import MODELS, SCALE_FACTOR
+        t0 = time.monotonic()
+        for cfg in MODELS.values():
+            for xmin, xmax, ymin, ymax in tiles:
+                fake_wcs.coverage_body(cfg['coverage_id'], cfg['response_format'], float(xmin), float(xmax), float(ymin), float(ymax), SCALE_FACTOR)
+        log(f"Generated synthetic responses in {time.monotonic() - t0:.1f} s")
+
+    db_problem = ensure_bench_db() if DB_STAGES & set(stages) else None
+    log(f"Benchmarking {len(tiles)} tiles per model in {args.work}, fake WCS {url} (latency {latency} s, failure rate {failure_rate})")
+    results = []
+    try:
+        for stage in stages:
+            if stage in DB_STAGES and db_problem:
+                results.append(dict(stage=stage, skipped=db_problem))
+                continue
+            log(f"== {stage} ==")
+            results.append(spawn_stage(args, stage, url))
+    finally:
+        server.shutdown()
+        if own_work:
+            shutil.rmtree(args.work, ignore_errors=True)
+    log(f"Fake WCS answered {server.RequestHandlerClass.requests} requests, {server.RequestHandlerClass.failures} failed on purpose")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r['stage']: r for r in json.load(f)['results']}
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(grid=args.grid, latency=latency, failure_rate=failure_rate, workers=args.workers, results=results), f, indent=1)
+    if regressions:
+        log(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,13 @@ set -euo pipefail
 source config.sh
 export PGPASSWORD
 
+#SLOPE_INCREMENTAL=1 recomputes only ways which changed or cross raster tiles loaded since the last run
+if [ "${SLOPE_INCREMENTAL:-0}" = "1" ]; then
+    procedure=compute_slope_static_incremental
+else
+    procedure=compute_slope_static
+fi
+
 psql \
   -h "${PGHOST}" \
   -p "${PGPORT}" \
@@ -11,4 +18,4 @@ psql \
   -d "${PGDATABASE}" \
   -v ON_ERROR_STOP=1 \
   -f compute_slope_static.sql \
-  -c "CALL compute_slope_static();"
+  -c "CALL ${procedure}();"
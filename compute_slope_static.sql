@@ -1,5 +1,5 @@
-DROP TABLE IF EXISTS slope_static;
-CREATE TABLE slope_static (
+--Not dropped, so compute_slope_static_incremental() can update results of previous runs
+CREATE TABLE IF NOT EXISTS slope_static (
     segment_id BIGINT NOT NULL,
     way_id    BIGINT NOT NULL,
     name      TEXT,
@@ -13,9 +13,21 @@ CREATE TABLE slope_static (
     nmpt_doubt_b  DOUBLE PRECISION,
     nmt_used_a INT,
     nmt_used_b INT,
-    delta_h DOUBLE PRECISION
+    -- h_b - h_a: positive when the way goes uphill from its start (slope is the absolute value)
+    delta_h DOUBLE PRECISION,
+    -- along-segment profile, filled by slope_engine.py with SLOPE_PROFILE_SPACING (NULL otherwise)
+    max_grade DOUBLE PRECISION,
+    mean_grade DOUBLE PRECISION,
+    climb DOUBLE PRECISION,
+    descent DOUBLE PRECISION
 );
 
+-- tables created before the profile columns
+ALTER TABLE slope_static ADD COLUMN IF NOT EXISTS max_grade DOUBLE PRECISION;
+ALTER TABLE slope_static ADD COLUMN IF NOT EXISTS mean_grade DOUBLE PRECISION;
+ALTER TABLE slope_static ADD COLUMN IF NOT EXISTS climb DOUBLE PRECISION;
+ALTER TABLE slope_static ADD COLUMN IF NOT EXISTS descent DOUBLE PRECISION;
+
 -- Recommended but optional
 CREATE INDEX IF NOT EXISTS slope_static_geom_idx
     ON slope_static
@@ -24,8 +36,118 @@ CREATE INDEX IF NOT EXISTS slope_static_geom_idx
 CREATE INDEX IF NOT EXISTS slope_static_way_id_idx
     ON slope_static (way_id);
 
+/*
+ * Per-way summary of slope_static, refreshed by refresh_slope_way_stats() together with it.
+ * Grades are fractions like slope, ascent/descent in meters along the direction of the way.
+ */
+CREATE TABLE IF NOT EXISTS slope_way_stats (
+    way_id     BIGINT PRIMARY KEY,
+    name       TEXT,
+    segments   INT NOT NULL,
+    length     DOUBLE PRECISION NOT NULL,
+    mean_grade DOUBLE PRECISION NOT NULL, -- weighted by segment length
+    max_grade  DOUBLE PRECISION NOT NULL,
+    ascent     DOUBLE PRECISION NOT NULL,
+    descent    DOUBLE PRECISION NOT NULL,
+    bbox       geometry(Geometry, 2180) NOT NULL
+);
 
-CREATE OR REPLACE PROCEDURE compute_slope_static()
+CREATE INDEX IF NOT EXISTS slope_way_stats_name_idx
+    ON slope_way_stats (name);
+
+CREATE INDEX IF NOT EXISTS slope_way_stats_bbox_idx
+    ON slope_way_stats
+    USING GIST (bbox);
+
+/*
+ * Recomputes slope_way_stats of the given ways (all if way_ids is NULL) from slope_static;
+ * ways without segments any more are removed.
+ * Along-segment profiles (max_grade, climb, descent) are used where slope_engine.py computed them.
+ */
+CREATE OR REPLACE PROCEDURE refresh_slope_way_stats(way_ids BIGINT[])
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF way_ids IS NULL THEN
+        TRUNCATE TABLE slope_way_stats;
+    ELSE
+        DELETE FROM slope_way_stats WHERE way_id = ANY(way_ids);
+    END IF;
+
+    INSERT INTO slope_way_stats (way_id, name, segments, length, mean_grade, max_grade, ascent, descent, bbox)
+    SELECT
+        way_id,
+        min(name),
+        count(*),
+        sum(st_length(geom)),
+        sum(slope * st_length(geom)) / sum(st_length(geom)),
+        greatest(max(slope), max(max_grade)),
+        --climb and descent count the rises and falls within a segment
+        sum(coalesce(climb, greatest(delta_h, 0))),
+        sum(coalesce(descent, greatest(-delta_h, 0))),
+        st_setsrid(st_extent(geom)::geometry, 2180)
+    FROM slope_static
+    WHERE way_ids IS NULL OR way_id = ANY(way_ids)
+    GROUP BY way_id;
+END;
+$$;
+
+/*
+ * Change tracking for compute_slope_static_incremental():
+ *  - raster_tile_changes: footprints of raster tiles (re)loaded since the last computation,
+ *    filled by raster_upload.py
+ *  - slope_changed_ways: ways inserted, updated or deleted since the last computation,
+ *    filled by a trigger on ways, installed by slope_static_changes_consumed()
+ */
+CREATE TABLE IF NOT EXISTS raster_tile_changes (
+    raster_table TEXT NOT NULL,
+    footprint geometry(Polygon, 2180) NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS slope_changed_ways (
+    way_id BIGINT PRIMARY KEY,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION slope_track_way_change()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO slope_changed_ways (way_id) VALUES (OLD.way_id) ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO slope_changed_ways (way_id) VALUES (NEW.way_id) ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+/*
+ * Forgets changes recorded before computation_start (they are reflected in slope_static now)
+ * and makes sure changes of ways are tracked from now on.
+ * Importing ways from scratch drops the table together with the trigger,
+ * which is how compute_slope_static_incremental() knows it has to compute everything.
+ */
+CREATE OR REPLACE PROCEDURE slope_static_changes_consumed(computation_start TIMESTAMPTZ)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    DELETE FROM raster_tile_changes WHERE changed_at <= computation_start;
+    DELETE FROM slope_changed_ways WHERE changed_at <= computation_start;
+    CREATE OR REPLACE TRIGGER ways_slope_changes
+        AFTER INSERT OR UPDATE OR DELETE ON ways
+        FOR EACH ROW EXECUTE FUNCTION slope_track_way_change();
+END;
+$$;
+
+
+/*
+ * Original, row-by-row implementation, kept as a reference for compute_slope_static()
+ */
+CREATE OR REPLACE PROCEDURE compute_slope_static_cursor()
 LANGUAGE plpgsql
 AS $$
 DECLARE
@@ -37,6 +159,9 @@ DECLARE
     processed_percent    NUMERIC;
     previous_way_id BIGINT:=-1;
     segment_counter BIGINT :=1;
+    --progress is reported at most once per interval (SET slope.progress_interval = '30 s'), not for every way
+    progress_interval INTERVAL := coalesce(nullif(current_setting('slope.progress_interval', true), ''), '5 seconds')::interval;
+    last_progress TIMESTAMPTZ := clock_timestamp();
 
     h_nmt_start DOUBLE PRECISION;
     h_nmt_end   DOUBLE PRECISION;
@@ -150,8 +275,8 @@ BEGIN
             ELSE h_end := h_nmt_end; nmt_used_end := 1;
         END IF;
 
-        dh := abs(h_start - h_end);
-        slope_frac := dh / st_length(rec.geom);
+        dh := h_end - h_start;
+        slope_frac := abs(dh) / st_length(rec.geom);
 
         IF slope_frac > 0.5
             THEN 
@@ -195,9 +320,11 @@ BEGIN
         IF rec.way_id != previous_way_id /*I hate <>, != also works*/
             THEN 
             processed_ways := processed_ways + 1;
-            processed_percent := (processed_ways::NUMERIC / total_ways_count)*100;
-
-            RAISE NOTICE '% %% (% of % ways)', to_char(processed_percent, 'FM999999990.00'), processed_ways, total_ways_count;
+            IF clock_timestamp() - last_progress >= progress_interval THEN
+                processed_percent := (processed_ways::NUMERIC / total_ways_count)*100;
+                RAISE NOTICE '% %% (% of % ways)', to_char(processed_percent, 'FM999999990.00'), processed_ways, total_ways_count;
+                last_progress := clock_timestamp();
+            END IF;
             previous_way_id := rec.way_id;
         END IF;
         segment_counter := segment_counter + 1;
@@ -205,7 +332,216 @@ BEGIN
 
     CLOSE cur;
 
+    CALL refresh_slope_way_stats(NULL);
+
     processed_ways := processed_ways + 1;
     RAISE NOTICE '\nDone. Computed slopes for % ways', processed_ways;
 END;
 $$;
+
+
+/*
+ * Set-based implementation: segment endpoints are built once, all three rasters
+ * are sampled with lateral joins and the NMT/NMPT selection is done in SQL expressions.
+ * Samples are collected with CREATE TABLE AS, which (unlike INSERT ... SELECT)
+ * may be executed with a parallel plan.
+ * Computes segments of the given ways only (all ways if way_ids is NULL) and appends them to slope_static.
+ */
+CREATE OR REPLACE PROCEDURE compute_slope_static_for_ways(way_ids BIGINT[])
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    sampled_count BIGINT;
+    steep_count BIGINT;
+    inserted_count BIGINT;
+    first_segment_id BIGINT;
+    started TIMESTAMPTZ := clock_timestamp();
+BEGIN
+    DROP TABLE IF EXISTS slope_static_samples;
+    CREATE TEMP TABLE slope_static_samples AS
+    WITH segments AS (
+        SELECT
+            ways.way_id,
+            ways.layer,
+            ways.bridge,
+            ways.name,
+            seg.path[1] AS segment_no,
+            seg.geom,
+            st_startpoint(seg.geom) AS pt_a,
+            st_endpoint(seg.geom) AS pt_b
+        FROM ways
+        CROSS JOIN LATERAL st_dumpsegments(
+            st_segmentize(
+                st_simplifypreservetopology(
+                    st_transform(ways.geom, 2180),
+                    2::double precision
+                ),
+                50::double precision
+            )
+        ) AS seg
+        WHERE
+            ways.name IS NOT NULL
+            --ignore tunnels
+            AND (ways.layer IS NULL OR ways.layer >= 0)
+            AND kind IN (
+                'primary', 'secondary', 'tertiary',
+                'residential', 'living_street',
+                'unclassified', 'service'
+            )
+            AND (way_ids IS NULL OR ways.way_id = ANY(way_ids))
+    )
+    /*
+     * st_convexhull(rast) && point lets the planner use the index created by raster2pgsql -I,
+     * st_contains(st_envelope(...)) is the same condition as in the cursor version
+     */
+    SELECT
+        s.*,
+        nmt_a.h AS h_nmt_start,
+        nmt_b.h AS h_nmt_end,
+        nmpt_a.h AS h_nmpt_start,
+        nmpt_b.h AS h_nmpt_end,
+        doubt_a.h AS doubt_nmpt_start,
+        doubt_b.h AS doubt_nmpt_end
+    FROM segments s
+    CROSS JOIN LATERAL (SELECT st_nearestvalue(d.rast, s.pt_a) AS h FROM dtm d
+        WHERE st_convexhull(d.rast) && s.pt_a AND st_contains(st_envelope(d.rast), s.pt_a) LIMIT 1) nmt_a
+    CROSS JOIN LATERAL (SELECT st_nearestvalue(d.rast, s.pt_b) AS h FROM dtm d
+        WHERE st_convexhull(d.rast) && s.pt_b AND st_contains(st_envelope(d.rast), s.pt_b) LIMIT 1) nmt_b
+    CROSS JOIN LATERAL (SELECT st_nearestvalue(d.rast, s.pt_a) AS h FROM dtcm d
+        WHERE st_convexhull(d.rast) && s.pt_a AND st_contains(st_envelope(d.rast), s.pt_a) LIMIT 1) nmpt_a
+    CROSS JOIN LATERAL (SELECT st_nearestvalue(d.rast, s.pt_b) AS h FROM dtcm d
+        WHERE st_convexhull(d.rast) && s.pt_b AND st_contains(st_envelope(d.rast), s.pt_b) LIMIT 1) nmpt_b
+    CROSS JOIN LATERAL (SELECT st_nearestvalue(d.rast, s.pt_a) AS h FROM dtcm_doubt d
+        WHERE st_convexhull(d.rast) && s.pt_a AND st_contains(st_envelope(d.rast), s.pt_a) LIMIT 1) doubt_a
+    CROSS JOIN LATERAL (SELECT st_nearestvalue(d.rast, s.pt_b) AS h FROM dtcm_doubt d
+        WHERE st_convexhull(d.rast) && s.pt_b AND st_contains(st_envelope(d.rast), s.pt_b) LIMIT 1) doubt_b
+    WHERE
+        nmt_a.h IS NOT NULL AND nmt_b.h IS NOT NULL
+        AND nmpt_a.h IS NOT NULL AND nmpt_b.h IS NOT NULL
+        AND doubt_a.h IS NOT NULL AND doubt_b.h IS NOT NULL;
+
+    GET DIAGNOSTICS sampled_count = ROW_COUNT;
+    RAISE NOTICE 'Sampled rasters for % segments in % s', sampled_count, round(extract(epoch FROM clock_timestamp() - started)::numeric, 1);
+
+    --new segments get ids after the ones already in the table
+    SELECT coalesce(max(segment_id), 0) INTO first_segment_id FROM slope_static;
+
+    INSERT INTO slope_static (
+        segment_id,
+        way_id,
+        name,
+        geom,
+        slope,
+        delta_h,
+        nmt_h_a,
+        nmt_h_b,
+        nmpt_h_a,
+        nmpt_h_b,
+        nmpt_doubt_a,
+        nmpt_doubt_b,
+        nmt_used_a,
+        nmt_used_b
+    )
+    SELECT
+        first_segment_id + row_number() OVER (ORDER BY way_id, segment_no),
+        way_id,
+        name,
+        geom,
+        abs(h_start - h_end) / st_length(geom),
+        h_end - h_start,
+        h_nmt_start,
+        h_nmt_end,
+        h_nmpt_start,
+        h_nmpt_end,
+        doubt_nmpt_start,
+        doubt_nmpt_end,
+        nmt_used_start,
+        nmt_used_end
+    FROM (
+        SELECT
+            smp.*,
+            --use NMPT if computed doubt is low or layer >0 is set or bridge explicitly
+            --otherwise NMT, when NMPT cannot be trusted (mainly because of overhanging trees)
+            CASE WHEN doubt_nmpt_start < 1.0 OR layer IS NOT NULL OR bridge IS NOT NULL
+                THEN h_nmpt_start ELSE h_nmt_start END AS h_start,
+            CASE WHEN doubt_nmpt_end < 1.0 OR layer IS NOT NULL OR bridge IS NOT NULL
+                THEN h_nmpt_end ELSE h_nmt_end END AS h_end,
+            CASE WHEN doubt_nmpt_start < 1.0 OR layer IS NOT NULL OR bridge IS NOT NULL
+                THEN 0 ELSE 1 END AS nmt_used_start,
+            CASE WHEN doubt_nmpt_end < 1.0 OR layer IS NOT NULL OR bridge IS NOT NULL
+                THEN 0 ELSE 1 END AS nmt_used_end
+        FROM slope_static_samples smp
+    ) chosen
+    --segments which are ridiculuosly steep are skipped as errors
+    WHERE abs(h_start - h_end) / st_length(geom) <= 0.5;
+
+    GET DIAGNOSTICS inserted_count = ROW_COUNT;
+    steep_count := sampled_count - inserted_count;
+    IF steep_count > 0 THEN
+        RAISE WARNING '% segments are ridiculuosly steep (slope > 0.5), skipped as errors', steep_count;
+    END IF;
+
+    DROP TABLE slope_static_samples;
+    CALL refresh_slope_way_stats(way_ids);
+    RAISE NOTICE 'Done. Computed slopes for % segments in % s', inserted_count, round(extract(epoch FROM clock_timestamp() - started)::numeric, 1);
+END;
+$$;
+
+
+/*
+ * Computes slopes of all ways from scratch
+ */
+CREATE OR REPLACE PROCEDURE compute_slope_static()
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    computation_start TIMESTAMPTZ := clock_timestamp();
+BEGIN
+    TRUNCATE TABLE slope_static;
+    CALL compute_slope_static_for_ways(NULL);
+    CALL slope_static_changes_consumed(computation_start);
+END;
+$$;
+
+
+/*
+ * Recomputes only segments of ways which changed or which cross raster tiles loaded since the last computation.
+ * Falls back to compute_slope_static() when changes of ways are not tracked (ways imported from scratch).
+ */
+CREATE OR REPLACE PROCEDURE compute_slope_static_incremental()
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    computation_start TIMESTAMPTZ := clock_timestamp();
+    ways_srid INT;
+    affected_way_ids BIGINT[];
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'ways_slope_changes' AND tgrelid = 'ways'::regclass) THEN
+        RAISE NOTICE 'Changes of ways are not tracked (first run or ways imported from scratch), computing all slopes';
+        CALL compute_slope_static();
+        RETURN;
+    END IF;
+
+    --variable instead of st_srid(ways.geom), so the spatial index on ways can be used
+    ways_srid := Find_SRID('public', 'ways', 'geom');
+
+    SELECT array_agg(way_id) INTO affected_way_ids
+    FROM (
+        SELECT way_id FROM slope_changed_ways
+        UNION
+        SELECT ways.way_id
+        FROM raster_tile_changes c
+        JOIN ways ON st_intersects(ways.geom, st_transform(c.footprint, ways_srid))
+    ) affected;
+
+    IF affected_way_ids IS NULL THEN
+        RAISE NOTICE 'Nothing changed since the last computation';
+    ELSE
+        RAISE NOTICE 'Recomputing slopes of % ways', cardinality(affected_way_ids);
+        --deleted ways just disappear, the rest is computed again
+        DELETE FROM slope_static WHERE way_id = ANY(affected_way_ids);
+        CALL compute_slope_static_for_ways(affected_way_ids);
+    END IF;
+    CALL slope_static_changes_consumed(computation_start);
+END;
+$$;
@@ -0,0 +1,198 @@
+import math
+import os
+import re
+import time
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+from extract_multipart import iter_multipart, extract_multipart, CHUNK_SIZE
+from utils import run_command
+from metrics import get_metrics
+
+#Creation options of the GeoTiffs we write ourselves
+GTIFF_PROFILE = dict(driver='GTiff', tiled=True, blockxsize=256, blockysize=256, compress='lzw')
+
+_WHITESPACE = b' \t\r\n'
+
+
+class AAIGridReader:
+    """
+    Incremental reader of ARC/INFO ASCII GRID. Feed it chunks of the .asc file,
+    values are parsed with numpy straight into a preallocated float32 array,
+    so the text is never held in memory as a whole.
+    """
+    def __init__(self):
+        self.header = {}
+        self.values = None
+        self.filled = 0
+        self._pending = b""
+
+    def feed(self, chunk):
+        data = self._pending + chunk
+        if self.values is None:
+            data = self._parse_header(data)
+            if self.values is None:
+                self._pending = data
+                return
+        #a number may be cut in half at the end of the chunk, leave it for the next one
+        cut = max(data.rfind(c) for c in _WHITESPACE)
+        if cut == -1:
+            self._pending = data
+            return
+        self._pending = data[cut:]
+        self._parse_values(data[:cut])
+
+    def _parse_header(self, data):
+        while True:
+            data = data.lstrip()
+            #values may all be in one huge line, so the header ends at the first token which is not a keyword
+            if data[:1] and not data[:1].isalpha():
+                break
+            eol = data.find(b"\n")
+            if eol == -1:
+                return data
+            tokens = data[:eol].split()
+            if len(tokens) >= 2:
+                self.header[tokens[0].decode('ascii').lower()] = float(tokens[1])
+            data = data[eol + 1:]
+        for key in ('ncols', 'nrows'):
+            if key not in self.header:
+                raise Exception(f'AAIGrid header is missing {key}')
+        self.values = np.empty(int(self.header['ncols']) * int(self.header['nrows']), dtype=np.float32)
+        return data
+
+    def _parse_values(self, text):
+        #fromstring(sep=' ') is deprecated and stops quietly at a malformed token, this raises on it
+        parsed = np.array(text.split(), dtype=np.float32)
+        end = self.filled + parsed.size
+        if end > self.values.size:
+            raise Exception(f'AAIGrid has more values than ncols*nrows={self.values.size}')
+        self.values[self.filled:end] = parsed
+        self.filled = end
+
+    def finish(self):
+        """Returns the grid as 2d float32 array, first row is the northernmost one"""
+        if self.values is None:
+            raise Exception('AAIGrid header not found')
+        if self._pending.strip():
+            self._parse_values(self._pending)
+        self._pending = b""
+        if self.filled != self.values.size:
+            raise Exception(f'AAIGrid has {self.filled} values, expected {self.values.size}')
+        return self.values.reshape(int(self.header['nrows']), int(self.header['ncols']))
+
+    def bounds(self):
+        """(left, bottom, right, top) of the grid"""
+        h = self.header
+        dx = h.get('dx', h.get('cellsize'))
+        dy = h.get('dy', h.get('cellsize'))
+        left = h['xllcorner'] if 'xllcorner' in h else h['xllcenter'] - dx / 2
+        bottom = h['yllcorner'] if 'yllcorner' in h else h['yllcenter'] - dy / 2
+        return left, bottom, left + dx * h['ncols'], bottom + dy * h['nrows']
+
+
+def check_bounds(bounds, xmin, ymin, xmax, ymax, tolerance=1e-3):
+    """Raises if (left, bottom, right, top) doesn't match the expected tile extent"""
+    left, bottom, right, top = bounds
+    if not (math.isclose(left, xmin, abs_tol=tolerance) and math.isclose(top, ymax, abs_tol=tolerance)):
+        raise Exception("Upper left corner of tiff doesn't match expected:", xmin, ymax, 'got:', left, top)
+    if not (math.isclose(right, xmax, abs_tol=tolerance) and math.isclose(bottom, ymin, abs_tol=tolerance)):
+        raise Exception("Lower Right corner of tiff doesn't match expected:", xmax, ymin, 'got:', right, bottom)
+
+
+def geotiff_bounds(path):
+    """Bounds read from GeoTiff header, fails if the file is malformed"""
+    with rasterio.open(path) as src:
+        return tuple(src.bounds)
+
+
+def write_geotiff(out_path, data, transform, crs, nodata=None, **options):
+    """Writes single band GeoTiff under temporary name and renames it, so out_path is never half-written"""
+    profile = dict(GTIFF_PROFILE, height=data.shape[0], width=data.shape[1], count=1,
+                   dtype=data.dtype, crs=crs, transform=transform, nodata=nodata)
+    profile.update(options)
+    tmp_path = out_path + '.tmp'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        dst.write(data, 1)
+    os.replace(tmp_path, out_path)
+
+
+def aaigrid_multipart_to_geotiff(mime_file, out_path, expected_bounds=None, asc_part='result.asc', prj_part='result.prj', chunk_size=CHUNK_SIZE):
+    """
+    Converts multipart WCS response (aaigrid + prj) into GeoTiff without writing the .asc to disk.
+    expected_bounds: (xmin, ymin, xmax, ymax) checked before anything is written
+    """
+    reader = AAIGridReader()
+    prj = b""
+    with open(mime_file, 'rb') as f:
+        for _, filename, chunk in iter_multipart(f, chunk_size=chunk_size):
+            if not chunk:
+                continue
+            if filename == asc_part:
+                reader.feed(chunk)
+            elif filename == prj_part:
+                prj += chunk
+    data = reader.finish()
+    bounds = reader.bounds()
+    if expected_bounds is not None:
+        check_bounds(bounds, *expected_bounds)
+    if not prj:
+        raise Exception(f'No {prj_part} in {mime_file}, cannot tell the coordinate system')
+    left, bottom, right, top = bounds
+    transform = from_origin(left, top, (right - left) / data.shape[1], (top - bottom) / data.shape[0])
+    write_geotiff(out_path, data, transform, CRS.from_wkt(prj.decode('latin1')), nodata=reader.header.get('nodata_value'))
+    return out_path
+
+
+def response_to_geotiff(response_body_file, tif_path, response_format, xmin, xmax, ymin, ymax, converter='rasterio'):
+    """
+    Turns downloaded WCS response into the GeoTiff tile and removes the response.
+    converter: 'rasterio' converts in-process, 'gdal' extracts the parts and runs gdal_translate
+    """
+    t0 = time.monotonic()
+    if response_format == "image/x-aaigrid" and converter == 'rasterio':
+        #parse aaigrid straight from the response, bounds are checked before the tiff is written
+        aaigrid_multipart_to_geotiff(response_body_file, tif_path, expected_bounds=(xmin, ymin, xmax, ymax))
+        os.remove(response_body_file)
+    elif response_format == "image/x-aaigrid":
+        #response has 3 files in it...
+        parts_dir = os.path.join(os.path.dirname(tif_path), f"parts_{xmin}_{ymin}")
+        os.makedirs(parts_dir, exist_ok=True)
+        asc_file, aux_file, prj_file = extract_multipart(response_body_file, parts_dir, expected_parts=['result.asc', 'result.asc.aux.xml', 'result.prj'])
+        #Convert to GeoTiff
+        #It apparently implicitly using prj file which is located within the same directory
+        run_command(f"gdal_translate -of GTiff -co COMPRESS=LZW {asc_file} {tif_path}")
+        for part_file in (asc_file, aux_file, prj_file):
+            os.remove(part_file)
+        os.rmdir(parts_dir)
+        os.remove(response_body_file)
+    elif response_format == "image/tiff":
+        #Just move, nothing to be done
+        os.replace(response_body_file, tif_path)
+    else:
+        raise Exception(f"wrong format:{response_format}")
+    get_metrics().observe('convert_seconds', time.monotonic() - t0, format=response_format, converter=converter)
+
+
+def validate_tile(tif_path, xmin, xmax, ymin, ymax, converter='rasterio'):
+    """Ensures tif_path is a proper GeoTiff with matching bounding box, renames it to *_MALFORMED otherwise"""
+    if converter == 'rasterio':
+        try:
+            check_bounds(geotiff_bounds(tif_path), xmin, ymin, xmax, ymax)#This fails if file is malformed
+        except Exception:
+            os.rename(tif_path, tif_path+'_MALFORMED')
+            get_metrics().inc('tiles_malformed')
+            raise
+    else:
+        tif_info = run_command(f'gdalinfo {tif_path} | tail -n 6')#This fails if file is malformed
+        if not re.search(r'Upper Left *\( *'+str(xmin)+r'\.?0*, *'+str(ymax)+r'\.?0*\)', tif_info):
+            os.rename(tif_path, tif_path+'_MALFORMED')
+            get_metrics().inc('tiles_malformed')
+            raise Exception("Upper left corner of tiff doesn't match expected:", xmin, ymax)
+        if not re.search(r'Lower Right *\( *'+str(xmax)+r'\.?0*, *'+str(ymin)+r'\.?0*\)', tif_info):
+            os.rename(tif_path, tif_path+'_MALFORMED')
+            get_metrics().inc('tiles_malformed')
+            raise Exception("Lower Right corner of tiff doesn't match expected:", xmax, ymin)
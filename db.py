@@ -0,0 +1,26 @@
+import os
+
+PGHOST=os.getenv('PGHOST', 'localhost')
+PGPORT=int(os.getenv('PGPORT', '5439'))
+PGUSER=os.getenv('PGUSER','postgres')
+PGDATABASE=os.getenv('PGDATABASE', 'osm')
+PGPASSWORD=os.getenv('PGPASSWORD', 'postgres')
+
+_connection = None
+
+def get_connection():
+    """
+    One connection per process, opened on first use and reused afterwards.
+    psycopg2 is imported here, so modules importing db don't need it unless they talk to the database.
+    """
+    global _connection
+    if _connection is None or _connection.closed:
+        import psycopg2
+        _connection = psycopg2.connect(host=PGHOST, port=PGPORT, user=PGUSER, dbname=PGDATABASE, password=PGPASSWORD)
+    return _connection
+
+def copy_text(value):
+    """Formats a value for COPY ... FROM STDIN in text format"""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
@@ -1,308 +1,313 @@
 #!/usr/bin/env python3
 
-import math
+#Downloads NMT/NMPT tiles covering a bbox, generates doubt maps of NMPT and uploads both to PostGIS.
+#Can be imported: nothing runs at import time, and rasterio, scipy and treefiend are imported
+#by the functions that need them, so the CLI starts fast and a long running process can
+#call download_model() for many bboxes.
+
 import os
-import subprocess
 import sys
-from urllib.parse import urlencode
-from urllib.request import urlretrieve
-import re
 import time
-from osgeo import osr
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 log = print
 silent = lambda *a, **k :None
 
 #Internal imports
 from utils import  run_command
-from extract_multipart import extract_multipart
-from treefinder import treefiend
-
+from downloader import wcs_url, download_with_retry, HostRateLimiter, Throughput
+from tiles import TILE_SIZE, SCALE_FACTOR, MODELS, tif_path_of, doubt_tif_path_of, neighbour_paths, plan_tiles
+from db import PGHOST, PGPORT, PGUSER, PGDATABASE, PGPASSWORD, get_connection
+from tile_cache import get_tile_cache
+from mosaic import TILE_FORMAT, mosaic_path, update_vrt
+from metrics import get_metrics, profiled
 
 
 # PARAMETERS
 
-if len(sys.argv) == 1:
-    #Centrum Krakowa
-    # LAT_MIN = float(os.getenv('LAT_MIN',50.04786869296248))
-    # LAT_MAX = float(os.getenv('LAT_MAX', 50.05265631114086))
-    # LON_MIN = float(os.getenv('LON_MIN',19.92424571666919))
-    # LON_MAX = float(os.getenv('LON_MAX',19.934312066931237))
-
-    # #Kraków ograniczony obwodnicami
-    # LAT_MIN = float(os.getenv('LAT_MIN',49.98990084121155))
-    # LAT_MAX = float(os.getenv('LAT_MAX', 50.120513852136696))
-    # LON_MIN = float(os.getenv('LON_MIN',19.798920671943563))
-    # LON_MAX = float(os.getenv('LON_MAX',20.07638014022811))
-
-    #Południe Krakowa - tam gdzie podjazdy
-    # LAT_MIN = float(os.getenv('LAT_MIN',49.98944742300455))
-    # LAT_MAX = float(os.getenv('LAT_MAX',50.069140407423106))
-    # LON_MIN = float(os.getenv('LON_MIN',19.807477376085956))
-    # LON_MAX = float(os.getenv('LON_MAX',19.998048150356652))
-
-    #podjazd pod zoo
-    
-    LAT_MIN = float(os.getenv('LAT_MIN', 50.04183857007973))
-    LAT_MAX = float(os.getenv('LAT_MAX', 50.06514819273997))
-    LON_MIN = float(os.getenv('LON_MIN', 19.828946554412852))
-    LON_MAX = float(os.getenv('LON_MAX', 19.871964006870684))
-
-
-    print('Using default coords')
-elif len(sys.argv) == 5:
-    LAT_MIN, LAT_MAX, LON_MIN, LON_MAX = [float(x) for x in sys.argv[1:5]]
-else:
-    print('usage: download_nmpt <lat_min> <lat_max> <lon_min> <lon_max')
-    exit(1)
-
 #Will insert only these tiles which are already in the directory (useful if one want to see some results in db out without waiting too long for all files to download)
 SKIP_DOWNLOAD = bool(os.getenv('SKIP_DOWNLOAD', False))
-
-TILE_SIZE = 1000  # meters
-SCALE_FACTOR = 1.0
-
-MODEL = os.getenv("MODEL", 'NMPT')
-if MODEL == 'NMT':
-    WCS_BASE = "https://mapy.geoportal.gov.pl/wss/service/PZGIK/NMT/GRID1/WCS/DigitalTerrainModelFormatTIFF"
-    RESPONSE_FORMAT = "image/tiff"
-    COVERAGE_ID = "DTM_PL-KRON86-NH_TIFF"
-    OUT_DIR = "tiles/nmt"
-if MODEL == "NMPT":
-    WCS_BASE = "https://mapy.geoportal.gov.pl/wss/service/PZGIK/NMPT/GRID1/WCS/DigitalSurfaceModel"
-    RESPONSE_FORMAT = "image/x-aaigrid"
-    COVERAGE_ID = "DSM_PL-KRON86-NH"
-    OUT_DIR = "tiles/nmpt"
-
-log('=== NMT/NMPT TILES DOWNLOAD AND IMPORT ===')
-log(f"MODEL:{MODEL}")
-log(f"WCS_BASE:{WCS_BASE}")
-log(f"RESPONSE_FORMAT:{RESPONSE_FORMAT}")
-log(f"OUT_DIR:{OUT_DIR}")
-log(f"LAT_MIN LAT_MAX LON_MIN LON_MAX")
-log(f"{LAT_MIN} {LAT_MAX} {LON_MIN} {LON_MAX}")
-log()
-
-
-# CRS TRANSFORM
-log("Creating coordinate transformation EPSG:4326 => EPSG:2180")
-
-src = osr.SpatialReference()
-src.ImportFromEPSG(4326)
-
-dst = osr.SpatialReference()
-dst.ImportFromEPSG(2180)
-
-transform = osr.CoordinateTransformation(src, dst)
-
-
-uly,ulx, _ = transform.TransformPoint(LAT_MAX, LON_MIN)
-
-lry,lrx, _ = transform.TransformPoint(LAT_MIN, LON_MAX)
-
-log(f"Raw transformed bbox:")
-log(f"  ULX={ulx}, ULY={uly}")
-log(f"  LRX={lrx}, LRY={lry}")
-
-if uly<0 or ulx<0 or lrx<0 or lry<0:
-    raise Exception("Incorrect bbox (negatove coords)")
-
-
-def tile_generator(ulx, uly, lrx, lry, TILE_SIZE=TILE_SIZE, log=log):
-    # SNAP TO TILE GRID
-
-    def snap_down(val, size):
-        return math.floor(val / size) * size
-
-    def snap_up(val, size):
-        return math.ceil(val / size) * size
-
-    ulx_s = snap_down(ulx, TILE_SIZE)
-    uly_s = snap_up(uly, TILE_SIZE)
-    lrx_s = snap_up(lrx, TILE_SIZE)
-    lry_s = snap_down(lry, TILE_SIZE)
-
-    log("Snapped bbox to 1000m grid:")
-    log(f"  ULX={ulx_s}, ULY={uly_s}")
-    log(f"  LRX={lrx_s}, LRY={lry_s}")
-
-    # =========================
-    # TILE GRID
-    # =========================
-
-    x_tiles = int((lrx_s - ulx_s) / TILE_SIZE)
-    y_tiles = int((uly_s - lry_s) / TILE_SIZE)
-
-    log(f"Tile grid size:")
-    log(f"  x_tiles={x_tiles}")
-    log(f"  y_tiles={y_tiles}")
-
-    os.makedirs(OUT_DIR, exist_ok=True)
-
-
-    # =========================
-    # DOWNLOAD LOOP
-    # =========================
-
-    tile_index = 0
-
-    for ix in range(x_tiles):
-        for iy in range(y_tiles):
-
-            tile_index += 1
-
-            xmin = ulx_s + ix * TILE_SIZE
-            xmax = xmin + TILE_SIZE
-            ymax = uly_s - iy * TILE_SIZE
-            ymin = ymax - TILE_SIZE
-
-            log(f"Tile {tile_index}:")
-            log(f"  ix={ix}, iy={iy}")
-            log(f"  xmin={xmin}, xmax={xmax}")
-            log(f"  ymin={ymin}, ymax={ymax}")
-            yield xmin, xmax, ymin, ymax
-    return
-
-tif_path_of = lambda OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin : f"{OUT_DIR}/tile_{xmin}_{ymin}_{TILE_SIZE}_{SCALE_FACTOR}.tif"
-doubt_tif_path_of = lambda OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin : f"{OUT_DIR}/tile_{xmin}_{ymin}_{TILE_SIZE}_{SCALE_FACTOR}.doubt.tif"
-downloaded_tiles = []
-
-## Download tiles
-log("== DOWNLOADING TILES ==")
-tile_num=0
-for xmin, xmax, ymin, ymax in tile_generator(ulx, uly, lrx, lry, log=silent):
-    tile_num+=1
-    print('tile:', tile_num, (xmin, xmax, ymin, xmax))
-    tif_path = tif_path_of(OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin)
-
-    if os.path.exists(tif_path):
-        log(f"Tile {tif_path} already exists, skipping download.")
-        downloaded_tiles.append(tif_path)
-        continue
-    if SKIP_DOWNLOAD:
-        log(f'SKIP_DOWNLOAD is set to 1: Skip tile {tif_path} entirely')
-        continue
-
-    params = {
-        "SERVICE": "WCS",
-        "VERSION": "2.0.1",
-        "REQUEST": "GetCoverage",
-        "COVERAGEID": COVERAGE_ID,
-        "FORMAT": RESPONSE_FORMAT,
-        "SUBSETTINGCRS": "EPSG:2180",
-        "SCALEFACTOR":str(SCALE_FACTOR),
-        "SUBSET": [
-            f"x({xmin},{xmax})",
-            f"y({ymin},{ymax})"
-        ]
-    }
-
-    #urlencode with repeated SUBSET keys
-    query = urlencode(params, doseq=True)
-    url = f"{WCS_BASE}?{query}"
-
-    response_body_file = OUT_DIR+"/buffer.txt"#  aaigrid files are very large, we won't keep all of them
-    log(f"  URL={url}")
-    log(f"  will write to to {response_body_file}")
-
-    retry_times_sec = [30, 60, 3*60, 15*60, 60*60]
-    retry_num = 0
-    retrieved = False
-    while(not retrieved and retry_num < len(retry_times_sec)):
-        try:
-            log(f'Commence download {url} to {response_body_file}')
-            urlretrieve(url, response_body_file)
-            log("  Download OK")
-            retrieved = True
-        except Exception as e:
-            log(f"  ERROR downloading tile: {e}")
-            log(f"Will wait {retry_times_sec[retry_num]} seconds and retry")
-            time.sleep(retry_times_sec[retry_num])
-            retry_num +=1
-    if not retrieved:
-        raise Exception("Reasonable number of retries exceeded.")
-    
-    if RESPONSE_FORMAT == "image/x-aaigrid":
-        #response has 3 files in it...
-        asc_file, _, prj_file = extract_multipart(response_body_file, OUT_DIR, expected_parts=['result.asc', 'result.asc.aux.xml', 'result.prj'])
-        #Convert to GeoTiff
-        #It apparently implicitly using prj file which is located within the same directory 
-        run_command(f"gdal_translate -of GTiff -co COMPRESS=LZW {asc_file} {tif_path}")
-    elif RESPONSE_FORMAT == "image/tiff":
-        #Just move, nothing to be done
-        run_command(f"mv {response_body_file} {tif_path}")
-    else:
-        raise Exception(f"wrong format:{RESPONSE_FORMAT}")
-    
-    #Ensure it is a proper GeoTiff, with matching bounding box
-    tif_info = run_command(f'gdalinfo {tif_path} | tail -n 6')#This fails if file is malformed
-    if not re.search(r'Upper Left *\( *'+str(xmin)+r'\.?0*, *'+str(ymax)+r'\.?0*\)', tif_info):
-        os.rename(tif_path, tif_path+'_MALFORMED')
-        raise Exception("Upper left corner of tiff doesn't match expected:", xmin, ymax)
-    if not re.search(r'Lower Right *\( *'+str(xmax)+r'\.?0*, *'+str(ymin)+r'\.?0*\)', tif_info):
-        os.rename(tif_path, tif_path+'_MALFORMED')
-        raise Exception("Lower Right corner of tiff doesn't match expected:", xmax, ymin)  
-    downloaded_tiles.append(tif_path)
+#'rasterio' converts and validates tiles in-process, 'gdal' uses gdal_translate and gdalinfo subprocesses
+CONVERTER = os.getenv('CONVERTER', 'rasterio')
+#Number of tiles downloaded at once; 1 keeps the old, sequential behaviour
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 1))
+#Minimal time (s) between starting two requests to the same server, shared by all workers
+MIN_REQUEST_INTERVAL = float(os.getenv('MIN_REQUEST_INTERVAL', 0))
+#Number of processes computing doubt maps; 1 computes them one by one in this process
+DOUBT_WORKERS = int(os.getenv('DOUBT_WORKERS', os.cpu_count() or 1))
+#Read a frame of pixels from adjacent tiles, so filters give the same result at tile edges as inside
+HALO_FROM_NEIGHBOURS = os.getenv('HALO_FROM_NEIGHBOURS', '1') == '1'
+#'copy' streams tiles over one connection from python, 'raster2pgsql' runs raster2pgsql | psql for every tile
+UPLOAD_MODE = os.getenv('UPLOAD_MODE', 'copy')
+#with 'copy': load only tiles which are new or changed since the previous run instead of dropping the tables
+UPLOAD_INCREMENTAL = os.getenv('UPLOAD_INCREMENTAL', '1') == '1'
+
+
+def fetch_tile(model, xmin, xmax, ymin, ymax, converter=CONVERTER, skip_download=SKIP_DOWNLOAD, rate_limiter=None, throughput=None):
+    """
+    Downloads, converts and validates a single tile. Returns path of the GeoTiff or None if skipped.
+    Safe to run in several threads at once: every temporary file is named after the tile.
+    """
+    from convert import response_to_geotiff, validate_tile
+    from mosaic import optimize_geotiff
+    cfg = MODELS[model]
+    tif_path = tif_path_of(cfg['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+
+    cache = get_tile_cache()
+    #another worker may be fetching the same tile, it is done once
+    with cache.lock(tif_path):
+        if cache.get(tif_path):
+            log(f"Tile {tif_path} already exists, skipping download.")
+            return tif_path
+        if os.path.exists(tif_path):
+            #tile from before the cache manifest, checked once and adopted
+            validate_tile(tif_path, xmin, xmax, ymin, ymax, converter)
+            if TILE_FORMAT == 'cog':
+                optimize_geotiff(tif_path)
+            cache.put(tif_path, model, cfg['coverage_id'], (xmin, ymin, xmax, ymax), SCALE_FACTOR)
+            log(f"Tile {tif_path} already exists, added to the cache.")
+            return tif_path
+        if skip_download:
+            log(f'SKIP_DOWNLOAD is set to 1: Skip tile {tif_path} entirely')
+            return None
+
+        url = wcs_url(cfg['wcs_base'], cfg['coverage_id'], cfg['response_format'], xmin, xmax, ymin, ymax, SCALE_FACTOR)
+
+        response_body_file = f"{cfg['out_dir']}/buffer_{xmin}_{ymin}.txt"#  aaigrid files are very large, we won't keep all of them
+        log(f"  URL={url}")
+        log(f"  will write to to {response_body_file}")
+
+        download_with_retry(url, response_body_file, rate_limiter=rate_limiter, throughput=throughput, log=log)
+
+        response_to_geotiff(response_body_file, tif_path, cfg['response_format'], xmin, xmax, ymin, ymax, converter)
+        validate_tile(tif_path, xmin, xmax, ymin, ymax, converter)
+        if TILE_FORMAT == 'cog':
+            optimize_geotiff(tif_path)
+        cache.put(tif_path, model, cfg['coverage_id'], (xmin, ymin, xmax, ymax), SCALE_FACTOR)
     log('Finished with tile ', tif_path)
     log()
-    
-log(f'Downloaded {len(downloaded_tiles)} tiles')
-
-
-if MODEL == "NMPT":
-    log(f"== COMPUTING DOUBT MAPS FOR NMPT ==")
+    return tif_path
+
+
+def fetch_tiles(model, tiles, workers=DOWNLOAD_WORKERS, min_request_interval=MIN_REQUEST_INTERVAL, **fetch_options):
+    """Fetches tiles [(xmin, xmax, ymin, ymax)], returns paths of the GeoTiffs in the order of tiles"""
+    log("== DOWNLOADING TILES ==")
+    log(f"DOWNLOAD_WORKERS:{workers} MIN_REQUEST_INTERVAL:{min_request_interval}")
+    os.makedirs(MODELS[model]['out_dir'], exist_ok=True)
+    rate_limiter = HostRateLimiter(min_request_interval)
+    throughput = Throughput()
+    downloaded_tiles = []
+    if workers <= 1:
+        tile_num=0
+        for xmin, xmax, ymin, ymax in tiles:
+            tile_num+=1
+            print('tile:', tile_num, (xmin, xmax, ymin, xmax))
+            tif_path = fetch_tile(model, xmin, xmax, ymin, ymax, rate_limiter=rate_limiter, throughput=throughput, **fetch_options)
+            if tif_path is not None:
+                downloaded_tiles.append(tif_path)
+    else:
+        failed_tiles = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch_tile, model, *tile, rate_limiter=rate_limiter, throughput=throughput, **fetch_options): tile
+                       for tile in tiles}
+            for tile_num, future in enumerate(as_completed(futures), start=1):
+                try:
+                    tif_path = future.result()
+                except Exception as e:
+                    log(f"  ERROR tile {futures[future]} failed: {e}")
+                    failed_tiles.append(futures[future])
+                    continue
+                if tif_path is not None:
+                    downloaded_tiles.append(tif_path)
+                log(f'tile: {tile_num}/{len(tiles)} done; {throughput.report()}')
+        if failed_tiles:
+            raise Exception(f"{len(failed_tiles)} tiles failed:", failed_tiles)
+        #keep the same order as tile_generator, regardless of completion order
+        out_dir = MODELS[model]['out_dir']
+        order = {tif_path_of(out_dir, TILE_SIZE, SCALE_FACTOR, t[0], t[2]): i for i, t in enumerate(tiles)}
+        downloaded_tiles.sort(key=order.get)
+
+    log(f'Download throughput: {throughput.report()}')
+    log(f'Downloaded {len(downloaded_tiles)} tiles')
+    update_vrt(mosaic_path(MODELS[model]['out_dir']), downloaded_tiles)
+    return downloaded_tiles
+
+
+def generate_doubt_map_job(tif_path, doubt_tif_path, neighbours=None, tile_format=TILE_FORMAT):
+    """Entry point for worker processes: doubt map of one tile, laid out as the tiles are"""
+    from treefinder import treefiend
+    with profiled('roughness'):
+        treefiend.generate_roughness_job(tif_path, doubt_tif_path, neighbours)
+    if tile_format == 'cog':
+        from mosaic import optimize_geotiff
+        optimize_geotiff(doubt_tif_path)
+    return doubt_tif_path
+
+
+def timed_doubt_map_job(tif_path, doubt_tif_path, neighbours=None):
+    """generate_doubt_map_job returning (doubt_tif_path, seconds) - its own duration, waiting in the pool is not counted"""
+    t0 = time.monotonic()
+    generate_doubt_map_job(tif_path, doubt_tif_path, neighbours)
+    return doubt_tif_path, time.monotonic() - t0
+
+
+def generate_doubt_maps(model, tiles, workers=DOUBT_WORKERS, halo_from_neighbours=HALO_FROM_NEIGHBOURS):
+    """Doubt maps of the tiles which are on disk, returns their paths; maps younger than their inputs are kept"""
+    log(f"== COMPUTING DOUBT MAPS FOR {model} ==")
+    out_dir = MODELS[model]['out_dir']
     generated_doubt_tiles = []
+    doubt_jobs = []
     tile_num=0
-    for xmin, xmax, ymin, ymax in tile_generator(ulx, uly, lrx, lry, log=silent):
+    for xmin, xmax, ymin, ymax in tiles:
         tile_num+=1
         print('tile:', tile_num, (xmin, xmax, ymin, xmax))
-        tif_path = tif_path_of(OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin)
-        doubt_tif_path = doubt_tif_path_of(OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        tif_path = tif_path_of(out_dir, TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        doubt_tif_path = doubt_tif_path_of(out_dir, TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        if not os.path.exists(tif_path):
+            continue
+
+        #Edges of the doubt map are computed from strips of the adjacent tiles, so they are inputs too
+        neighbours = neighbour_paths(out_dir, xmin, ymin)
+        if not halo_from_neighbours:
+            neighbours = {}
 
-        #Skip tile if doubt tile (derivate) is younger than the original tif
-        if os.path.exists(doubt_tif_path) and os.path.getmtime(doubt_tif_path) > os.path.getmtime(tif_path):
+        #Skip tile if doubt tile (derivate) is younger than the original tif (and its neighbours)
+        newest_input = max(os.path.getmtime(p) for p in [tif_path, *neighbours.values()])
+        if os.path.exists(doubt_tif_path) and os.path.getmtime(doubt_tif_path) > newest_input:
             log(f"Skipping generating roughness to {doubt_tif_path} since it younger than input file {tif_path}")
             generated_doubt_tiles.append(doubt_tif_path)
             continue
-
-        treefiend.generate_roughness(tif_path, doubt_tif_path, save_also_png = False)
-        log('Generated ', doubt_tif_path)
-        generated_doubt_tiles.append(doubt_tif_path)
-    log("generated all doubt maps for NMPT model")
-
-# upload to postgis
-# clean old rasters
-PGHOST=os.getenv('PGHOST', 'localhost')
-PGPORT=int(os.getenv('PGPORT', '5439'))
-PGUSER=os.getenv('PGUSER','postgres')
-PGDATABASE=os.getenv('PGDATABASE', 'osm')
-PGPASSWORD=os.getenv('PGPASSWORD', 'postgres')
-os.environ['PGPASSWORD'] = PGPASSWORD
-
-if MODEL == "NMPT":
-    RASTER_TABLE='dtcm'
-elif MODEL == "NMT":
-    RASTER_TABLE="dtm"
-
-def upload_rasters_to_db(RASTER_TABLE:str, tiles:list):
+        doubt_jobs.append((tif_path, doubt_tif_path, neighbours))
+
+    log(f"Generating {len(doubt_jobs)} doubt maps with DOUBT_WORKERS={workers}")
+    if workers <= 1:
+        for tif_path, doubt_tif_path, neighbours in doubt_jobs:
+            _, elapsed = timed_doubt_map_job(tif_path, doubt_tif_path, neighbours)
+            get_metrics().observe('roughness_seconds', elapsed)
+            log('Generated ', doubt_tif_path)
+            get_tile_cache().put(doubt_tif_path, model, derived_from=tif_path)
+            generated_doubt_tiles.append(doubt_tif_path)
+    else:
+        #forkserver: the caller may run threads, which a plain fork would copy in whatever state they are
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+            futures = {pool.submit(timed_doubt_map_job, *job): job[0] for job in doubt_jobs}
+            for future in as_completed(futures):
+                doubt_tif_path, elapsed = future.result()
+                #recorded here: worker processes don't write the metrics file
+                get_metrics().observe('roughness_seconds', elapsed)
+                log('Generated ', doubt_tif_path)
+                get_tile_cache().put(doubt_tif_path, model, derived_from=futures[future])
+                generated_doubt_tiles.append(doubt_tif_path)
+    log(f"generated all doubt maps for {model} model")
+    update_vrt(mosaic_path(out_dir, 'doubt'), generated_doubt_tiles)
+    return generated_doubt_tiles
+
+
+def upload_rasters_to_db(RASTER_TABLE:str, tiles:list, mode=UPLOAD_MODE, incremental=UPLOAD_INCREMENTAL):
+    from raster_upload import upload_rasters_copy, upload_rasters_incremental, record_tile_changes, DB_OVERVIEWS
+    if mode == 'copy' and incremental:
+        upload_rasters_incremental(RASTER_TABLE, tiles)
+        return
+    if mode == 'copy':
+        upload_rasters_copy(RASTER_TABLE, tiles)
+        return
+    os.environ['PGPASSWORD'] = PGPASSWORD
     log(f"== UPLOADING {len(tiles)} TILES TO TABLE {RASTER_TABLE} ==")
     run_command(f'psql -h "{PGHOST}" -p "{PGPORT}" -U "{PGUSER}" -d "{PGDATABASE}" -c "CREATE EXTENSION IF NOT EXISTS postgis;"')
     run_command(f'psql -h "{PGHOST}" -p "{PGPORT}" -U "{PGUSER}" -d "{PGDATABASE}" -c "CREATE EXTENSION IF NOT EXISTS postgis_raster;"')
 
     log(f"Dropping the target table ${RASTER_TABLE} if exists")
     run_command(f' psql -h "{PGHOST}" -p "{PGPORT}" -U "{PGUSER}" -d "{PGDATABASE}" -c "DROP TABLE IF EXISTS {RASTER_TABLE} CASCADE;"')
-    # for i in 2,4,8,16:
-    #     run_command(f' psql -h "{PGHOST}" -p "{PGPORT}" -U "{PGUSER}" -d "{PGDATABASE}" -c "DROP TABLE IF EXISTS o_{i}_{RASTER_TABLE} CASCADE;"')
+    for i in DB_OVERVIEWS:
+        run_command(f' psql -h "{PGHOST}" -p "{PGPORT}" -U "{PGUSER}" -d "{PGDATABASE}" -c "DROP TABLE IF EXISTS o_{i}_{RASTER_TABLE} CASCADE;"')
 
     #loading rasters
     i=0
     for raster_file in tiles:
         ini_opt = '-I ' if i==0 else '-a '
-        pyramids = ""#"-l 2,4,8,16 "
+        pyramids = f"-l {','.join(str(f) for f in DB_OVERVIEWS)} " if DB_OVERVIEWS else ""
         run_command(f'raster2pgsql -s 2180 -Y -M {pyramids}{ini_opt}-t auto "{raster_file}" "public.{RASTER_TABLE}"'+
                     f' | psql -h "{PGHOST}" -p "{PGPORT}" -U "{PGUSER}" -d "{PGDATABASE}"')
         i+=1
+    record_tile_changes(get_connection(), RASTER_TABLE, tiles)
+    get_connection().commit()
     log('Finished.')
-upload_rasters_to_db(RASTER_TABLE, downloaded_tiles)
 
-if MODEL == "NMPT":
-    upload_rasters_to_db("dtcm_doubt", generated_doubt_tiles)
\ No newline at end of file
+
+def download_model(model, lat_min, lat_max, lon_min, lon_max, upload=True, **options):
+    """
+    Whole processing of one model for a bbox: tiles, doubt maps (NMPT) and upload.
+    options: fetch_tiles() keyword arguments (workers, converter, ...)
+    Returns (tiles, doubt_tiles) as lists of paths.
+    """
+    cfg = MODELS[model]
+    log('=== NMT/NMPT TILES DOWNLOAD AND IMPORT ===')
+    log(f"MODEL:{model}")
+    log(f"WCS_BASE:{cfg['wcs_base']}")
+    log(f"RESPONSE_FORMAT:{cfg['response_format']}")
+    log(f"OUT_DIR:{cfg['out_dir']}")
+    log(f"LAT_MIN LAT_MAX LON_MIN LON_MAX")
+    log(f"{lat_min} {lat_max} {lon_min} {lon_max}")
+    log()
+
+    tiles = plan_tiles(lat_min, lat_max, lon_min, lon_max)
+    downloaded_tiles = fetch_tiles(model, tiles, **options)
+    doubt_tiles = generate_doubt_maps(model, tiles) if 'doubt_table' in cfg else []
+
+    #tiles of this bbox (of every model) stay, they are still needed for the slopes
+    cache = get_tile_cache()
+    cache.remove_malformed(cfg['out_dir'])
+    if cache.evict(keep=[tif_path_of(m['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin) for m in MODELS.values() for xmin, _, ymin, _ in tiles]):
+        #drop evicted tiles from the mosaics
+        for m in MODELS.values():
+            for kind in ('tif', 'doubt'):
+                if os.path.exists(mosaic_path(m['out_dir'], kind)):
+                    update_vrt(mosaic_path(m['out_dir'], kind))
+
+    if upload:
+        upload_rasters_to_db(cfg['raster_table'], downloaded_tiles)
+        if 'doubt_table' in cfg:
+            upload_rasters_to_db(cfg['doubt_table'], doubt_tiles)
+    return downloaded_tiles, doubt_tiles
+
+
+def main(argv):
+    if len(argv) == 1:
+        #Centrum Krakowa
+        # LAT_MIN = float(os.getenv('LAT_MIN',50.04786869296248))
+        # LAT_MAX = float(os.getenv('LAT_MAX', 50.05265631114086))
+        # LON_MIN = float(os.getenv('LON_MIN',19.92424571666919))
+        # LON_MAX = float(os.getenv('LON_MAX',19.934312066931237))
+
+        # #Kraków ograniczony obwodnicami
+        # LAT_MIN = float(os.getenv('LAT_MIN',49.98990084121155))
+        # LAT_MAX = float(os.getenv('LAT_MAX', 50.120513852136696))
+        # LON_MIN = float(os.getenv('LON_MIN',19.798920671943563))
+        # LON_MAX = float(os.getenv('LON_MAX',20.07638014022811))
+
+        #Południe Krakowa - tam gdzie podjazdy
+        # LAT_MIN = float(os.getenv('LAT_MIN',49.98944742300455))
+        # LAT_MAX = float(os.getenv('LAT_MAX',50.069140407423106))
+        # LON_MIN = float(os.getenv('LON_MIN',19.807477376085956))
+        # LON_MAX = float(os.getenv('LON_MAX',19.998048150356652))
+
+        #podjazd pod zoo
+        LAT_MIN = float(os.getenv('LAT_MIN', 50.04183857007973))
+        LAT_MAX = float(os.getenv('LAT_MAX', 50.06514819273997))
+        LON_MIN = float(os.getenv('LON_MIN', 19.828946554412852))
+        LON_MAX = float(os.getenv('LON_MAX', 19.871964006870684))
+        print('Using default coords')
+    elif len(argv) == 5:
+        LAT_MIN, LAT_MAX, LON_MIN, LON_MAX = [float(x) for x in argv[1:5]]
+    else:
+        print('usage: download_nmpt <lat_min> <lat_max> <lon_min> <lon_max')
+        return 1
+
+    MODEL = os.getenv("MODEL", 'NMPT')
+    log(f"CONVERTER:{CONVERTER}")
+    download_model(MODEL, LAT_MIN, LAT_MAX, LON_MIN, LON_MAX)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
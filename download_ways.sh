@@ -25,12 +25,52 @@ LON_MAX="$4"
 bbox="$LAT_MIN $LAT_MAX $LON_MIN $LON_MAX"
 echo "bbox:" $bbox
 
+# Highway kinds imported into ways (ways.lua reads the same variable), only named ones are kept.
+# WAYS_KINDS=all imports every highway.
+export WAYS_KINDS="${WAYS_KINDS:-primary,secondary,tertiary,residential,living_street,unclassified,service}"
+# OSM_PBF=poland-latest.osm.pbf - local extract (e.g. from download.geofabrik.de) instead of Overpass, no network needed
+OSM_PBF="${OSM_PBF:-}"
+# OSM_UPDATES=1 - import in slim mode, so diffs can be applied later with OSM_CHANGE
+OSM_UPDATES="${OSM_UPDATES:-0}"
+# OSM_CHANGE=changes.osc.gz - applies the diff to ways imported before with OSM_UPDATES=1
+OSM_CHANGE="${OSM_CHANGE:-}"
+
+osm2pgsql_args=(-d "$PGDATABASE" -H "$PGHOST" -P "$PGPORT" -U "$PGUSER" -O flex -S ways.lua)
+
+if [ -n "$OSM_CHANGE" ]; then
+  # Objects of the diff outside the bbox are skipped
+  osm2pgsql "${osm2pgsql_args[@]}" --slim --append --bbox "$LON_MIN,$LAT_MIN,$LON_MAX,$LAT_MAX" "$OSM_CHANGE"
+  exit 0
+fi
+
+if [ "$OSM_UPDATES" = "1" ]; then
+  osm2pgsql_args+=(--slim)
+fi
+
+if [ -n "$OSM_PBF" ]; then
+  # Clipped and filtered in one stream, osm2pgsql reads only the ways it keeps and their nodes
+  if [ "$WAYS_KINDS" = "all" ]; then
+    filter="w/highway"
+  else
+    filter="w/highway=$WAYS_KINDS"
+  fi
+  osmium extract --bbox "$LON_MIN,$LAT_MIN,$LON_MAX,$LAT_MAX" --strategy complete_ways -f pbf -o - "$OSM_PBF" \
+    | osmium tags-filter -F pbf - "$filter" -f pbf -o ways.osm.pbf --overwrite
+  osm2pgsql "${osm2pgsql_args[@]}" ways.osm.pbf
+  exit 0
+fi
+
+if [ "$WAYS_KINDS" = "all" ]; then
+  query='way["highway"]'
+else
+  query="way[\"highway\"~\"^(${WAYS_KINDS//,/|})\$\"][\"name\"]"
+fi
 addr=\
 "http://overpass-api.de/api/interpreter"\
-'?data=way["highway"]'\
+"?data=$query"\
 "($LAT_MIN,$LON_MIN,$LAT_MAX,$LON_MAX);"\
 "(._;>>;);"\
 "out;"
-wget $addr -O ways.osm
+wget "$addr" -O ways.osm
 
-osm2pgsql -d $PGDATABASE -H $PGHOST -P $PGPORT -U postgres -O flex -S ways.lua ways.osm
+osm2pgsql "${osm2pgsql_args[@]}" ways.osm
@@ -0,0 +1,118 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+from urllib.request import urlretrieve
+
+from metrics import get_metrics
+
+#Same schedule as the original sequential loop, the last one is long: geoportal tends to stop responding for a while
+RETRY_TIMES_SEC = [30, 60, 3*60, 15*60, 60*60]
+
+
+def wcs_url(wcs_base, coverage_id, response_format, xmin, xmax, ymin, ymax, scale_factor=1.0):
+    params = {
+        "SERVICE": "WCS",
+        "VERSION": "2.0.1",
+        "REQUEST": "GetCoverage",
+        "COVERAGEID": coverage_id,
+        "FORMAT": response_format,
+        "SUBSETTINGCRS": "EPSG:2180",
+        "SCALEFACTOR":str(scale_factor),
+        "SUBSET": [
+            f"x({xmin},{xmax})",
+            f"y({ymin},{ymax})"
+        ]
+    }
+    #urlencode with repeated SUBSET keys
+    query = urlencode(params, doseq=True)
+    return f"{wcs_base}?{query}"
+
+
+class HostRateLimiter:
+    """
+    Keeps at least min_interval_sec between starts of consecutive requests to the same host,
+    no matter how many worker threads are asking.
+    """
+    def __init__(self, min_interval_sec=0.0):
+        self.min_interval_sec = min_interval_sec
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url):
+        if self.min_interval_sec <= 0:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval_sec
+        #sleep outside of the lock, so other hosts (and bookkeeping) are not blocked
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Throughput:
+    """Thread safe counter of downloaded tiles and bytes"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+        self.tiles = 0
+        self.bytes = 0
+        self.retries = 0
+
+    def add(self, nbytes):
+        with self._lock:
+            self.tiles += 1
+            self.bytes += nbytes
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (f"{self.tiles} tiles, {self.bytes} bytes in {elapsed:.1f} s: "
+                f"{self.tiles / elapsed * 60:.2f} tiles/min, {self.bytes / elapsed:.0f} bytes/s, "
+                f"{self.retries} retries")
+
+
+def download_with_retry(url, out_path, retry_times_sec=RETRY_TIMES_SEC, rate_limiter=None, throughput=None, jitter=0.25, log=print):
+    """
+    Downloads url to out_path, retrying with jittered waits.
+    Waiting happens in the calling thread only, so other workers keep downloading.
+    File is written under temporary name and renamed, so out_path is either complete or absent.
+    Returns number of bytes downloaded.
+    """
+    tmp_path = out_path + '.part'
+    metrics = get_metrics()
+    for retry_num in range(len(retry_times_sec)):
+        try:
+            if rate_limiter is not None:
+                rate_limiter.wait(url)
+            log(f'Commence download {url} to {out_path}')
+            t0 = time.monotonic()
+            urlretrieve(url, tmp_path)
+            os.replace(tmp_path, out_path)
+            nbytes = os.path.getsize(out_path)
+            log(f"  Download OK ({nbytes} bytes)")
+            metrics.observe('download_seconds', time.monotonic() - t0)
+            metrics.inc('tiles_fetched')
+            metrics.inc('bytes_downloaded', nbytes)
+            if throughput is not None:
+                throughput.add(nbytes)
+            return nbytes
+        except Exception as e:
+            log(f"  ERROR downloading tile: {e}")
+            if retry_num == len(retry_times_sec) - 1:
+                break
+            metrics.inc('download_retries')
+            if throughput is not None:
+                throughput.add_retry()
+            wait = retry_times_sec[retry_num] * random.uniform(1 - jitter, 1 + jitter)
+            log(f"Will wait {wait:.0f} seconds and retry")
+            time.sleep(wait)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    raise Exception("Reasonable number of retries exceeded.")
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+#Streams slope_static as GeoJSON to stdout.
+#Rows come through a server-side cursor and every feature is written as soon as it arrives,
+#so memory use doesn't depend on the number of segments (unlike one json_agg() value built by PostgreSQL).
+
+import os
+import sys
+
+from db import get_connection
+
+#'1' - newline-delimited GeoJSON, one feature per line, instead of a FeatureCollection
+NDJSON = os.getenv('NDJSON', '0') == '1'
+#Decimal digits of the coordinates; 6 is ~0.1 m in EPSG:4326, 9 is the PostGIS default
+GEOJSON_PRECISION = int(os.getenv('GEOJSON_PRECISION', 9))
+ITERSIZE = 10_000
+
+FEATURES_SQL = """
+SELECT ST_AsGeoJSON(s.*, 'geom', %s, id_column => 'segment_id')
+FROM (SELECT segment_id, ST_Transform(geom, 4326) AS geom, slope, name FROM slope_static) s
+"""
+
+
+def export_geojson(out, conn=None, ndjson=NDJSON, precision=GEOJSON_PRECISION, itersize=ITERSIZE):
+    """Writes features of slope_static to out (text file object), returns their number"""
+    conn = conn or get_connection()
+    n = 0
+    with conn.cursor(name='export_geojson') as cur:
+        cur.itersize = itersize
+        cur.execute(FEATURES_SQL, (precision,))
+        if not ndjson:
+            out.write('{"type":"FeatureCollection","features":[')
+        for (feature,) in cur:
+            if ndjson:
+                out.write(feature)
+                out.write('\n')
+            else:
+                if n:
+                    out.write(',\n')
+                out.write(feature)
+            n += 1
+        if not ndjson:
+            out.write(']}\n')
+    conn.commit()
+    return n
+
+
+if __name__ == '__main__':
+    n = export_geojson(sys.stdout)
+    print(f'Exported {n} features', file=sys.stderr)
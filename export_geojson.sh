@@ -4,23 +4,5 @@ set -euo pipefail
 source config.sh
 export PGPASSWORD
 
-psql \
-  -h "${PGHOST}" \
-  -p "${PGPORT}" \
-  -U "${PGUSER}" \
-  -d "${PGDATABASE}" \
-  -tAc "
-select
-    json_build_object(
-        'type',
-        'FeatureCollection',
-        'features',
-        json_agg(
-            ST_AsGeoJSON(
-                s.*,
-                id_column => 'segment_id'
-            )::json
-        )
-    )
-from (select segment_id, ST_Transform(geom, 4326) as geom, slope, name from slope_static) s
-"
+#NDJSON=1 writes one feature per line, GEOJSON_PRECISION=6 rounds coordinates to 6 decimal digits
+python3 export_geojson.py
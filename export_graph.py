@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+#Exports slope_static as a routing graph in CSR form (compressed sparse rows), one .npy file per array,
+#so a router can np.load(..., mmap_mode='r') a whole city in milliseconds without copying it into memory.
+#Topology comes from the OSM nodes shared by ways (unsimplified geometry of ways): slope_static is cut from
+#geometries simplified per way, which drops a junction vertex lying almost on a straight way (T-junction),
+#so the segment passing by such a junction is split there. Points closer than GRAPH_SNAP are one node.
+#Every segment (piece) gives two directed edges, grade is signed in the direction of travel (positive uphill).
+
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from db import get_connection
+
+log = print
+
+#Points closer than this (m, EPSG:2180) are one node
+GRAPH_SNAP = float(os.getenv('GRAPH_SNAP', 0.01))
+#Max distance (m) of a junction from the simplified segment it is snapped to:
+#the simplification tolerance of compute_slope_static.sql (2 m) with a margin
+GRAPH_JOIN = float(os.getenv('GRAPH_JOIN', 2.5))
+GRAPH_FORMAT_VERSION = 1
+
+#Heights actually used for the slope: nmt_used_* is NULL for rows of compute_slope_static_cursor(),
+#then the same rule is applied here
+EDGES_SQL = """
+SELECT
+    s.segment_id,
+    s.way_id,
+    ST_X(ST_StartPoint(s.geom)), ST_Y(ST_StartPoint(s.geom)),
+    ST_X(ST_EndPoint(s.geom)), ST_Y(ST_EndPoint(s.geom)),
+    ST_Length(s.geom),
+    s.slope,
+    CASE WHEN coalesce(s.nmt_used_a = 0, s.nmpt_doubt_a < 1.0 OR w.layer IS NOT NULL OR w.bridge IS NOT NULL)
+        THEN s.nmpt_h_a ELSE s.nmt_h_a END,
+    CASE WHEN coalesce(s.nmt_used_b = 0, s.nmpt_doubt_b < 1.0 OR w.layer IS NOT NULL OR w.bridge IS NOT NULL)
+        THEN s.nmpt_h_b ELSE s.nmt_h_b END
+FROM slope_static s
+LEFT JOIN ways w ON w.way_id = s.way_id
+"""
+
+#(way_id, x, y) of the vertices shared by more than one way of slope_static, from the unsimplified geometry;
+#a shared OSM node is transformed to the same coordinates in every way
+JUNCTIONS_SQL = """
+SELECT way_id, x, y
+FROM (
+    SELECT way_id, x, y, count(*) OVER (PARTITION BY x, y) AS ways
+    FROM (
+        SELECT DISTINCT w.way_id, ST_X(d.geom) AS x, ST_Y(d.geom) AS y
+        FROM ways w
+        CROSS JOIN LATERAL ST_DumpPoints(ST_Transform(w.geom, 2180)) d
+        WHERE w.way_id IN (SELECT DISTINCT way_id FROM slope_static)
+    ) vertices
+) counted
+WHERE ways > 1
+"""
+
+#name: dtype of the arrays written
+ARRAYS = {
+    'offsets': np.int64,     #edges of node i are offsets[i]:offsets[i + 1]
+    'targets': np.int32,
+    'length': np.float32,    #meters
+    'grade': np.float32,     #signed fraction, dh / length in the direction of the edge
+    'segment_id': np.int64,  #slope_static row of the edge
+    'node_x': np.float64,    #EPSG:2180
+    'node_y': np.float64,
+}
+
+
+def fetch_edges(conn, itersize=100_000):
+    rows = []
+    with conn.cursor(name='export_graph_edges') as cur:
+        cur.itersize = itersize
+        cur.execute(EDGES_SQL)
+        for row in cur:
+            rows.append(row)
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 10)
+    return {
+        'segment_id': rows[:, 0].astype(np.int64), 'way_id': rows[:, 1].astype(np.int64),
+        'xa': rows[:, 2], 'ya': rows[:, 3], 'xb': rows[:, 4], 'yb': rows[:, 5],
+        'length': rows[:, 6], 'slope': rows[:, 7], 'h_a': rows[:, 8], 'h_b': rows[:, 9],
+    }
+
+
+def fetch_junctions(conn):
+    with conn.cursor() as cur:
+        cur.execute(JUNCTIONS_SQL)
+        rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+    return {'way_id': rows[:, 0].astype(np.int64), 'x': rows[:, 1], 'y': rows[:, 2]}
+
+
+def point_segment_distance(px, py, xa, ya, xb, yb):
+    """(distance, position 0..1 of the closest point) from points p to segments a-b, vectorized"""
+    dx = xb - xa
+    dy = yb - ya
+    d2 = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(d2 > 0, ((px - xa) * dx + (py - ya) * dy) / d2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(xa + t * dx - px, ya + t * dy - py), t
+
+
+def junction_splits(edges, junctions, join=GRAPH_JOIN, snap=GRAPH_SNAP):
+    """
+    (segment, t, x, y) of the junctions lying inside segments: for every way of a junction the closest
+    of its segments, if within `join` m and farther than `snap` from both its ends (ends are merged as nodes).
+    """
+    empty = (np.array([], dtype=np.int64),) + (np.array([]),) * 3
+    if junctions['way_id'].size == 0:
+        return empty
+    #segments of every way: order[first[w]:first[w] + count[w]]
+    order = np.argsort(edges['way_id'], kind='stable')
+    ways, first, count = np.unique(edges['way_id'][order], return_index=True, return_counts=True)
+    pos = np.minimum(np.searchsorted(ways, junctions['way_id']), ways.size - 1)
+    known = ways[pos] == junctions['way_id']
+    jx, jy, pos = junctions['x'][known], junctions['y'][known], pos[known]
+    if pos.size == 0:
+        return empty
+    #every (junction, way) pair against all segments of the way
+    n = count[pos]
+    pair = np.repeat(np.arange(pos.size), n)
+    k = np.arange(pair.size) - np.repeat(np.cumsum(n) - n, n)
+    seg = order[first[pos][pair] + k]
+    dist, t = point_segment_distance(jx[pair], jy[pair], edges['xa'][seg], edges['ya'][seg], edges['xb'][seg], edges['yb'][seg])
+    closest = np.lexsort((dist, pair))
+    closest = closest[np.concatenate([[True], pair[closest][1:] != pair[closest][:-1]])]
+    seg, dist, t, pair = seg[closest], dist[closest], t[closest], pair[closest]
+    x, y = jx[pair], jy[pair]
+    inside = ((dist <= join)
+              & (np.hypot(x - edges['xa'][seg], y - edges['ya'][seg]) > snap)
+              & (np.hypot(x - edges['xb'][seg], y - edges['yb'][seg]) > snap))
+    return seg[inside], t[inside], x[inside], y[inside]
+
+
+def merge_points(x, y, snap=GRAPH_SNAP):
+    """(node of every point, node_x, node_y): points within snap m of each other (transitively) are one node"""
+    pairs = cKDTree(np.column_stack([x, y])).query_pairs(snap, output_type='ndarray')
+    adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(x.size, x.size))
+    n_nodes, node_of = connected_components(adjacency, directed=False)
+    #node at the centre of its points
+    count = np.bincount(node_of, minlength=n_nodes)
+    return node_of, np.bincount(node_of, x, n_nodes) / count, np.bincount(node_of, y, n_nodes) / count
+
+
+def build_graph(edges, junctions=None, snap=GRAPH_SNAP, join=GRAPH_JOIN):
+    """
+    Arrays of the CSR graph (see ARRAYS) from segment ends, lengths and heights.
+    junctions: {'way_id', 'x', 'y'} of the vertices shared by ways (see JUNCTIONS_SQL), segments are split there.
+    """
+    n_seg = edges['segment_id'].size
+    if junctions is None:
+        junctions = {'way_id': np.array([], dtype=np.int64), 'x': np.array([]), 'y': np.array([])}
+    split_seg, split_t, split_x, split_y = junction_splits(edges, junctions, join, snap)
+
+    #points along every segment: its ends (t = 0, 1) and the junctions inside it, consecutive points make pieces
+    pt_seg = np.concatenate([np.arange(n_seg), np.arange(n_seg), split_seg])
+    pt_t = np.concatenate([np.zeros(n_seg), np.ones(n_seg), split_t])
+    pt_x = np.concatenate([edges['xa'], edges['xb'], split_x])
+    pt_y = np.concatenate([edges['ya'], edges['yb'], split_y])
+    along = np.lexsort((pt_t, pt_seg))
+    same = pt_seg[along][1:] == pt_seg[along][:-1]
+    start, end = along[:-1][same], along[1:][same]
+    seg = pt_seg[start]
+
+    node_of, node_x, node_y = merge_points(pt_x, pt_y, snap)
+    a, b = node_of[start], node_of[end]
+    #segments shorter than snap collapse into a node
+    keep = a != b
+    a, b, seg = a[keep], b[keep], seg[keep]
+    length = edges['length'][seg] * (pt_t[end] - pt_t[start])[keep]
+
+    #magnitude is the stored slope (same as in the map), the sign comes from the heights used for it
+    grade = np.copysign(edges['slope'], edges['h_b'] - edges['h_a'])[seg]
+    source = np.concatenate([a, b])
+    order = np.argsort(source, kind='stable')
+    counts = np.bincount(source, minlength=node_x.size)
+    return {
+        'offsets': np.concatenate([[0], np.cumsum(counts)]),
+        'targets': np.concatenate([b, a])[order],
+        'length': np.concatenate([length, length])[order],
+        'grade': np.concatenate([grade, -grade])[order],
+        'segment_id': np.concatenate([edges['segment_id'][seg], edges['segment_id'][seg]])[order],
+        'node_x': node_x,
+        'node_y': node_y,
+    }
+
+
+def count_components(graph):
+    """Number of connected parts of the graph (1 when every street is reachable from every other)"""
+    n_nodes = len(graph['offsets']) - 1
+    source = np.repeat(np.arange(n_nodes), np.diff(graph['offsets']))
+    adjacency = coo_matrix((np.ones(source.size), (source, graph['targets'])), shape=(n_nodes, n_nodes))
+    return connected_components(adjacency, directed=False)[0]
+
+
+def save_graph(out_dir, graph, snap=GRAPH_SNAP):
+    """One .npy per array plus graph.json; arrays are written first, graph.json marks a complete export"""
+    os.makedirs(out_dir, exist_ok=True)
+    meta_path = os.path.join(out_dir, 'graph.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name, dtype in ARRAYS.items():
+        np.save(os.path.join(out_dir, f'{name}.npy'), np.ascontiguousarray(graph[name], dtype=dtype))
+    meta = {
+        'version': GRAPH_FORMAT_VERSION,
+        'nodes': len(graph['offsets']) - 1,
+        'edges': len(graph['targets']),
+        'srid': 2180,
+        'snap': snap,
+        'arrays': {name: np.dtype(dtype).str for name, dtype in ARRAYS.items()},
+    }
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def load_graph(graph_dir, mmap_mode='r'):
+    """
+    Graph exported by export_graph() as a dict of arrays (see ARRAYS), memory-mapped by default:
+    pages are read on first access and shared between processes loading the same files.
+    Neighbours of node i: targets[offsets[i]:offsets[i + 1]], with length, grade, segment_id at the same positions.
+    """
+    with open(os.path.join(graph_dir, 'graph.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != GRAPH_FORMAT_VERSION:
+        raise Exception(f"Unsupported graph format version {meta['version']} in {graph_dir}")
+    graph = {name: np.load(os.path.join(graph_dir, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+    graph['meta'] = meta
+    return graph
+
+
+def export_graph(out_dir, conn=None, snap=GRAPH_SNAP, join=GRAPH_JOIN):
+    conn = conn or get_connection()
+    t0 = time.monotonic()
+    edges = fetch_edges(conn)
+    junctions = fetch_junctions(conn)
+    conn.commit()
+    if edges['segment_id'].size == 0:
+        raise Exception('slope_static is empty, nothing to export')
+    log(f"Fetched {edges['segment_id'].size} segments in {time.monotonic() - t0:.1f} s")
+    graph = build_graph(edges, junctions, snap, join)
+    meta = save_graph(out_dir, graph, snap)
+    log(f"Written graph with {meta['nodes']} nodes, {meta['edges']} edges and {count_components(graph)} connected parts "
+        f"to {out_dir} in {time.monotonic() - t0:.1f} s")
+    return meta
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: export_graph.py <out_dir>')
+        exit(1)
+    export_graph(sys.argv[1])
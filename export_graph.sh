@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+source config.sh
+export PGPASSWORD
+
+#GRAPH_SNAP sets the distance (m) under which segment ends are one node (default 0.01)
+python3 export_graph.py "${1:-slope_graph}"
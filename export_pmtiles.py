@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+#Exports slope_static as a PMTiles (v3) archive of Mapbox Vector Tiles, which viewer.html reads tile by tile.
+#Tiles are cut by PostGIS (ST_AsMVT), one zoom level per query streamed through a server-side cursor.
+#Below PMTILES_MAXZOOM segments of a way with the same slope (rounded to 1%) are merged and simplified,
+#features carry only slope and name.
+#The archive writer is self-contained: tiles are gzipped, deduplicated, and ordered along the Hilbert curve.
+
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from db import get_connection
+
+log = print
+
+PMTILES_MINZOOM = int(os.getenv('PMTILES_MINZOOM', 10))
+PMTILES_MAXZOOM = int(os.getenv('PMTILES_MAXZOOM', 16))
+LAYER = 'slope'
+EXTENT = 4096
+BUFFER = 64
+
+#PMTiles v3 header fields
+_HEADER = struct.Struct('<7sBQQQQQQQQQQQBBBBBBiiiiBii')
+_COMPRESSION_GZIP = 2
+_TILE_TYPE_MVT = 1
+#Header and root directory have to fit in the first 16 KiB
+_ROOT_MAX = 16384 - _HEADER.size
+
+GENERALIZED_SQL = """
+CREATE TEMP TABLE slope_generalized ON COMMIT DROP AS
+SELECT
+    name,
+    round(slope::numeric, 2)::double precision AS slope,
+    ST_LineMerge(ST_Collect(ST_Transform(geom, 3857))) AS geom
+FROM slope_static
+GROUP BY way_id, name, round(slope::numeric, 2);
+CREATE INDEX ON slope_generalized USING gist (geom);
+ANALYZE slope_generalized;
+"""
+
+#one row per non-empty tile of zoom %(z)s in the tile range
+DETAILED_TILES_SQL = """
+SELECT tx.x, ty.y, ST_AsMVT(q, %(layer)s, %(extent)s, 'geom')
+FROM generate_series(%(x0)s, %(x1)s) AS tx(x)
+CROSS JOIN generate_series(%(y0)s, %(y1)s) AS ty(y)
+CROSS JOIN LATERAL (
+    SELECT
+        ST_AsMVTGeom(ST_Transform(s.geom, 3857), ST_TileEnvelope(%(z)s, tx.x, ty.y), %(extent)s, %(buffer)s) AS geom,
+        s.slope, s.name
+    FROM slope_static s
+    WHERE s.geom && ST_Transform(ST_TileEnvelope(%(z)s, tx.x, ty.y, margin => %(margin)s), 2180)
+) q
+WHERE q.geom IS NOT NULL
+GROUP BY tx.x, ty.y
+"""
+
+GENERALIZED_TILES_SQL = """
+SELECT tx.x, ty.y, ST_AsMVT(q, %(layer)s, %(extent)s, 'geom')
+FROM generate_series(%(x0)s, %(x1)s) AS tx(x)
+CROSS JOIN generate_series(%(y0)s, %(y1)s) AS ty(y)
+CROSS JOIN LATERAL (
+    SELECT
+        ST_AsMVTGeom(ST_Simplify(s.geom, %(tolerance)s), ST_TileEnvelope(%(z)s, tx.x, ty.y), %(extent)s, %(buffer)s) AS geom,
+        s.slope, s.name
+    FROM slope_generalized s
+    WHERE s.geom && ST_TileEnvelope(%(z)s, tx.x, ty.y, margin => %(margin)s)
+) q
+WHERE q.geom IS NOT NULL
+GROUP BY tx.x, ty.y
+"""
+
+
+def zxy_to_tileid(z, x, y):
+    """PMTiles tile id: tiles of the lower zooms first, within a zoom position along the Hilbert curve"""
+    acc = ((1 << (2 * z)) - 1) // 3
+    n = 1 << z
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return acc + d
+
+
+def lonlat_to_tile(lon, lat, z):
+    n = 1 << z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _varint(out, value):
+    while value >= 0x80:
+        out.write(bytes([(value & 0x7f) | 0x80]))
+        value >>= 7
+    out.write(bytes([value]))
+
+
+def serialize_directory(entries):
+    """entries: [(tile_id, offset, length, run_length)] sorted by tile_id; gzipped PMTiles directory"""
+    out = io.BytesIO()
+    _varint(out, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        _varint(out, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        _varint(out, run_length)
+    for _, _, length, _ in entries:
+        _varint(out, length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        prev = entries[i - 1] if i else None
+        #0 means "right after the previous entry"
+        if prev is not None and offset == prev[1] + prev[2]:
+            _varint(out, 0)
+        else:
+            _varint(out, offset + 1)
+    return gzip.compress(out.getvalue())
+
+
+def build_directories(entries):
+    """(root, leaves) serialized; leaf directories are used only when the root alone would not fit"""
+    root = serialize_directory(entries)
+    if len(root) <= _ROOT_MAX:
+        return root, b''
+    leaf_size = 4096
+    while True:
+        leaves = io.BytesIO()
+        root_entries = []
+        for i in range(0, len(entries), leaf_size):
+            chunk = entries[i:i + leaf_size]
+            leaf = serialize_directory(chunk)
+            #run_length 0 marks an entry pointing to a leaf directory
+            root_entries.append((chunk[0][0], leaves.tell(), len(leaf), 0))
+            leaves.write(leaf)
+        root = serialize_directory(root_entries)
+        if len(root) <= _ROOT_MAX:
+            return root, leaves.getvalue()
+        leaf_size *= 2
+
+
+class PMTilesWriter:
+    """
+    Collects tiles in any order into a temporary file, finish() writes the archive
+    with tile data ordered by tile id (clustered) and identical tiles stored once.
+    """
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self._data = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(out_path)))
+        self._tiles = []
+        self._by_hash = {}
+
+    def add(self, z, x, y, mvt):
+        compressed = gzip.compress(mvt, compresslevel=6, mtime=0)
+        digest = hashlib.sha1(compressed).digest()
+        if digest not in self._by_hash:
+            self._by_hash[digest] = (self._data.tell(), len(compressed))
+            self._data.write(compressed)
+        self._tiles.append((zxy_to_tileid(z, x, y), digest))
+
+    def finish(self, minzoom, maxzoom, bounds, metadata):
+        """bounds: (min_lon, min_lat, max_lon, max_lat)"""
+        self._tiles.sort()
+        #tile data is rewritten in tile id order, run of the same content is one entry
+        entries = []
+        order = {}
+        data_path = self.out_path + '.data.tmp'
+        with open(data_path, 'wb') as data:
+            for tile_id, digest in self._tiles:
+                if entries and entries[-1][4] == digest and entries[-1][0] + entries[-1][3] == tile_id:
+                    entries[-1][3] += 1
+                    continue
+                if digest not in order:
+                    src_offset, length = self._by_hash[digest]
+                    self._data.seek(src_offset)
+                    order[digest] = (data.tell(), length)
+                    data.write(self._data.read(length))
+                offset, length = order[digest]
+                entries.append([tile_id, offset, length, 1, digest])
+        self._data.close()
+        entries = [(tile_id, offset, length, run_length) for tile_id, offset, length, run_length, _ in entries]
+        root, leaves = build_directories(entries)
+        meta = gzip.compress(json.dumps(metadata).encode())
+        tile_data_length = os.path.getsize(data_path)
+
+        root_offset = _HEADER.size
+        meta_offset = root_offset + len(root)
+        leaves_offset = meta_offset + len(meta)
+        data_offset = leaves_offset + len(leaves)
+        min_lon, min_lat, max_lon, max_lat = bounds
+        e7 = lambda v: int(round(v * 1e7))
+        header = _HEADER.pack(
+            b'PMTiles', 3,
+            root_offset, len(root), meta_offset, len(meta), leaves_offset, len(leaves), data_offset, tile_data_length,
+            len(self._tiles), len(entries), len(order),
+            1, _COMPRESSION_GZIP, _COMPRESSION_GZIP, _TILE_TYPE_MVT, minzoom, maxzoom,
+            e7(min_lon), e7(min_lat), e7(max_lon), e7(max_lat),
+            minzoom, e7((min_lon + max_lon) / 2), e7((min_lat + max_lat) / 2))
+        tmp_path = self.out_path + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            out.write(header)
+            out.write(root)
+            out.write(meta)
+            out.write(leaves)
+            with open(data_path, 'rb') as data:
+                shutil.copyfileobj(data, out, 1 << 20)
+        os.remove(data_path)
+        os.replace(tmp_path, self.out_path)
+        return len(self._tiles)
+
+
+def export_pmtiles(out_path, conn=None, minzoom=PMTILES_MINZOOM, maxzoom=PMTILES_MAXZOOM):
+    conn = conn or get_connection()
+    with conn.cursor() as cur:
+        cur.execute("SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(ST_Transform(geom, 4326)) AS e FROM slope_static) b")
+        bounds = cur.fetchone()
+        if bounds[0] is None:
+            raise Exception('slope_static is empty, nothing to export')
+        cur.execute(GENERALIZED_SQL)
+    min_lon, min_lat, max_lon, max_lat = bounds
+
+    writer = PMTilesWriter(out_path)
+    for z in range(minzoom, maxzoom + 1):
+        x0, y0 = lonlat_to_tile(min_lon, max_lat, z)
+        x1, y1 = lonlat_to_tile(max_lon, min_lat, z)
+        params = dict(z=z, x0=x0, x1=x1, y0=y0, y1=y1, layer=LAYER, extent=EXTENT, buffer=BUFFER,
+                      margin=BUFFER / EXTENT,
+                      #half a screen pixel of a 256 px tile, in EPSG:3857 metres
+                      tolerance=40075016.686 / (256 << z) / 2)
+        n = 0
+        with conn.cursor(name=f'export_pmtiles_{z}') as cur:
+            cur.itersize = 100
+            cur.execute(DETAILED_TILES_SQL if z == maxzoom else GENERALIZED_TILES_SQL, params)
+            for x, y, mvt in cur:
+                writer.add(z, x, y, bytes(mvt))
+                n += 1
+        log(f"zoom {z}: {n} tiles")
+
+    metadata = {
+        'name': 'slope_static',
+        'description': 'Street gradients',
+        'vector_layers': [{'id': LAYER, 'fields': {'slope': 'Number', 'name': 'String'}, 'minzoom': minzoom, 'maxzoom': maxzoom}],
+    }
+    n = writer.finish(minzoom, maxzoom, bounds, metadata)
+    conn.commit()
+    log(f"Written {n} tiles to {out_path}")
+    return n
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: export_pmtiles.py <out.pmtiles>')
+        exit(1)
+    export_pmtiles(sys.argv[1])
@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+source config.sh
+export PGPASSWORD
+
+#PMTILES_MINZOOM / PMTILES_MAXZOOM set the zoom levels written (default 10-16)
+python3 export_pmtiles.py "${1:-slope_static.pmtiles}"
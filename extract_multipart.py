@@ -1,59 +1,168 @@
-
-
 import re
 import sys
 
+BOUNDARY = b"--wcs"
+CHUNK_SIZE = 1 << 20
+#Headers of a part are kept in memory until the blank line, so they have to be bounded
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class _PartSplitter:
+    """
+    Receives the bytes between consecutive boundaries piece by piece and turns them into
+    (part_index, filename, chunk) events. The events mimic the old, whole-file implementation:
+    a part is stripped of surrounding whitespace, empty parts and the closing '--' are skipped,
+    the data starts after the first empty line.
+    """
+    def __init__(self):
+        self.part_index = -1
+        self._begin()
+
+    def _begin(self):
+        self.head = b""
+        self.in_data = False
+        self.data_started = False
+        self.held = b""
+        self.filename = None
+
+    def feed(self, data):
+        if self.in_data:
+            return self._data(data)
+        self.head = (self.head + data).lstrip()
+        positions = [p for p in (self.head.find(b"\n\n"), self.head.find(b"\r\n\r\n")) if p != -1]
+        if not positions:
+            if len(self.head) > MAX_HEADER_SIZE:
+                raise Exception(f'No end of part headers within {MAX_HEADER_SIZE} bytes')
+            return []
+        data_start = min(positions)
+        self.part_index += 1
+        self.in_data = True
+        header = self.head[:data_start].decode("latin1")
+        rest = self.head[data_start:]
+        self.head = b""
+        # Extract filename from Content-Disposition
+        m = re.search(r'filename="?([^"\r\n]+)"?', header, re.IGNORECASE)
+        if m:
+            self.filename = m.group(1)
+        else:
+            self.filename = f"part{self.part_index}.bin"
+        return [(self.part_index, self.filename, b"")] + self._data(rest)
+
+    def _data(self, data):
+        if not self.data_started:
+            data = data.lstrip()
+            if not data:
+                return []
+            self.data_started = True
+        #trailing whitespace is held back until we know it is not the end of the part
+        data = self.held + data
+        stripped = data.rstrip()
+        self.held = data[len(stripped):]
+        return [(self.part_index, self.filename, stripped)] if stripped else []
+
+    def end(self):
+        events = []
+        if not self.in_data:
+            head = self.head.strip()
+            if not head or head == b"--":
+                print('empty part:', self.part_index + 1, ':', head.decode("latin1"))
+            else:
+                #non-empty part without an empty line - there is nothing to save
+                self.part_index += 1
+                m = re.search(r'filename="?([^"\r\n]+)"?', head.decode("latin1"), re.IGNORECASE)
+                events.append((self.part_index, m.group(1) if m else f"part{self.part_index}.bin", None))
+        self._begin()
+        return events
+
+
+def iter_multipart(f, boundary=BOUNDARY, chunk_size=CHUNK_SIZE):
+    """
+    Streams parts of multipart body from binary file object f, reading chunk_size bytes at a time.
+    Yields (part_index, filename, chunk). Every part starts with an empty chunk b"",
+    data follows in chunks no larger than chunk_size. Part without any data yields chunk None.
+    Memory use is bounded by chunk_size (plus headers), not by the size of the response.
+    """
+    splitter = _PartSplitter()
+    buf = b""
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        while True:
+            pos = buf.find(boundary)
+            if pos == -1:
+                break
+            yield from splitter.feed(buf[:pos])
+            yield from splitter.end()
+            buf = buf[pos + len(boundary):]
+        if not chunk:
+            break
+        #keep the tail which may be the beginning of a boundary split between chunks
+        safe = max(len(buf) - len(boundary) + 1, 0)
+        if safe:
+            yield from splitter.feed(buf[:safe])
+            buf = buf[safe:]
+    yield from splitter.feed(buf)
+    yield from splitter.end()
+
+
 #Extracts all parts of multpart response and saves as separate files
-def extract_multipart(mime_file, out_dir='.', expected_parts=None):
+def extract_multipart(mime_file, out_dir='.', expected_parts=None, chunk_size=CHUNK_SIZE):
+    """
+    mime_file: path or binary file object (e.g. http response) with the multipart body
+    Parts are written to disk as they arrive, the whole response is never held in memory.
+    """
+    if hasattr(mime_file, 'read'):
+        print('Extracting parts of multipart from stream')
+        return _extract_parts(mime_file, out_dir, expected_parts, chunk_size)
     print('Extracting parts of multipart from '+mime_file)
-    with open(mime_file, "r", encoding="latin1") as f:  # use latin1 to preserve all bytes
-        content = f.read()
-
-    # Split on boundary --wcs
-    parts = content.split("--wcs")
-    nonempty_parts = list()
-    for i, part in enumerate(parts):
-        part = part.strip()
-        if not part or part == "--":
-            print('empty part:',i,':', part)
-            continue
-        nonempty_parts.append(part)
-
-    num_parts=len(nonempty_parts)
+    with open(mime_file, "rb") as f:
+        return _extract_parts(f, out_dir, expected_parts, chunk_size)
+
+
+def _extract_parts(f, out_dir, expected_parts, chunk_size):
+    out_paths = list()
+    num_parts = 0
+    out = None
+    out_path = None
+    length = 0
+
+    def close_current():
+        if out is not None:
+            out.close()
+            out_paths.append(out_path)
+            print(f"Saved: {out_path}, length={length} bytes")
+
+    try:
+        for i, filename, chunk in iter_multipart(f, chunk_size=chunk_size):
+            if i == num_parts:
+                num_parts += 1
+                if expected_parts is not None:
+                    if i >= len(expected_parts):
+                        raise Exception(f'Expected {len(expected_parts)}, got more parts')
+                    if filename != expected_parts[i]:
+                        raise Exception(f'Expected part {i} to have filename={expected_parts[i]} but got {filename}')
+                close_current()
+                out = None
+                if chunk is None:
+                    print(f"Could not find data for {filename}, skipping")
+                    continue
+                out_path = out_dir+'/'+filename
+                length = 0
+                out = open(out_path, "wb")
+            out.write(chunk)
+            length += len(chunk)
+        close_current()
+        out = None
+    finally:
+        if out is not None:
+            out.close()
+
     if expected_parts is not None and num_parts != len(expected_parts):
         raise Exception(f'Expected {len(expected_parts)}, got {num_parts}')
-    
-    out_paths = list()
-    for i, part in enumerate(nonempty_parts):
-        # Extract filename from Content-Disposition
-        m = re.search(r'filename="?([^"\r\n]+)"?', part, re.IGNORECASE)
-        if m:
-            filename = m.group(1)
-        else:
-            filename = f"part{i}.bin"
-
-        if expected_parts is not None:
-            if filename != expected_parts[i]:
-                raise Exception(f'Expected part {i} to have filename={expected_parts[i]} but got {filename}')
-            
-        # Find start of actual data (after empty line)
-        data_start = part.find("\n\n")
-        if data_start == -1:
-            data_start = part.find("\r\n\r\n")
-        if data_start == -1:
-            print(f"Could not find data for {filename}, skipping")
-            continue
-
-        data = part[data_start:].lstrip()
-        out_path = out_dir+'/'+filename
-        # Save as binary
-        with open(out_path, "wb") as out:
-            out.write(data.encode("latin1"))
-        out_paths.append(out_path)
-        print(f"Saved: {out_path}, length={len(data)} bytes")
-    
     return out_paths
+
+
 if __name__ == '__main__':
     mime_file = sys.argv[1]#"nmpt_even.asc"
     pths=extract_multipart(mime_file)
-    print('files written:', pths)
\ No newline at end of file
+    print('files written:', pths)
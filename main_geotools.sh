@@ -14,7 +14,19 @@ fi
 
 echo "bbox: $bbox"
 
+#PIPELINE=1 processes tiles one by one through all stages at once, see pipeline.py
+if [ "${PIPELINE:-0}" = "1" ]; then
+    python3 pipeline.py $bbox
+    exit 0
+fi
+
+#ways first: TILE_PLAN=ways downloads only tiles near them
+bash ./download_ways.sh $bbox
 MODEL=NMT python3 download_model.py $bbox
 MODEL=NMPT python3 download_model.py $bbox
-bash ./download_ways.sh $bbox
-bash ./compute_slope_static.sh
+#SLOPE_ENGINE=python samples local tiles in python instead of rasters uploaded to PostGIS
+if [ "${SLOPE_ENGINE:-sql}" = "python" ]; then
+    python3 slope_engine.py
+else
+    bash ./compute_slope_static.sh
+fi
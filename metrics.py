@@ -0,0 +1,174 @@
+#Counters and timers of the pipeline (tiles fetched, bytes, retries, conversion/roughness/upload durations,
+#rows, segments), written as JSON lines or as a Prometheus textfile (node_exporter textfile collector).
+#Off unless METRICS is set, recording then costs a dictionary update under a lock.
+#PROFILE turns on cProfile or tracemalloc around the expensive calls (roughness, upload) of production runs.
+
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = print
+
+#'' - off; path ending with .prom - Prometheus textfile written at exit (and by flush()); other path - JSON lines appended as events happen
+METRICS = os.getenv('METRICS', '')
+#Comma separated sections to profile: roughness, upload
+PROFILE = [p for p in os.getenv('PROFILE', '').split(',') if p]
+#'cprofile' dumps .prof files (snakeviz, pstats), 'tracemalloc' logs the top allocations and records peak memory
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'cprofile')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+PROMETHEUS_PREFIX = 'street_gradients_'
+
+
+class Metrics:
+    """
+    Thread safe counters (inc) and timers (observe, timer) with optional labels.
+    Timers keep count, sum and max, like a Prometheus summary without quantiles.
+    """
+    def __init__(self, path=METRICS):
+        self.path = path
+        self.jsonl = bool(path) and not path.endswith('.prom')
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _event(self, kind, name, value, labels):
+        #one write per line: lines of several processes (doubt workers) appended to the same file don't interleave
+        line = json.dumps(dict(ts=time.time(), pid=os.getpid(), type=kind, name=name, value=value, **labels)) + '\n'
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.jsonl:
+            self._event('counter', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """Duration in seconds (or another measured value, e.g. bytes)"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + value, max(longest, value))
+        if self.jsonl:
+            self._event('timer', name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - t0, **labels)
+
+    def prometheus(self):
+        """Current values in Prometheus text exposition format"""
+        def series(name, labels, suffix=''):
+            label_text = ','.join(f'{k}="{str(v)}"' for k, v in labels)
+            return PROMETHEUS_PREFIX + name + suffix + (f'{{{label_text}}}' if label_text else '')
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name}_total counter')
+                typed.add(name)
+            lines.append(f'{series(name, labels, "_total")} {value}')
+        for (name, labels), (count, total, longest) in timers:
+            if name not in typed:
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} summary')
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name}_max gauge')
+                typed.add(name)
+            lines.append(f'{series(name, labels, "_count")} {count}')
+            lines.append(f'{series(name, labels, "_sum")} {total}')
+            lines.append(f'{series(name, labels, "_max")} {longest}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Writes the Prometheus textfile (atomically, the collector may read it any time); JSON lines are already written"""
+        if not self.enabled or self.jsonl:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, self.path)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    """One Metrics per process, created on first use; the Prometheus file is written when the process exits"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+            #worker processes don't write the textfile, the parent records what they did
+            if _metrics.enabled and not _metrics.jsonl and _is_main_process():
+                atexit.register(_metrics.flush)
+    return _metrics
+
+
+def _is_main_process():
+    import multiprocessing
+    return multiprocessing.parent_process() is None
+
+
+_profile_counter = 0
+_profile_lock = threading.Lock()
+
+@contextmanager
+def profiled(section, mode=PROFILE_MODE, sections=PROFILE, out_dir=PROFILE_DIR):
+    """
+    Profiles the block if section is in PROFILE (otherwise does nothing).
+    cprofile: stats are dumped to PROFILE_DIR/<section>-<pid>-<n>.prof
+    tracemalloc: logs the top allocations of the block and records its peak memory as a metric
+    """
+    global _profile_counter
+    if section not in sections:
+        yield
+        return
+    with _profile_lock:
+        _profile_counter += 1
+        n = _profile_counter
+    if mode == 'tracemalloc':
+        import tracemalloc
+        #one block at a time: tracemalloc is global to the process
+        with _profile_lock:
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        top = snapshot.statistics('lineno')[:10]
+        log(f"tracemalloc {section}: peak {peak / 1e6:.1f} MB, top allocations:\n" + '\n'.join(f"  {stat}" for stat in top))
+        get_metrics().observe('profile_peak_bytes', peak, section=section)
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            os.makedirs(out_dir, exist_ok=True)
+            path = os.path.join(out_dir, f'{section}-{os.getpid()}-{n}.prof')
+            profile.dump_stats(path)
+            log(f"cProfile of {section} written to {path}")
@@ -0,0 +1,149 @@
+#Layout of the tiles for windowed reads across the whole area:
+#tiles rewritten as cloud optimized GeoTiffs (internal 256x256 blocks, predictor + deflate, overviews)
+#and a VRT mosaic per model, so QGIS or a sampling engine open one dataset instead of hundreds of files.
+#The VRT is updated incrementally: only added tiles are opened, the rest is read back from the VRT itself.
+
+import fcntl
+import os
+import xml.etree.ElementTree as ET
+
+log = print
+
+#'cog' rewrites every tile as cloud optimized GeoTiff, 'gtiff' leaves them as they are written
+TILE_FORMAT = os.getenv('TILE_FORMAT', 'gtiff')
+BLOCK_SIZE = 256
+
+#VRT band data types of numpy dtypes
+_VRT_TYPES = {
+    'uint8': 'Byte', 'int8': 'Int8', 'int16': 'Int16', 'uint16': 'UInt16',
+    'int32': 'Int32', 'uint32': 'UInt32', 'float32': 'Float32', 'float64': 'Float64',
+}
+
+
+def is_optimized(path):
+    """True if the GeoTiff is internally tiled and has overviews"""
+    import rasterio
+    with rasterio.open(path) as src:
+        return bool(src.profile.get('tiled')) and bool(src.overviews(1))
+
+
+def optimize_geotiff(path, block_size=BLOCK_SIZE):
+    """
+    Rewrites the GeoTiff in place as COG: tiled, deflate with predictor suited to the data type,
+    overviews (averaged) down to a single block. Returns False if the file already is like that.
+    """
+    import rasterio
+    from rasterio.shutil import copy as rio_copy
+    if is_optimized(path):
+        return False
+    with rasterio.open(path) as src:
+        predictor = 'FLOATING_POINT' if src.dtypes[0].startswith('float') else 'STANDARD'
+    tmp_path = path + '.cog.tmp'
+    rio_copy(path, tmp_path, driver='COG', compress='DEFLATE', predictor=predictor,
+             blocksize=block_size, overview_resampling='AVERAGE', num_threads='1')
+    os.replace(tmp_path, path)
+    return True
+
+
+def mosaic_path(out_dir, kind='tif'):
+    """VRT of the tiles in out_dir; kind 'doubt' is the mosaic of the doubt maps"""
+    return os.path.join(out_dir, 'mosaic.vrt' if kind == 'tif' else f'mosaic.{kind}.vrt')
+
+
+def _source_of_tile(path):
+    import rasterio
+    with rasterio.open(path) as src:
+        return dict(
+            path=os.path.abspath(path),
+            left=src.transform.c, top=src.transform.f, xres=src.transform.a, yres=src.transform.e,
+            width=src.width, height=src.height, dtype=src.dtypes[0], nodata=src.nodata,
+            block=src.block_shapes[0], crs=src.crs.to_wkt() if src.crs else None,
+        )
+
+
+def _read_vrt(vrt_path):
+    """(header, sources) of an existing VRT written by write_vrt"""
+    root = ET.parse(vrt_path).getroot()
+    left, xres, _, top, _, yres = [float(v) for v in root.find('GeoTransform').text.split(',')]
+    band = root.find('VRTRasterBand')
+    nodata = band.find('NoDataValue')
+    srs = root.find('SRS')
+    header = dict(xres=xres, yres=yres, dtype=band.get('dataType'),
+                  nodata=float(nodata.text) if nodata is not None else None,
+                  crs=srs.text if srs is not None else None)
+    sources = []
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+    for s in band.findall('ComplexSource'):
+        name = s.find('SourceFilename')
+        path = os.path.join(vrt_dir, name.text) if name.get('relativeToVRT') == '1' else name.text
+        dst = s.find('DstRect')
+        props = s.find('SourceProperties')
+        sources.append(dict(
+            path=os.path.abspath(path),
+            left=left + float(dst.get('xOff')) * xres, top=top + float(dst.get('yOff')) * yres,
+            width=int(dst.get('xSize')), height=int(dst.get('ySize')),
+            block=(int(props.get('BlockYSize')), int(props.get('BlockXSize'))),
+        ))
+    return header, sources
+
+
+def write_vrt(vrt_path, header, sources):
+    left = min(s['left'] for s in sources)
+    top = max(s['top'] for s in sources)
+    right = max(s['left'] + s['width'] * header['xres'] for s in sources)
+    bottom = min(s['top'] + s['height'] * header['yres'] for s in sources)
+    width = int(round((right - left) / header['xres']))
+    height = int(round((bottom - top) / header['yres']))
+
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    if header['crs']:
+        ET.SubElement(root, 'SRS', dataAxisToSRSAxisMapping='1,2').text = header['crs']
+    ET.SubElement(root, 'GeoTransform').text = f"{left!r}, {header['xres']!r}, 0.0, {top!r}, 0.0, {header['yres']!r}"
+    band = ET.SubElement(root, 'VRTRasterBand', dataType=header['dtype'], band='1')
+    if header['nodata'] is not None:
+        ET.SubElement(band, 'NoDataValue').text = repr(header['nodata'])
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+    for s in sorted(sources, key=lambda s: (-s['top'], s['left'])):
+        src = ET.SubElement(band, 'ComplexSource')
+        ET.SubElement(src, 'SourceFilename', relativeToVRT='1').text = os.path.relpath(s['path'], vrt_dir)
+        ET.SubElement(src, 'SourceBand').text = '1'
+        ET.SubElement(src, 'SourceProperties', RasterXSize=str(s['width']), RasterYSize=str(s['height']), DataType=header['dtype'],
+                      BlockXSize=str(s['block'][1]), BlockYSize=str(s['block'][0]))
+        ET.SubElement(src, 'SrcRect', xOff='0', yOff='0', xSize=str(s['width']), ySize=str(s['height']))
+        x_off = int(round((s['left'] - left) / header['xres']))
+        y_off = int(round((s['top'] - top) / header['yres']))
+        ET.SubElement(src, 'DstRect', xOff=str(x_off), yOff=str(y_off), xSize=str(s['width']), ySize=str(s['height']))
+        if header['nodata'] is not None:
+            ET.SubElement(src, 'NODATA').text = repr(header['nodata'])
+    ET.indent(root)
+    tmp_path = vrt_path + '.tmp'
+    ET.ElementTree(root).write(tmp_path)
+    os.replace(tmp_path, vrt_path)
+
+
+def update_vrt(vrt_path, add=(), refresh=False):
+    """
+    Adds tiles to the VRT mosaic (created if missing) and drops sources whose files are gone (e.g. evicted from the cache).
+    Tiles already in the mosaic are not opened again, unless refresh. Safe to call from several workers.
+    Returns number of sources in the mosaic.
+    """
+    os.makedirs(os.path.dirname(vrt_path) or '.', exist_ok=True)
+    with open(vrt_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        header, sources = _read_vrt(vrt_path) if os.path.exists(vrt_path) else (None, [])
+        by_path = {s['path']: s for s in sources if os.path.exists(s['path'])}
+        for path in add:
+            if not refresh and os.path.abspath(path) in by_path:
+                continue
+            s = _source_of_tile(path)
+            if header is None:
+                header = dict(xres=s['xres'], yres=s['yres'], dtype=_VRT_TYPES[s['dtype']], nodata=s['nodata'], crs=s['crs'])
+            if (s['xres'], s['yres']) != (header['xres'], header['yres']) or _VRT_TYPES[s['dtype']] != header['dtype']:
+                raise Exception(f"Tile {path} has different resolution or data type than mosaic {vrt_path}")
+            by_path[s['path']] = s
+        if not by_path:
+            if os.path.exists(vrt_path):
+                os.remove(vrt_path)
+            return 0
+        write_vrt(vrt_path, header, list(by_path.values()))
+        return len(by_path)
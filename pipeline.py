@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+#Processing of a bbox as a pipeline of per-tile stages instead of model after model:
+#  download -> convert/validate -> upload            (NMT and NMPT tiles)
+#                               -> roughness -> upload (NMPT tiles, doubt maps)
+#Stages are pools of threads connected by bounded queues, so downloading the next tile overlaps
+#converting, analysing and uploading the previous ones. Ways are downloaded alongside,
+#slopes are computed once all rasters are in the database.
+#Finished stages are recorded in a state file (PIPELINE_STATE), a crashed run started again skips them.
+
+import json
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from utils import run_command
+from downloader import wcs_url, download_with_retry, HostRateLimiter, Throughput
+from tiles import TILE_SIZE, SCALE_FACTOR, MODELS, TILE_PLAN, tif_path_of, doubt_tif_path_of, neighbour_paths, plan_tiles
+from convert import response_to_geotiff, validate_tile
+from db import get_connection
+from tile_cache import get_tile_cache
+from raster_upload import prepare_incremental, tiles_to_load, load_tile_batch, finalize_raster_table, TILES_PER_TRANSACTION
+from download_model import timed_doubt_map_job
+from mosaic import TILE_FORMAT, optimize_geotiff, mosaic_path, update_vrt
+from metrics import get_metrics
+
+log = print
+silent = lambda *a, **k :None
+
+PIPELINE_STATE = os.getenv('PIPELINE_STATE', 'pipeline_state.json')
+#Models to process, in the order their tiles are queued
+PIPELINE_MODELS = os.getenv('PIPELINE_MODELS', 'NMT,NMPT').split(',')
+#Capacity of the queues between stages; a full queue stops the stage before it, so tiles don't pile up on disk
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 4))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 2))
+MIN_REQUEST_INTERVAL = float(os.getenv('MIN_REQUEST_INTERVAL', 0))
+CONVERT_WORKERS = int(os.getenv('CONVERT_WORKERS', 2))
+DOUBT_WORKERS = int(os.getenv('DOUBT_WORKERS', os.cpu_count() or 1))
+HALO_FROM_NEIGHBOURS = os.getenv('HALO_FROM_NEIGHBOURS', '1') == '1'
+CONVERTER = os.getenv('CONVERTER', 'rasterio')
+SLOPE_ENGINE = os.getenv('SLOPE_ENGINE', 'sql')
+
+#End of the items in a queue
+_DONE = object()
+
+
+class PipelineState:
+    """
+    {unit: {stage: value}} of finished stages, written to a JSON file after every change.
+    The value tells what the stage produced (path, or (size, mtime) of the uploaded file),
+    so the caller can check it still holds before skipping the stage.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)
+            log(f"Resuming from {path}: {len(self.done)} units have finished stages")
+
+    def get(self, unit, stage):
+        with self._lock:
+            return self.done.get(unit, {}).get(stage)
+
+    def mark(self, unit, stage, value=True):
+        with self._lock:
+            self.done.setdefault(unit, {})[stage] = value
+            #written under temporary name and renamed, a crash never leaves half of the file
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.done, f)
+            os.replace(tmp_path, self.path)
+
+
+class StageTimings:
+    """Thread safe count, total and max duration of every stage"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+        self.stages = {}
+
+    def add(self, stage, elapsed):
+        with self._lock:
+            count, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + elapsed, max(longest, elapsed))
+        get_metrics().observe('stage_seconds', elapsed, stage=stage)
+
+    def timed(self, stage, func, *args, **kwargs):
+        t0 = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(stage, time.monotonic() - t0)
+
+    def report(self):
+        lines = [f"Pipeline finished in {time.monotonic() - self.start:.1f} s"]
+        lines.append(f"  {'stage':<14}{'count':>7}{'total s':>10}{'mean s':>9}{'max s':>9}")
+        for stage, (count, total, longest) in self.stages.items():
+            lines.append(f"  {stage:<14}{count:>7}{total:>10.1f}{total / count:>9.2f}{longest:>9.2f}")
+        return '\n'.join(lines)
+
+
+def unit_key(model, xmin, ymin):
+    return f"{model}:{xmin}:{ymin}"
+
+
+def file_version(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def start_workers(name, n, in_q, work, on_finish):
+    """
+    Runs work(item) for items of in_q in n threads until _DONE.
+    on_finish() is called once, by the last worker to stop.
+    """
+    remaining = [n]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                in_q.put(_DONE)#let the other workers of the stage see it too
+                break
+            try:
+                work(item)
+            except Exception as e:
+                #a dead worker would stall the whole pipeline, the item is reported and dropped
+                log(f"  ERROR {name} of {item} failed: {e}")
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            on_finish()
+
+    threads = [threading.Thread(target=worker, name=f"{name}-{i}", daemon=True) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+class Pipeline:
+    def __init__(self, bbox, state_path=PIPELINE_STATE):
+        self.bbox = bbox
+        self.state = PipelineState(state_path)
+        self.timings = StageTimings()
+        self.throughput = Throughput()
+        self.rate_limiter = HostRateLimiter(MIN_REQUEST_INTERVAL)
+        self.cache = get_tile_cache()
+        self.failed = []
+        self.uploaded = 0
+        self._lock = threading.Lock()
+
+        self.convert_q = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.doubt_q = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.upload_q = queue.Queue(PIPELINE_QUEUE_SIZE)
+
+    def fail(self, key, stage, error):
+        log(f"  ERROR {stage} of {key} failed: {error}")
+        with self._lock:
+            self.failed.append((key, stage, str(error)))
+
+    ## Stage 1: download
+    def fetch(self, unit):
+        model, xmin, xmax, ymin, ymax = unit
+        cfg = MODELS[model]
+        key = unit_key(model, xmin, ymin)
+        tif_path = tif_path_of(cfg['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        response_body_file = f"{cfg['out_dir']}/buffer_{xmin}_{ymin}.txt"
+        #cache.get() drops a tile which doesn't match its manifest entry, it is downloaded again
+        if self.cache.get(tif_path) or os.path.exists(tif_path):
+            self.convert_q.put((unit, None))
+            return
+        #responses are written atomically, one recorded as downloaded is complete
+        if self.state.get(key, 'download') and os.path.exists(response_body_file):
+            self.convert_q.put((unit, response_body_file))
+            return
+        url = wcs_url(cfg['wcs_base'], cfg['coverage_id'], cfg['response_format'], xmin, xmax, ymin, ymax, SCALE_FACTOR)
+        try:
+            self.timings.timed('download', download_with_retry, url, response_body_file,
+                               rate_limiter=self.rate_limiter, throughput=self.throughput, log=silent)
+        except Exception as e:
+            self.fail(key, 'download', e)
+            self.convert_q.put((unit, e))
+            return
+        self.state.mark(key, 'download', response_body_file)
+        log(f"Downloaded {key}; {self.throughput.report()}")
+        self.convert_q.put((unit, response_body_file))
+
+    ## Stage 2: convert and validate
+    def convert(self, item):
+        unit, response_body_file = item
+        model, xmin, xmax, ymin, ymax = unit
+        cfg = MODELS[model]
+        key = unit_key(model, xmin, ymin)
+        tif_path = tif_path_of(cfg['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        ok = not isinstance(response_body_file, Exception)
+        if ok:
+            def convert_and_validate():
+                #tiles in the cache are known to be valid, only new ones are converted and checked
+                with self.cache.lock(tif_path):
+                    if self.cache.get(tif_path):
+                        return False
+                    if response_body_file is not None:
+                        response_to_geotiff(response_body_file, tif_path, cfg['response_format'], xmin, xmax, ymin, ymax, CONVERTER)
+                    #tiles found on disk are validated too, they may come from an interrupted older run
+                    validate_tile(tif_path, xmin, xmax, ymin, ymax, CONVERTER)
+                    if TILE_FORMAT == 'cog':
+                        optimize_geotiff(tif_path)
+                    self.cache.put(tif_path, model, cfg['coverage_id'], (xmin, ymin, xmax, ymax), SCALE_FACTOR)
+                    return True
+            try:
+                if self.timings.timed('convert', convert_and_validate):
+                    self.state.mark(key, 'convert', tif_path)
+            except Exception as e:
+                self.fail(key, 'convert', e)
+                ok = False
+        if ok:
+            update_vrt(mosaic_path(cfg['out_dir']), [tif_path])
+            self.upload_q.put((key, 'upload', cfg['raster_table'], tif_path))
+        if 'doubt_table' in cfg:
+            #the roughness stage waits for the neighbours too, failed ones included
+            self.doubt_q.put((unit, ok))
+
+    ## Stage 3: roughness of NMPT, in processes
+    def schedule_doubt(self, planned):
+        """
+        Doubt map of a tile is computed with a halo from the adjacent tiles, so it is started
+        once the tile and all its planned neighbours left the convert stage.
+        """
+        settled = {}
+        waiting = set()
+        running = {}
+        ctx = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=max(DOUBT_WORKERS, 1), mp_context=ctx) as pool:
+            finished = False
+            while not finished or running:
+                if not finished:
+                    try:
+                        item = self.doubt_q.get(timeout=0.2)
+                    except queue.Empty:
+                        item = None
+                    if item is _DONE:
+                        finished = True
+                    elif item is not None:
+                        unit, ok = item
+                        settled[(unit[0], unit[1], unit[3])] = ok
+                        if ok:
+                            waiting.add(unit)
+                for unit in list(waiting):
+                    model, xmin, _, ymin, _ = unit
+                    around = [(model, xmin + dx*TILE_SIZE, ymin + dy*TILE_SIZE) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+                    if HALO_FROM_NEIGHBOURS and not finished and any(t in planned and t not in settled for t in around):
+                        continue
+                    waiting.discard(unit)
+                    self.submit_doubt(pool, unit, running)
+                if finished and running:
+                    #nothing more comes from the queue, sleep until a job ends
+                    wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                for future in [f for f in running if f.done()]:
+                    unit = running.pop(future)
+                    self.doubt_done(unit, future)
+
+    def submit_doubt(self, pool, unit, running):
+        model, xmin, _, ymin, _ = unit
+        cfg = MODELS[model]
+        key = unit_key(model, xmin, ymin)
+        tif_path = tif_path_of(cfg['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        doubt_tif_path = doubt_tif_path_of(cfg['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin)
+        try:
+            neighbours = neighbour_paths(cfg['out_dir'], xmin, ymin) if HALO_FROM_NEIGHBOURS else {}
+            #Skip tile if doubt tile (derivate) is younger than the original tif (and its neighbours)
+            newest_input = max(os.path.getmtime(p) for p in [tif_path, *neighbours.values()])
+            if os.path.exists(doubt_tif_path) and os.path.getmtime(doubt_tif_path) > newest_input:
+                self.upload_q.put((key, 'upload_doubt', cfg['doubt_table'], doubt_tif_path))
+                return
+            running[pool.submit(timed_doubt_map_job, tif_path, doubt_tif_path, neighbours)] = unit
+        except Exception as e:
+            #e.g. the tile removed meanwhile or a broken pool, the other tiles go on
+            self.fail(key, 'doubt', e)
+
+    def doubt_done(self, unit, future):
+        model, xmin, _, ymin, _ = unit
+        key = unit_key(model, xmin, ymin)
+        try:
+            doubt_tif_path, elapsed = future.result()
+        except Exception as e:
+            self.fail(key, 'doubt', e)
+            return
+        self.timings.add('doubt', elapsed)
+        get_metrics().observe('roughness_seconds', elapsed)
+        self.cache.put(doubt_tif_path, model, derived_from=tif_path_of(MODELS[model]['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin))
+        self.state.mark(key, 'doubt', doubt_tif_path)
+        update_vrt(mosaic_path(MODELS[model]['out_dir'], 'doubt'), [doubt_tif_path])
+        log(f"Generated {doubt_tif_path}")
+        self.upload_q.put((key, 'upload_doubt', MODELS[model]['doubt_table'], doubt_tif_path))
+
+    ## Stage 4: upload, batched per table over one connection
+    def upload(self):
+        conn = get_connection()
+        prepared = set()
+        loaded_tables = set()
+        pending = {}
+
+        def flush(table):
+            items = pending.pop(table, [])
+            if not items:
+                return
+            if table not in prepared:
+                prepare_incremental(conn, table)
+                prepared.add(table)
+            by_path = {path: (key, stage) for key, stage, path in items}
+            batch = tiles_to_load(conn, table, list(by_path))
+            if batch:
+                t0 = time.monotonic()
+                rows = load_tile_batch(conn, table, batch)
+                self.timings.add('upload', time.monotonic() - t0)
+                loaded_tables.add(table)
+                with self._lock:
+                    self.uploaded += len(batch)
+                log(f"Uploaded {len(batch)} tiles ({rows} rows) to {table}")
+            for path, (key, stage) in by_path.items():
+                self.state.mark(key, stage, file_version(path))
+
+        while True:
+            try:
+                item = self.upload_q.get(timeout=1.0)
+            except queue.Empty:
+                #nothing new is coming for now, don't keep the tiles waiting for a full batch
+                for table in list(pending):
+                    flush(table)
+                continue
+            if item is _DONE:
+                for table in list(pending):
+                    flush(table)
+                break
+            key, stage, table, path = item
+            if self.state.get(key, stage) == file_version(path):
+                continue
+            pending.setdefault(table, []).append((key, stage, path))
+            if len(pending[table]) >= TILES_PER_TRANSACTION:
+                flush(table)
+        for table in loaded_tables:
+            self.timings.timed('finalize', finalize_raster_table, conn, table)
+
+    ## Ways and slopes
+    def download_ways(self):
+        key = 'ways:' + ' '.join(str(v) for v in self.bbox)
+        #a new extract or diff (see download_ways.sh) has to be imported even if the bbox was done before
+        source = [os.getenv('WAYS_KINDS', '')] + [
+            [path, *file_version(path)] for path in (os.getenv('OSM_PBF'), os.getenv('OSM_CHANGE')) if path
+        ]
+        if self.state.get(key, 'download') == source:
+            log("Ways for this bbox already downloaded, skipping")
+            return False
+        try:
+            self.timings.timed('ways', run_command, 'bash ./download_ways.sh ' + ' '.join(str(v) for v in self.bbox))
+        except Exception as e:
+            self.fail(key, 'ways', e)
+            return False
+        self.state.mark(key, 'download', source)
+        return True
+
+    def compute_slopes(self, ways_changed):
+        key = 'slopes:' + ' '.join(str(v) for v in self.bbox)
+        if self.state.get(key, 'compute') and not ways_changed and not self.uploaded:
+            log("Nothing changed since slopes were computed, skipping")
+            return
+        if SLOPE_ENGINE == 'python':
+            #in this process, so its metrics end up with the rest
+            from slope_engine import ensure_schema, compute_slope_static_python
+            conn = get_connection()
+            ensure_schema(conn)
+            self.timings.timed('slopes', compute_slope_static_python, conn)
+        else:
+            output = self.timings.timed('slopes', run_command, 'bash ./compute_slope_static.sh')
+            for n in re.findall(r'Computed slopes for (\d+) segments', output or ''):
+                get_metrics().inc('segments_computed', int(n), engine='sql')
+        self.state.mark(key, 'compute')
+
+    def run(self):
+        ways_changed = []
+        if TILE_PLAN == 'ways':
+            #tiles are planned around the streets, so they have to be imported first
+            ways_changed.append(self.download_ways())
+            if self.failed:
+                raise Exception("Importing ways failed, tiles near them can't be planned:", self.failed)
+        tiles = plan_tiles(*self.bbox, log=log)
+        units = []
+        for model in PIPELINE_MODELS:
+            os.makedirs(MODELS[model]['out_dir'], exist_ok=True)
+            for xmin, xmax, ymin, ymax in tiles:
+                units.append((model, xmin, xmax, ymin, ymax))
+        planned = {(model, xmin, ymin) for model, xmin, _, ymin, _ in units}
+        log(f"== PIPELINE: {len(units)} tiles of {','.join(PIPELINE_MODELS)} ==")
+        log(f"DOWNLOAD_WORKERS:{DOWNLOAD_WORKERS} CONVERT_WORKERS:{CONVERT_WORKERS} DOUBT_WORKERS:{DOUBT_WORKERS} "
+            f"PIPELINE_QUEUE_SIZE:{PIPELINE_QUEUE_SIZE} PIPELINE_STATE:{self.state.path}")
+
+        ways = threading.Thread(target=lambda: ways_changed.append(self.download_ways()), name='ways', daemon=True)
+        if TILE_PLAN != 'ways':
+            ways.start()
+
+        #the plan is known upfront, only the queues after the downloads are bounded
+        fetch_q = queue.Queue()
+        for unit in units:
+            fetch_q.put(unit)
+        fetch_q.put(_DONE)
+        start_workers('download', DOWNLOAD_WORKERS, fetch_q, self.fetch, lambda: self.convert_q.put(_DONE))
+        start_workers('convert', CONVERT_WORKERS, self.convert_q, self.convert, lambda: self.doubt_q.put(_DONE))
+
+        def doubt_stage():
+            try:
+                self.schedule_doubt(planned)
+            finally:
+                self.upload_q.put(_DONE)
+        doubt = threading.Thread(target=doubt_stage, name='doubt', daemon=True)
+        doubt.start()
+        self.upload()
+        doubt.join()
+        if TILE_PLAN != 'ways':
+            ways.join()
+
+        log(f"Download throughput: {self.throughput.report()}")
+        for model in PIPELINE_MODELS:
+            self.cache.remove_malformed(MODELS[model]['out_dir'])
+        #tiles of this bbox stay, slope_engine.py may still read them
+        if self.cache.evict(keep=[tif_path_of(m['out_dir'], TILE_SIZE, SCALE_FACTOR, xmin, ymin) for m in MODELS.values() for _, xmin, _, ymin, _ in units]):
+            #drop evicted tiles from the mosaics
+            for m in MODELS.values():
+                for kind in ('tif', 'doubt'):
+                    if os.path.exists(mosaic_path(m['out_dir'], kind)):
+                        update_vrt(mosaic_path(m['out_dir'], kind))
+        if self.failed:
+            log(self.timings.report())
+            raise Exception(f"{len(self.failed)} stages failed, run again to retry them:", self.failed)
+        self.compute_slopes(any(ways_changed))
+        log(self.timings.report())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5:
+        bbox = [float(x) for x in sys.argv[1:5]]
+    elif all(os.getenv(v) for v in ('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX')):
+        bbox = [float(os.getenv(v)) for v in ('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX')]
+    else:
+        print('usage: pipeline.py <lat_min> <lat_max> <lon_min> <lon_max>')
+        exit(1)
+    Pipeline(bbox).run()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+#Local HTTP service answering slope queries from memory, without a database round-trip per request.
+#slope_static is read once at startup into numpy arrays with a uniform grid index (cells of QUERY_CELL m),
+#every request only looks at the segments of the cells it touches. Responses are cached (LRU) by normalized query.
+#
+#  GET /near?lon=19.94&lat=50.06&radius=50          - segments within radius (m) of the point, nearest first
+#  GET /along?line=19.94,50.06;19.95,50.061&buffer=5 - segments lying along the polyline, in its order,
+#                                                     grade signed in the direction of the line, with totals
+#  GET /bbox?bbox=19.93,50.05,19.95,50.07           - segments intersecting the bbox (min_lon,min_lat,max_lon,max_lat)
+#  GET /health                                       - number of segments and bounds
+#
+#Distances are computed in a local equirectangular projection around the centre of the data (error well
+#below 0.1% over a city), so queries in WGS84 need no coordinate transformation.
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+import numpy as np
+
+from db import get_connection
+
+log = print
+
+QUERY_HOST = os.getenv('QUERY_HOST', '127.0.0.1')
+QUERY_PORT = int(os.getenv('QUERY_PORT', 8090))
+#Grid index cell size in meters; segments are at most 50 m long
+QUERY_CELL = float(os.getenv('QUERY_CELL', 100))
+#Number of responses cached, 0 - no cache
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 10000))
+#Upper bounds of a single request
+MAX_RESULTS = 1000
+MAX_RADIUS = 1000
+MAX_LINE_POINTS = 1000
+MAX_LINE_LENGTH = 50_000
+MAX_BUFFER = 100
+
+EARTH_RADIUS = 6371008.8
+
+SEGMENTS_SQL = """
+SELECT
+    s.segment_id, s.way_id, s.name, s.slope, s.delta_h, ST_Length(s.geom),
+    ST_X(ST_StartPoint(s.g)), ST_Y(ST_StartPoint(s.g)), ST_X(ST_EndPoint(s.g)), ST_Y(ST_EndPoint(s.g))
+FROM (SELECT *, ST_Transform(geom, 4326) AS g FROM slope_static) s
+"""
+
+
+class QueryError(Exception):
+    """Invalid request, answered with 400"""
+
+
+def load_segments(conn, itersize=100_000):
+    """slope_static as numpy arrays (coordinates in EPSG:4326)"""
+    ids, names, values = [], [], []
+    with conn.cursor(name='query_service_segments') as cur:
+        cur.itersize = itersize
+        cur.execute(SEGMENTS_SQL)
+        for row in cur:
+            ids.append(row[0:2])
+            names.append(row[2])
+            values.append(row[3:10])
+    conn.commit()
+    ids = np.array(ids, dtype=np.int64).reshape(-1, 2)
+    values = np.array(values, dtype=np.float64).reshape(-1, 7)
+    return {
+        'segment_id': ids[:, 0], 'way_id': ids[:, 1], 'name': names,
+        'slope': values[:, 0], 'delta_h': values[:, 1], 'length': values[:, 2],
+        'lon_a': values[:, 3], 'lat_a': values[:, 4], 'lon_b': values[:, 5], 'lat_b': values[:, 6],
+    }
+
+
+def point_segment_distance(px, py, xa, ya, xb, yb):
+    """(distance, position 0..1 of the closest point) from point(s) p to segments a-b, vectorized"""
+    dx = xb - xa
+    dy = yb - ya
+    d2 = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(d2 > 0, ((px - xa) * dx + (py - ya) * dy) / d2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(xa + t * dx - px, ya + t * dy - py), t
+
+
+class SegmentIndex:
+    """Segments in a local metric projection with a uniform grid: cell -> slice of segment numbers"""
+    def __init__(self, seg, cell=QUERY_CELL):
+        self.seg = seg
+        self.cell = cell
+        self.n = len(seg['segment_id'])
+        lon = np.concatenate([seg['lon_a'], seg['lon_b']])
+        lat = np.concatenate([seg['lat_a'], seg['lat_b']])
+        self.bounds = [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())] if self.n else [0, 0, 0, 0]
+        self.lon0 = (self.bounds[0] + self.bounds[2]) / 2
+        self.lat0 = (self.bounds[1] + self.bounds[3]) / 2
+        self.xa, self.ya = self.project(seg['lon_a'], seg['lat_a'])
+        self.xb, self.yb = self.project(seg['lon_b'], seg['lat_b'])
+
+        #every segment is put into all cells its bbox touches
+        cx0 = np.floor(np.minimum(self.xa, self.xb) / cell).astype(np.int64)
+        cy0 = np.floor(np.minimum(self.ya, self.yb) / cell).astype(np.int64)
+        nx = np.floor(np.maximum(self.xa, self.xb) / cell).astype(np.int64) - cx0 + 1
+        ny = np.floor(np.maximum(self.ya, self.yb) / cell).astype(np.int64) - cy0 + 1
+        counts = nx * ny
+        owner = np.repeat(np.arange(self.n), counts)
+        k = np.arange(owner.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = cx0[owner] + k % nx[owner]
+        cy = cy0[owner] + k // nx[owner]
+        order = np.lexsort((cy, cx))
+        self.members = owner[order]
+        cells = np.stack([cx[order], cy[order]], axis=1)
+        starts = np.flatnonzero(np.concatenate([[True], np.any(cells[1:] != cells[:-1], axis=1)])) if owner.size else np.array([], dtype=np.int64)
+        ends = np.concatenate([starts[1:], [owner.size]])
+        self.cells = {(int(x), int(y)): (int(s), int(e)) for (x, y), s, e in zip(cells[starts], starts, ends)}
+
+    def project(self, lon, lat):
+        x = (np.asarray(lon, dtype=np.float64) - self.lon0) * math.radians(1) * EARTH_RADIUS * math.cos(math.radians(self.lat0))
+        y = (np.asarray(lat, dtype=np.float64) - self.lat0) * math.radians(1) * EARTH_RADIUS
+        return x, y
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        """Numbers of segments in the cells overlapping the (projected) rectangle"""
+        c = self.cell
+        x0, x1 = math.floor(xmin / c), math.floor(xmax / c)
+        y0, y1 = math.floor(ymin / c), math.floor(ymax / c)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            return np.arange(self.n)
+        ranges = (self.cells.get((x, y)) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+        parts = [self.members[r[0]:r[1]] for r in ranges if r]
+        if not parts:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(parts))
+
+    def feature(self, i, **extra):
+        s = self.seg
+        f = {
+            'segment_id': int(s['segment_id'][i]), 'way_id': int(s['way_id'][i]), 'name': s['name'][i],
+            'slope': round(float(s['slope'][i]), 4), 'delta_h': round(float(s['delta_h'][i]), 2),
+            'length': round(float(s['length'][i]), 1),
+            'coords': [[round(float(s['lon_a'][i]), 7), round(float(s['lat_a'][i]), 7)],
+                       [round(float(s['lon_b'][i]), 7), round(float(s['lat_b'][i]), 7)]],
+        }
+        f.update(extra)
+        return f
+
+    def near(self, lon, lat, radius, limit=MAX_RESULTS):
+        (px,), (py,) = self.project([lon], [lat])
+        idx = self.candidates(px - radius, py - radius, px + radius, py + radius)
+        dist, _ = point_segment_distance(px, py, self.xa[idx], self.ya[idx], self.xb[idx], self.yb[idx])
+        hit = dist <= radius
+        idx, dist = idx[hit], dist[hit]
+        order = np.argsort(dist, kind='stable')[:limit]
+        return {'segments': [self.feature(i, distance=round(float(d), 1)) for i, d in zip(idx[order], dist[order])]}
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat, limit=MAX_RESULTS):
+        (x0, x1), (y0, y1) = self.project([min_lon, max_lon], [min_lat, max_lat])
+        idx = self.candidates(x0, y0, x1, y1)
+        #bbox of the segment overlaps the query (exact enough for 50 m segments)
+        hit = ((np.maximum(self.xa[idx], self.xb[idx]) >= x0) & (np.minimum(self.xa[idx], self.xb[idx]) <= x1)
+               & (np.maximum(self.ya[idx], self.yb[idx]) >= y0) & (np.minimum(self.ya[idx], self.yb[idx]) <= y1))
+        idx = idx[hit]
+        return {'truncated': bool(idx.size > limit), 'segments': [self.feature(i) for i in idx[:limit]]}
+
+    def along(self, points, buffer):
+        """Segments with both ends within buffer of the polyline, ordered by position along it"""
+        lx, ly = self.project([p[0] for p in points], [p[1] for p in points])
+        edge_len = np.hypot(np.diff(lx), np.diff(ly))
+        if edge_len.sum() > MAX_LINE_LENGTH:
+            raise QueryError(f"line is longer than {MAX_LINE_LENGTH} m")
+        edge_start = np.concatenate([[0], np.cumsum(edge_len)])[:-1]
+
+        #edges are cut into pieces of at most a cell, every piece looks only at the segments of the cells around it
+        pieces = np.maximum(np.ceil(edge_len / self.cell), 1).astype(np.int64)
+        e = np.repeat(np.arange(edge_len.size), pieces)
+        k = np.arange(e.size) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0, t1 = k / pieces[e], (k + 1) / pieces[e]
+        x0, x1 = lx[e] + (lx[e + 1] - lx[e]) * t0, lx[e] + (lx[e + 1] - lx[e]) * t1
+        y0, y1 = ly[e] + (ly[e + 1] - ly[e]) * t0, ly[e] + (ly[e + 1] - ly[e]) * t1
+        piece_start = edge_start[e] + edge_len[e] * t0
+        piece_len = edge_len[e] / pieces[e]
+
+        found = []
+        for p in range(e.size):
+            idx = self.candidates(min(x0[p], x1[p]) - buffer, min(y0[p], y1[p]) - buffer,
+                                  max(x0[p], x1[p]) + buffer, max(y0[p], y1[p]) + buffer)
+            if idx.size == 0:
+                continue
+            da, ta = point_segment_distance(self.xa[idx], self.ya[idx], x0[p], y0[p], x1[p], y1[p])
+            db, tb = point_segment_distance(self.xb[idx], self.yb[idx], x0[p], y0[p], x1[p], y1[p])
+            found.append((idx, da, piece_start[p] + ta * piece_len[p], db, piece_start[p] + tb * piece_len[p]))
+        if not found:
+            found = [(np.array([], dtype=np.int64),) + (np.array([]),) * 4]
+        hits, dist_a, pos_a, dist_b, pos_b = (np.concatenate(c) for c in zip(*found))
+
+        def closest(dist, pos):
+            #per segment the piece closest to its end: distance to the line and position (m from the start) on it
+            order = np.lexsort((dist, hits))
+            segments, first = np.unique(hits[order], return_index=True)
+            return segments, dist[order][first], pos[order][first]
+
+        #a and b are looked up in the same pieces, so both give the same sorted segments
+        idx, dist_a, pos_a = closest(dist_a, pos_a)
+        _, dist_b, pos_b = closest(dist_b, pos_b)
+        #the segment has to go along the line, not cross it
+        on = (dist_a <= buffer) & (dist_b <= buffer) & (np.abs(pos_b - pos_a) > 0)
+        idx, pos_a, pos_b = idx[on], pos_a[on], pos_b[on]
+        order = np.argsort(np.minimum(pos_a, pos_b), kind='stable')[:MAX_RESULTS]
+        idx, pos_a, pos_b = idx[order], pos_a[order], pos_b[order]
+        #delta_h is h_b - h_a, reversed when the segment is travelled from b to a
+        direction = np.where(pos_b >= pos_a, 1.0, -1.0)
+        dh = self.seg['delta_h'][idx] * direction
+        length = self.seg['length'][idx]
+        grade = np.copysign(self.seg['slope'][idx], dh)
+        total = float(length.sum())
+        return {
+            'length': round(total, 1),
+            'mean_grade': round(float((np.abs(grade) * length).sum() / total), 4) if total else None,
+            'max_grade': round(float(np.abs(grade).max()), 4) if idx.size else None,
+            'ascent': round(float(np.maximum(dh, 0).sum()), 2),
+            'descent': round(float(np.maximum(-dh, 0).sum()), 2),
+            'segments': [self.feature(i, grade=round(float(g), 4), position=round(float(min(a, b)), 1))
+                         for i, g, a, b in zip(idx, grade, pos_a, pos_b)],
+        }
+
+
+def _float(params, name, default=None):
+    value = params.get(name, default)
+    if value is None:
+        raise QueryError(f"Missing parameter {name}")
+    try:
+        number = float(value)
+    except ValueError:
+        raise QueryError(f"Parameter {name} is not a number: {value}")
+    #float() accepts nan and inf
+    if not math.isfinite(number):
+        raise QueryError(f"Parameter {name} is not a finite number: {value}")
+    return number
+
+
+def _coords(text, name):
+    try:
+        numbers = [float(v) for v in text.split(',')]
+    except ValueError:
+        raise QueryError(f"Parameter {name} is not a list of numbers: {text}")
+    if not all(math.isfinite(v) for v in numbers):
+        raise QueryError(f"Parameter {name} has to contain finite numbers: {text}")
+    return numbers
+
+
+def _lonlat(lon, lat, name):
+    #finite but far outside WGS84 would still overflow the grid cell numbers
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise QueryError(f"Parameter {name} is outside of lon -180..180, lat -90..90")
+
+
+def answer(index, path, params):
+    """Response object of a request; params: {name: value}"""
+    if path == '/near':
+        radius = _float(params, 'radius', 50)
+        if not 0 < radius <= MAX_RADIUS:
+            raise QueryError(f"radius has to be in (0, {MAX_RADIUS}]")
+        lon, lat = _float(params, 'lon'), _float(params, 'lat')
+        _lonlat(lon, lat, 'lon/lat')
+        return index.near(lon, lat, radius)
+    if path == '/bbox':
+        box = _coords(params.get('bbox', ''), 'bbox')
+        if len(box) != 4:
+            raise QueryError("bbox has to be min_lon,min_lat,max_lon,max_lat")
+        _lonlat(box[0], box[1], 'bbox')
+        _lonlat(box[2], box[3], 'bbox')
+        return index.bbox(*box)
+    if path == '/along':
+        points = [_coords(p, 'line') for p in params.get('line', '').split(';') if p]
+        if not 2 <= len(points) <= MAX_LINE_POINTS or any(len(p) != 2 for p in points):
+            raise QueryError(f"line has to be 2 to {MAX_LINE_POINTS} lon,lat pairs separated by ;")
+        for lon, lat in points:
+            _lonlat(lon, lat, 'line')
+        buffer = _float(params, 'buffer', 5)
+        if not 0 < buffer <= MAX_BUFFER:
+            raise QueryError(f"buffer has to be in (0, {MAX_BUFFER}]")
+        return index.along(points, buffer)
+    if path == '/health':
+        return {'segments': index.n, 'bounds': index.bounds}
+    raise LookupError(path)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    #keep-alive, clients reuse connections; without TCP_NODELAY headers and body written separately
+    #wait for the delayed ACK (~40 ms per request)
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    respond = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        #normalized, so the same query with parameters in another order hits the cache
+        query = tuple(sorted(parse_qsl(url.query)))
+        status, body = self.respond(url.path, query)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_responder(index, cache_size=QUERY_CACHE_SIZE):
+    """(path, query items) -> (status, body), cached when cache_size > 0"""
+    def respond(path, query):
+        try:
+            return 200, json.dumps(answer(index, path, dict(query))).encode()
+        except QueryError as e:
+            return 400, json.dumps({'error': str(e)}).encode()
+        except LookupError:
+            return 404, json.dumps({'error': f'Unknown endpoint {path}'}).encode()
+    return lru_cache(maxsize=cache_size)(respond) if cache_size else respond
+
+
+def make_server(index, host=QUERY_HOST, port=QUERY_PORT, cache_size=QUERY_CACHE_SIZE):
+    handler = type('Handler', (QueryHandler,), dict(respond=staticmethod(make_responder(index, cache_size))))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(index, host=QUERY_HOST, port=QUERY_PORT, cache_size=QUERY_CACHE_SIZE):
+    """Serves in a daemon thread, returns (server, base url)"""
+    server = make_server(index, host, port, cache_size)
+    threading.Thread(target=server.serve_forever, name='query-service', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    t0 = time.monotonic()
+    index = SegmentIndex(load_segments(get_connection()))
+    log(f"Indexed {index.n} segments in {time.monotonic() - t0:.1f} s, listening on http://{QUERY_HOST}:{QUERY_PORT}")
+    try:
+        make_server(index).serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
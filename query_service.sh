@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+source config.sh
+export PGPASSWORD
+
+#QUERY_HOST / QUERY_PORT set the address (default 127.0.0.1:8090), QUERY_CACHE_SIZE the number of cached responses
+python3 query_service.py
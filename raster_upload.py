@@ -0,0 +1,272 @@
+#Uploads GeoTiff tiles into PostGIS raster tables over a single connection.
+#Rasters are encoded as PostGIS raster WKB in-process and streamed with COPY,
+#which replaces one `raster2pgsql | psql` pipeline (and one new connection) per tile.
+
+import os
+import struct
+import time
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from db import get_connection
+from metrics import get_metrics, profiled
+
+log = print
+
+#Block (in pixels) tiles are cut into, like raster2pgsql -t
+BLOCK_SIZE = 250
+TILES_PER_TRANSACTION = 16
+#Which tile files (and in which version) are loaded into which raster table
+MANIFEST_TABLE = 'raster_tiles_loaded'
+#Factors of overview tables o_<factor>_<table> built after loading, e.g. '2,4,8,16'; empty - none
+DB_OVERVIEWS = [int(f) for f in os.getenv('DB_OVERVIEWS', '').split(',') if f.strip()]
+
+#PostGIS raster pixel types
+PIXTYPES = {
+    'int8': 3, 'uint8': 4, 'int16': 5, 'uint16': 6,
+    'int32': 7, 'uint32': 8, 'float32': 10, 'float64': 11,
+}
+_BAND_HAS_NODATA = 0x40
+
+
+def raster_wkb(data, transform, srid, nodata=None):
+    """
+    PostGIS raster WKB (little endian, version 0) of a single band array.
+    transform: affine transform of data (rasterio), rotation is not expected
+    """
+    height, width = data.shape
+    dtype = data.dtype.name
+    pixtype = PIXTYPES[dtype]
+    header = struct.pack('<BHHddddddiHH', 1, 0, 1,
+                         transform.a, transform.e, transform.c, transform.f, transform.b, transform.d,
+                         srid, width, height)
+    band_flags = pixtype | (_BAND_HAS_NODATA if nodata is not None else 0)
+    nodata_value = np.array([nodata if nodata is not None else 0], dtype=data.dtype).astype('<' + data.dtype.str[1:])
+    return header + bytes([band_flags]) + nodata_value.tobytes() + np.ascontiguousarray(data, dtype='<' + data.dtype.str[1:]).tobytes()
+
+
+def iter_tile_blocks(path, block_size=BLOCK_SIZE, srid=2180):
+    """Cuts the first band of a GeoTiff into blocks, yields their raster WKB"""
+    with rasterio.open(path) as src:
+        nodata = src.nodata
+        for row in range(0, src.height, block_size):
+            for col in range(0, src.width, block_size):
+                window = Window(col, row, min(block_size, src.width - col), min(block_size, src.height - row))
+                data = src.read(1, window=window)
+                yield raster_wkb(data, src.window_transform(window), srid, nodata)
+
+
+def prepare_raster_table(conn, table):
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis_raster")
+        log(f"Dropping the target table {table} if exists")
+        cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+        cur.execute(f"CREATE TABLE {table} (rid serial PRIMARY KEY, rast raster, filename text)")
+        cur.execute(f"CREATE INDEX {table}_filename_idx ON {table} (filename)")
+        #table is loaded from scratch, whatever the manifest said about it is no longer true
+        if manifest_exists(cur):
+            cur.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE raster_table = %s", (table,))
+    conn.commit()
+
+
+def manifest_exists(cur):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (MANIFEST_TABLE,))
+    return cur.fetchone()[0]
+
+
+def prepare_incremental(conn, table):
+    """Creates the raster table and the manifest if needed, without touching tiles already loaded"""
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis_raster")
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            raster_table TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size BIGINT NOT NULL,
+            mtime DOUBLE PRECISION NOT NULL,
+            loaded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (raster_table, filename)
+        )""")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table} (rid serial PRIMARY KEY, rast raster, filename text)")
+        #tables loaded by raster2pgsql have no filename, nothing in them can be matched with files on disk
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS filename text")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_filename_idx ON {table} (filename)")
+        cur.execute(f"DELETE FROM {table} WHERE filename IS NULL")
+        if cur.rowcount:
+            log(f"Removed {cur.rowcount} rows of {table} not known to the manifest, their tiles will be loaded again")
+            cur.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE raster_table = %s", (table,))
+    conn.commit()
+
+
+class _IterReader:
+    """File-like object over an iterator of bytes, lets COPY read the payload while it is being produced"""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buf)
+        out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def copy_tiles(conn, table, tiles, block_size=BLOCK_SIZE):
+    """Streams blocks of the tiles into table with one COPY, returns number of rows"""
+    rows = 0
+    def lines():
+        nonlocal rows
+        for path in tiles:
+            for wkb in iter_tile_blocks(path, block_size):
+                rows += 1
+                yield wkb.hex().encode('ascii') + b'\t' + tile_key(path).encode() + b'\n'
+    t0 = time.monotonic()
+    with profiled('upload'), conn.cursor() as cur:
+        cur.copy_expert(f"COPY {table} (rast, filename) FROM STDIN", _IterReader(lines()), size=1 << 20)
+    metrics = get_metrics()
+    metrics.observe('upload_seconds', time.monotonic() - t0, table=table)
+    metrics.inc('upload_tiles', len(tiles), table=table)
+    metrics.inc('upload_rows', rows, table=table)
+    return rows
+
+
+def record_tile_changes(conn, table, tiles):
+    """Footprints of (re)loaded tiles, compute_slope_static_incremental() recomputes ways crossing them"""
+    with conn.cursor() as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS raster_tile_changes (
+            raster_table TEXT NOT NULL,
+            footprint geometry(Polygon, 2180) NOT NULL,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""")
+        for path in tiles:
+            with rasterio.open(path) as src:
+                left, bottom, right, top = src.bounds
+            cur.execute("INSERT INTO raster_tile_changes (raster_table, footprint) VALUES (%s, ST_MakeEnvelope(%s, %s, %s, %s, 2180))",
+                        (table, left, bottom, right, top))
+
+
+def tile_key(path):
+    """Name under which the tile is recorded; tile names already carry the coordinates, the directory may differ"""
+    return os.path.basename(path)
+
+
+def finalize_raster_table(conn, table):
+    """Index, constraints and statistics, built once after all tiles are loaded (raster2pgsql -I -C -M)"""
+    log(f"Creating index and constraints on {table}")
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_st_convexhull_idx ON {table} USING gist (st_convexhull(rast))")
+        cur.execute("SELECT srid FROM raster_columns WHERE r_table_name = %s AND r_raster_column = 'rast'", (table,))
+        constrained = (cur.fetchone() or [0])[0] not in (0, None)
+    if not constrained:
+        add_raster_constraints(conn, table)
+    conn.commit()
+    if DB_OVERVIEWS:
+        create_overviews(conn, table, DB_OVERVIEWS)
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"VACUUM ANALYZE {table}")
+    finally:
+        conn.autocommit = autocommit
+
+
+def create_overviews(conn, table, factors):
+    """
+    Rebuilds overview tables of table (raster2pgsql -l), so clients reading the whole area don't decode full resolution.
+    They are computed from the whole table, loading a few tiles rebuilds them completely.
+    """
+    for factor in factors:
+        log(f"Creating overview o_{factor}_{table}")
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS o_{factor}_{table}")
+            cur.execute("SELECT ST_CreateOverview(%s::regclass, 'rast'::name, %s, 'Bilinear')", (table, factor))
+        conn.commit()
+
+
+def add_raster_constraints(conn, table):
+    with conn.cursor() as cur:
+        #extent and block size are left out, so more tiles can be appended later
+        cur.execute("SELECT AddRasterConstraints(%s::name, 'rast'::name, "
+                    "srid => true, scale_x => true, scale_y => true, blocksize_x => false, blocksize_y => false, "
+                    "same_alignment => true, regular_blocking => false, num_bands => true, pixel_types => true, "
+                    "nodata_values => true, out_db => true, extent => false)", (table,))
+
+
+def upload_rasters_copy(table, tiles, block_size=BLOCK_SIZE, tiles_per_transaction=TILES_PER_TRANSACTION, conn=None):
+    conn = conn or get_connection()
+    log(f"== UPLOADING {len(tiles)} TILES TO TABLE {table} (COPY) ==")
+    prepare_raster_table(conn, table)
+    rows = 0
+    for i in range(0, len(tiles), tiles_per_transaction):
+        batch = tiles[i:i + tiles_per_transaction]
+        rows += copy_tiles(conn, table, batch, block_size)
+        record_tile_changes(conn, table, batch)
+        conn.commit()
+        log(f"  {i + len(batch)}/{len(tiles)} tiles, {rows} rows")
+    finalize_raster_table(conn, table)
+    log('Finished.')
+    return rows
+
+
+def upload_rasters_incremental(table, tiles, block_size=BLOCK_SIZE, tiles_per_transaction=TILES_PER_TRANSACTION, conn=None):
+    """
+    Loads only tiles which are new or changed (by size and mtime) since they were last loaded into table.
+    Changed tiles are replaced in place, other rows are left alone, so the cost scales with the change.
+    Returns list of tiles which were (re)loaded.
+    """
+    conn = conn or get_connection()
+    prepare_incremental(conn, table)
+    to_load = tiles_to_load(conn, table, tiles)
+    log(f"== UPLOADING {len(to_load)} NEW OR CHANGED OF {len(tiles)} TILES TO TABLE {table} (COPY, incremental) ==")
+    if not to_load:
+        return []
+
+    rows = 0
+    for i in range(0, len(to_load), tiles_per_transaction):
+        batch = to_load[i:i + tiles_per_transaction]
+        rows += load_tile_batch(conn, table, batch, block_size)
+        log(f"  {i + len(batch)}/{len(to_load)} tiles, {rows} rows")
+    finalize_raster_table(conn, table)
+    log('Finished.')
+    return [path for path, _, _ in to_load]
+
+
+def tiles_to_load(conn, table, tiles):
+    """(path, size, mtime) of the tiles which are new or changed (by size and mtime) since they were loaded into table"""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT filename, size, mtime FROM {MANIFEST_TABLE} WHERE raster_table = %s", (table,))
+        loaded = {filename: (size, mtime) for filename, size, mtime in cur.fetchall()}
+    to_load = []
+    for path in tiles:
+        st = os.stat(path)
+        if loaded.get(tile_key(path)) != (st.st_size, st.st_mtime):
+            to_load.append((path, st.st_size, st.st_mtime))
+    return to_load
+
+
+def load_tile_batch(conn, table, batch, block_size=BLOCK_SIZE):
+    """
+    Replaces rows of the tiles in batch [(path, size, mtime)] and records them in the manifest, in one transaction.
+    Returns number of rows loaded.
+    """
+    keys = [tile_key(path) for path, _, _ in batch]
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {table} WHERE filename = ANY(%s)", (keys,))
+    rows = copy_tiles(conn, table, [path for path, _, _ in batch], block_size)
+    record_tile_changes(conn, table, [path for path, _, _ in batch])
+    with conn.cursor() as cur:
+        for key, (_, size, mtime) in zip(keys, batch):
+            cur.execute(f"""INSERT INTO {MANIFEST_TABLE} (raster_table, filename, size, mtime) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (raster_table, filename) DO UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, loaded_at = now()""",
+                (table, key, size, mtime))
+    conn.commit()
+    return rows
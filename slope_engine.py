@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+#Alternative to compute_slope_static(): samples heights from local GeoTiff tiles instead of rasters in PostGIS,
+#so rasters don't have to be uploaded before slopes can be computed.
+#Segments are still cut by PostGIS, with exactly the same expression as in compute_slope_static.sql.
+#With SLOPE_PROFILE_SPACING every segment is also sampled along its length (bilinear interpolation),
+#which gives max_grade, mean_grade, climb and descent - dips and crests between the ends of a segment.
+
+import io
+import os
+import time
+
+import numpy as np
+import rasterio
+
+from db import get_connection, copy_text
+from tiles import TILE_SIZE, SCALE_FACTOR, NMT_DIR, NMPT_DIR, tif_path_of, doubt_tif_path_of
+from metrics import get_metrics
+
+log = print
+
+KINDS = ('primary', 'secondary', 'tertiary', 'residential', 'living_street', 'unclassified', 'service')
+MAX_SLOPE = 0.5
+COPY_BATCH = 100_000
+#Distance (m) between profile samples along a segment, e.g. 1; 0 - only the ends are sampled
+SLOPE_PROFILE_SPACING = float(os.getenv('SLOPE_PROFILE_SPACING', 0))
+#Profile samples processed at once, bounds memory for large cities
+PROFILE_CHUNK = 2_000_000
+
+SEGMENTS_SQL = """
+SELECT
+    ways.way_id,
+    ways.layer,
+    ways.bridge IS NOT NULL,
+    ways.name,
+    st_x(st_startpoint(seg.geom)), st_y(st_startpoint(seg.geom)),
+    st_x(st_endpoint(seg.geom)), st_y(st_endpoint(seg.geom))
+FROM ways
+CROSS JOIN LATERAL st_dumpsegments(
+    st_segmentize(
+        st_simplifypreservetopology(
+            st_transform(ways.geom, 2180),
+            2::double precision
+        ),
+        50::double precision
+    )
+) AS seg
+WHERE
+    ways.name IS NOT NULL
+    --ignore tunnels
+    AND (ways.layer IS NULL OR ways.layer >= 0)
+    AND kind IN %s
+ORDER BY ways.way_id, seg.path[1]
+"""
+
+COPY_COLUMNS = ('segment_id', 'way_id', 'name', 'geom', 'slope', 'delta_h', 'nmt_h_a', 'nmt_h_b',
+                'nmpt_h_a', 'nmpt_h_b', 'nmpt_doubt_a', 'nmpt_doubt_b', 'nmt_used_a', 'nmt_used_b',
+                'max_grade', 'mean_grade', 'climb', 'descent')
+
+#EWKB of 2-point LineString with SRID
+_EWKB_LINE = np.dtype([('order', 'u1'), ('type', '<u4'), ('srid', '<u4'), ('npoints', '<u4'), ('coords', '<f8', 4)])
+
+
+def fetch_segments(conn, kinds=KINDS, itersize=50_000):
+    """Segment endpoints of all matching ways as numpy arrays (EPSG:2180)"""
+    way_id, layer, bridge, name, coords = [], [], [], [], []
+    with conn.cursor(name='slope_engine_segments') as cur:
+        cur.itersize = itersize
+        cur.execute(SEGMENTS_SQL, (tuple(kinds),))
+        for row in cur:
+            way_id.append(row[0])
+            layer.append(row[1])
+            bridge.append(row[2])
+            name.append(row[3])
+            coords.append(row[4:8])
+    coords = np.array(coords, dtype=np.float64).reshape(-1, 4)
+    return {
+        'way_id': np.array(way_id, dtype=np.int64),
+        'has_layer': np.array([l is not None for l in layer], dtype=bool),
+        'bridge': np.array(bridge, dtype=bool),
+        'name': name,
+        'xa': coords[:, 0], 'ya': coords[:, 1], 'xb': coords[:, 2], 'yb': coords[:, 3],
+    }
+
+
+def sample_rasters(x, y, rasters, methods=None, tile_size=TILE_SIZE):
+    """
+    Values of several rasters at points (x, y), {name: values}; rasters: {name: path_of(xmin, ymin)}.
+    Points are grouped by tile once, every tile of every raster is opened and read once
+    and sampled with a single vectorized operation.
+    methods: {name: 'nearest' | 'bilinear'}, nearest by default:
+            'nearest' - value of the pixel containing the point (like st_nearestvalue),
+            'bilinear' - interpolated between the 4 nearest pixel centres; within half a pixel
+            of the tile edge the edge pixels are used, neighbouring tiles are not read.
+    NaN where there is no tile or a pixel used is nodata.
+    """
+    methods = methods or {}
+    values = {name: np.full(x.shape, np.nan, dtype=np.float64) for name in rasters}
+    if x.size == 0:
+        return values
+    tx = np.floor(x / tile_size).astype(np.int64)
+    ty = np.floor(y / tile_size).astype(np.int64)
+    keys, inverse = np.unique(np.stack([tx, ty], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(keys)))])
+    for k, (kx, ky) in enumerate(keys):
+        idx = order[bounds[k]:bounds[k + 1]]
+        for name, path_of in rasters.items():
+            path = path_of(int(kx) * tile_size, int(ky) * tile_size)
+            if not os.path.exists(path):
+                continue
+            with rasterio.open(path) as src:
+                band = src.read(1).astype(np.float64)
+                t = src.transform
+                nodata = src.nodata
+            if nodata is not None:
+                band[band == nodata] = np.nan
+            if methods.get(name, 'nearest') == 'bilinear':
+                values[name][idx] = _bilinear(band, (x[idx] - t.c) / t.a - 0.5, (y[idx] - t.f) / t.e - 0.5)
+                continue
+            cols = np.floor((x[idx] - t.c) / t.a).astype(np.int64)
+            rows = np.floor((y[idx] - t.f) / t.e).astype(np.int64)
+            inside = (rows >= 0) & (rows < band.shape[0]) & (cols >= 0) & (cols < band.shape[1])
+            values[name][idx[inside]] = band[rows[inside], cols[inside]]
+    return values
+
+
+def _bilinear(band, fx, fy):
+    """band interpolated at fractional pixel-centre coordinates (fx column, fy row), clamped to the band"""
+    height, width = band.shape
+    fx = np.clip(fx, 0, width - 1)
+    fy = np.clip(fy, 0, height - 1)
+    c0 = np.minimum(np.floor(fx).astype(np.int64), max(width - 2, 0))
+    r0 = np.minimum(np.floor(fy).astype(np.int64), max(height - 2, 0))
+    c1 = np.minimum(c0 + 1, width - 1)
+    r1 = np.minimum(r0 + 1, height - 1)
+    wx = fx - c0
+    wy = fy - r0
+    top = band[r0, c0] * (1 - wx) + band[r0, c1] * wx
+    bottom = band[r1, c0] * (1 - wx) + band[r1, c1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def segment_profiles(xa, ya, xb, yb, forced, rasters, spacing, chunk=PROFILE_CHUNK):
+    """
+    Grades along the segments from heights sampled every `spacing` meters (both ends included).
+    Heights are bilinear NMT/NMPT, chosen per sample by the doubt map (nearest) like the ends of segments.
+    rasters: {'nmt': path_of, 'nmpt': path_of, 'doubt': path_of}; forced: layer or bridge, NMPT everywhere.
+    Returns (max_grade, mean_grade, climb, descent): steepest and mean absolute grade between consecutive samples,
+    sums of the rises and of the falls from a to b (m). Both come from the profile: its interpolated ends
+    differ slightly from the nearest-pixel ends of delta_h, so climb - delta_h is not the descent.
+    NaN for segments with a sample outside the tiles.
+    """
+    #chunks of segments ordered by tile touch few tiles each, so a tile is read about once for all chunks
+    by_tile = np.lexsort((np.floor(ya / TILE_SIZE), np.floor(xa / TILE_SIZE)))
+    xa, ya, xb, yb, forced = xa[by_tile], ya[by_tile], xb[by_tile], yb[by_tile], forced[by_tile]
+    length = np.hypot(xb - xa, yb - ya)
+    steps = np.maximum(np.ceil(length / spacing), 1).astype(np.int64)
+    max_grade = np.full(length.shape, np.nan)
+    mean_grade = np.full(length.shape, np.nan)
+    climb = np.full(length.shape, np.nan)
+    descent = np.full(length.shape, np.nan)
+    #segments are processed in chunks of about `chunk` samples
+    ends = np.cumsum(steps + 1)
+    first = 0
+    while first < length.size:
+        last = int(np.searchsorted(ends, (ends[first - 1] if first else 0) + chunk, side='right'))
+        last = max(last, first + 1)
+        s = np.arange(first, last)
+        n = steps[s] + 1
+        seg_of = np.repeat(np.arange(s.size), n)
+        starts = np.concatenate([[0], np.cumsum(n)[:-1]])
+        #position of every sample along its segment, 0..1
+        t = (np.arange(seg_of.size) - starts[seg_of]) / steps[s][seg_of]
+        x = xa[s][seg_of] + (xb[s] - xa[s])[seg_of] * t
+        y = ya[s][seg_of] + (yb[s] - ya[s])[seg_of] * t
+
+        sampled = sample_rasters(x, y, rasters, {'nmt': 'bilinear', 'nmpt': 'bilinear'})
+        use_nmpt = (sampled['doubt'] < 1.0) | forced[s][seg_of]
+        h = np.where(use_nmpt, sampled['nmpt'], sampled['nmt'])
+        h[np.isnan(sampled['doubt'])] = np.nan
+
+        #differences between consecutive samples of the same segment: drop the ones across segment boundaries
+        dh = np.diff(h)
+        within = np.ones(dh.size, dtype=bool)
+        within[(starts[1:] - 1)] = False
+        dh = dh[within]
+        step_len = (length[s] / steps[s])[seg_of[1:][within]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grade = np.abs(dh) / step_len
+        #every segment has steps[s] differences, contiguous and in order
+        bounds = np.concatenate([[0], np.cumsum(steps[s])[:-1]])
+        max_grade[s] = np.maximum.reduceat(grade, bounds)
+        mean_grade[s] = np.add.reduceat(np.abs(dh), bounds) / length[s]
+        climb[s] = np.add.reduceat(np.maximum(dh, 0), bounds)
+        descent[s] = np.add.reduceat(np.maximum(-dh, 0), bounds)
+        first = last
+    #back to the order of the segments given
+    profiles = []
+    for values in (max_grade, mean_grade, climb, descent):
+        restored = np.empty_like(values)
+        restored[by_tile] = values
+        profiles.append(restored)
+    return tuple(profiles)
+
+
+def choose_heights(seg, samples):
+    """Same rules as compute_slope_static(): NMPT unless doubtful, layer or bridge forces NMPT"""
+    forced = seg['has_layer'] | seg['bridge']
+    chosen = {}
+    for end in ('a', 'b'):
+        use_nmpt = (samples[f'doubt_{end}'] < 1.0) | forced
+        chosen[f'h_{end}'] = np.where(use_nmpt, samples[f'nmpt_{end}'], samples[f'nmt_{end}'])
+        chosen[f'nmt_used_{end}'] = (~use_nmpt).astype(np.int32)
+    return chosen
+
+
+def linestrings_ewkb_hex(xa, ya, xb, yb, srid=2180):
+    """Hex EWKB of 2-point linestrings, as accepted by COPY into a geometry column"""
+    rec = np.zeros(xa.shape, dtype=_EWKB_LINE)
+    rec['order'] = 1
+    rec['type'] = 0x20000002 #LineString with SRID
+    rec['srid'] = srid
+    rec['npoints'] = 2
+    rec['coords'] = np.stack([xa, ya, xb, yb], axis=1)
+    hex_all = rec.tobytes().hex()
+    n = 2 * _EWKB_LINE.itemsize
+    return [hex_all[i:i + n] for i in range(0, len(hex_all), n)]
+
+
+def write_slope_static(conn, rows, batch=COPY_BATCH):
+    """rows: iterable of tuples in COPY_COLUMNS order, streamed to COPY in batches"""
+    columns = ', '.join(COPY_COLUMNS)
+    buf = io.StringIO()
+    n = 0
+    with conn.cursor() as cur:
+        for row in rows:
+            buf.write('\t'.join(copy_text(v) for v in row))
+            buf.write('\n')
+            n += 1
+            if n % batch == 0:
+                buf.seek(0)
+                cur.copy_expert(f"COPY slope_static ({columns}) FROM STDIN", buf)
+                buf = io.StringIO()
+        buf.seek(0)
+        cur.copy_expert(f"COPY slope_static ({columns}) FROM STDIN", buf)
+    return n
+
+
+def compute_slope_static_python(conn, nmt_dir=NMT_DIR, nmpt_dir=NMPT_DIR, max_slope=MAX_SLOPE, profile_spacing=SLOPE_PROFILE_SPACING):
+    t0 = time.monotonic()
+    with conn.cursor() as cur:
+        cur.execute("SELECT clock_timestamp()")
+        computation_start = cur.fetchone()[0]
+    seg = fetch_segments(conn)
+    log(f"Fetched {len(seg['way_id'])} segments in {time.monotonic() - t0:.1f} s")
+
+    t1 = time.monotonic()
+    rasters = {
+        'nmt': lambda xmin, ymin: tif_path_of(nmt_dir, TILE_SIZE, SCALE_FACTOR, xmin, ymin),
+        'nmpt': lambda xmin, ymin: tif_path_of(nmpt_dir, TILE_SIZE, SCALE_FACTOR, xmin, ymin),
+        'doubt': lambda xmin, ymin: doubt_tif_path_of(nmpt_dir, TILE_SIZE, SCALE_FACTOR, xmin, ymin),
+    }
+    #both ends in one pass, so every tile is read once
+    n_seg = len(seg['xa'])
+    sampled = sample_rasters(np.concatenate([seg['xa'], seg['xb']]), np.concatenate([seg['ya'], seg['yb']]), rasters)
+    samples = {}
+    for raster, values in sampled.items():
+        samples[f'{raster}_a'] = values[:n_seg]
+        samples[f'{raster}_b'] = values[n_seg:]
+    log(f"Sampled rasters in {time.monotonic() - t1:.1f} s")
+
+    chosen = choose_heights(seg, samples)
+    length = np.hypot(seg['xb'] - seg['xa'], seg['yb'] - seg['ya'])
+    #zero length (repeated vertex) gives a NaN slope, never > max_slope, so it would be kept
+    valid = np.all(np.isfinite(np.stack(list(samples.values()))), axis=0) & (length > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #signed along the way, slope is absolute
+        dh = chosen['h_b'] - chosen['h_a']
+        slope = np.abs(dh) / length
+    steep = valid & (slope > max_slope)
+    keep = np.flatnonzero(valid & ~steep)
+    if steep.any():
+        log(f"WARNING {int(steep.sum())} segments are ridiculuosly steep (slope > {max_slope}), skipped as errors")
+
+    if profile_spacing > 0:
+        t3 = time.monotonic()
+        forced = seg['has_layer'] | seg['bridge']
+        max_grade, mean_grade, climb, descent = segment_profiles(seg['xa'][keep], seg['ya'][keep], seg['xb'][keep], seg['yb'][keep],
+                                                        forced[keep], rasters, profile_spacing)
+        log(f"Sampled profiles every {profile_spacing} m in {time.monotonic() - t3:.1f} s")
+    else:
+        max_grade = mean_grade = climb = descent = np.full(keep.size, np.nan)
+
+    geoms = linestrings_ewkb_hex(seg['xa'][keep], seg['ya'][keep], seg['xb'][keep], seg['yb'][keep])
+    columns = [
+        np.arange(1, keep.size + 1), seg['way_id'][keep], [seg['name'][i] for i in keep], geoms,
+        slope[keep], dh[keep],
+        samples['nmt_a'][keep], samples['nmt_b'][keep], samples['nmpt_a'][keep], samples['nmpt_b'][keep],
+        samples['doubt_a'][keep], samples['doubt_b'][keep],
+        chosen['nmt_used_a'][keep], chosen['nmt_used_b'][keep],
+    ]
+    #profiles missing (off or partly outside the tiles) are NULL, not NaN
+    columns += [np.where(np.isnan(c), None, c) for c in (max_grade, mean_grade, climb, descent)]
+    columns = [c.tolist() if isinstance(c, np.ndarray) else c for c in columns]
+
+    t2 = time.monotonic()
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE TABLE slope_static")
+    n = write_slope_static(conn, zip(*columns))
+    with conn.cursor() as cur:
+        cur.execute("CALL refresh_slope_way_stats(NULL)")
+        cur.execute("CALL slope_static_changes_consumed(%s)", (computation_start,))
+    conn.commit()
+    log(f"Written {n} segments in {time.monotonic() - t2:.1f} s")
+    get_metrics().inc('segments_computed', n, engine='python')
+    get_metrics().observe('slopes_seconds', time.monotonic() - t0, engine='python')
+    return n
+
+
+def ensure_schema(conn, sql_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compute_slope_static.sql')):
+    """Creates slope_static (and the SQL procedures) the same way compute_slope_static.sh does"""
+    with conn.cursor() as cur:
+        cur.execute(open(sql_path).read())
+    conn.commit()
+
+
+if __name__ == '__main__':
+    conn = get_connection()
+    ensure_schema(conn)
+    compute_slope_static_python(conn)
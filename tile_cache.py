@@ -0,0 +1,192 @@
+#Local cache of downloaded tiles.
+#The tiles stay where tif_path_of() puts them, a SQLite manifest next to them records what every file is
+#(model, coverage, extent, scale), its size and sha256, when it was fetched and last used.
+#A tile is trusted only if its file still matches the manifest, which replaces reading it with gdalinfo,
+#and least recently used tiles are removed once the cache grows over TILE_CACHE_MAX_GB.
+#Several workers (threads or processes) on one host can share the cache: the manifest is a WAL-mode
+#SQLite database and every tile has a lock file, so a tile is downloaded, replaced or evicted by one worker at a time.
+
+import fcntl
+import glob
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+log = print
+
+TILE_CACHE_DB = os.getenv('TILE_CACHE_DB', 'tiles/cache.sqlite')
+#0 - no limit
+TILE_CACHE_MAX_GB = float(os.getenv('TILE_CACHE_MAX_GB', 0))
+#'1' - checksum every tile taken from the cache, not only its size and mtime
+TILE_CACHE_VERIFY = os.getenv('TILE_CACHE_VERIFY', '0') == '1'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    path TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    coverage_id TEXT,
+    xmin REAL, ymin REAL, xmax REAL, ymax REAL,
+    scale_factor REAL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    derived_from TEXT,
+    fetched_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tiles_last_used_idx ON tiles (last_used);
+CREATE INDEX IF NOT EXISTS tiles_derived_from_idx ON tiles (derived_from);
+"""
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TileCache:
+    def __init__(self, db_path=TILE_CACHE_DB, max_bytes=TILE_CACHE_MAX_GB * 1e9, verify=TILE_CACHE_VERIFY):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.verify = verify
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+
+    @contextmanager
+    def _db(self):
+        #a connection per call: sqlite3 connections can't be shared between threads
+        db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def lock(self, path, blocking=True):
+        """
+        Exclusive lock of a tile, between threads and processes.
+        With blocking=False yields False instead of waiting when someone else holds it.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.lock', 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, path):
+        """
+        path if it is in the cache and the file still matches the manifest, None otherwise.
+        A file which doesn't match is removed together with its entry, so it will be fetched again.
+        """
+        with self._db() as db:
+            row = db.execute("SELECT size, mtime, sha256 FROM tiles WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        size, mtime, sha256 = row
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._forget(path)
+            return None
+        ok = st.st_size == size and (st.st_mtime == mtime or file_sha256(path) == sha256)
+        if ok and self.verify:
+            ok = file_sha256(path) == sha256
+        if not ok:
+            log(f"Cached tile {path} doesn't match the manifest, removing it")
+            self.remove(path)
+            return None
+        with self._db() as db:
+            db.execute("UPDATE tiles SET last_used = ?, mtime = ? WHERE path = ?", (time.time(), st.st_mtime, path))
+        return path
+
+    def put(self, path, model, coverage_id=None, extent=(None, None, None, None), scale_factor=None, derived_from=None):
+        """
+        Records the file at path, which has to be complete and valid already.
+        extent: (xmin, ymin, xmax, ymax); derived_from: path of the tile it was computed from, evicted together
+        """
+        st = os.stat(path)
+        now = time.time()
+        with self._db() as db:
+            db.execute("""INSERT OR REPLACE INTO tiles
+                (path, model, coverage_id, xmin, ymin, xmax, ymax, scale_factor, size, mtime, sha256, derived_from, fetched_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (path, model, coverage_id, *extent, scale_factor, st.st_size, st.st_mtime, file_sha256(path), derived_from, now, now))
+
+    def _forget(self, path):
+        with self._db() as db:
+            db.execute("DELETE FROM tiles WHERE path = ? OR derived_from = ?", (path, path))
+
+    def remove(self, path):
+        """Deletes the file, files derived from it and their entries"""
+        with self._db() as db:
+            derived = [p for (p,) in db.execute("SELECT path FROM tiles WHERE derived_from = ?", (path,))]
+        for p in [path, *derived]:
+            if os.path.exists(p):
+                os.remove(p)
+        self._forget(path)
+
+    def total_bytes(self):
+        with self._db() as db:
+            return db.execute("SELECT coalesce(sum(size), 0) FROM tiles").fetchone()[0]
+
+    def evict(self, keep=()):
+        """
+        Removes least recently used tiles until the cache fits in max_bytes.
+        Tiles in keep (e.g. the ones the current run needs) and tiles locked by other workers stay.
+        Returns number of bytes freed.
+        """
+        if self.max_bytes <= 0:
+            return 0
+        keep = set(keep)
+        total = self.total_bytes()
+        freed = 0
+        with self._db() as db:
+            #only source tiles are candidates, derived ones go with them
+            candidates = db.execute("SELECT path FROM tiles WHERE derived_from IS NULL ORDER BY last_used").fetchall()
+        for (path,) in candidates:
+            if total - freed <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            with self.lock(path, blocking=False) as locked:
+                if not locked:
+                    continue
+                with self._db() as db:
+                    size = db.execute("SELECT coalesce(sum(size), 0) FROM tiles WHERE path = ? OR derived_from = ?", (path, path)).fetchone()[0]
+                self.remove(path)
+                freed += size
+        if freed:
+            log(f"Evicted {freed / 1e9:.2f} GB of least recently used tiles, cache has {(total - freed) / 1e9:.2f} GB")
+        return freed
+
+    def remove_malformed(self, out_dir):
+        """Deletes tiles which failed validation (*_MALFORMED), they are never used again"""
+        removed = glob.glob(os.path.join(out_dir, '*_MALFORMED'))
+        for path in removed:
+            os.remove(path)
+        if removed:
+            log(f"Removed {len(removed)} malformed tiles from {out_dir}")
+        return removed
+
+
+_tile_cache = None
+
+def get_tile_cache():
+    """One TileCache per process, created on first use"""
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = TileCache()
+    return _tile_cache
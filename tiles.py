@@ -0,0 +1,218 @@
+#Naming and grid of the NMT/NMPT tiles on disk, shared by the downloader and everything reading the tiles
+
+import math
+import os
+
+TILE_SIZE = 1000  # meters
+SCALE_FACTOR = 1.0
+
+NMT_DIR = "tiles/nmt"
+NMPT_DIR = "tiles/nmpt"
+
+tif_path_of = lambda OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin : f"{OUT_DIR}/tile_{xmin}_{ymin}_{TILE_SIZE}_{SCALE_FACTOR}.tif"
+doubt_tif_path_of = lambda OUT_DIR, TILE_SIZE, SCALE_FACTOR, xmin, ymin : f"{OUT_DIR}/tile_{xmin}_{ymin}_{TILE_SIZE}_{SCALE_FACTOR}.doubt.tif"
+
+#WCS services of the models and raster tables they are loaded into
+MODELS = {
+    'NMT': dict(
+        wcs_base="https://mapy.geoportal.gov.pl/wss/service/PZGIK/NMT/GRID1/WCS/DigitalTerrainModelFormatTIFF",
+        response_format="image/tiff",
+        coverage_id="DTM_PL-KRON86-NH_TIFF",
+        out_dir=NMT_DIR,
+        raster_table='dtm',
+    ),
+    'NMPT': dict(
+        wcs_base="https://mapy.geoportal.gov.pl/wss/service/PZGIK/NMPT/GRID1/WCS/DigitalSurfaceModel",
+        response_format="image/x-aaigrid",
+        coverage_id="DSM_PL-KRON86-NH",
+        out_dir=NMPT_DIR,
+        raster_table='dtcm',
+        doubt_table='dtcm_doubt',
+    ),
+}
+
+
+#'bbox' plans every tile of the bbox, 'ways' only tiles near streets already imported into ways (see download_ways.sh)
+TILE_PLAN = os.getenv('TILE_PLAN', 'bbox')
+#GeoJSON file (EPSG:4326) with a polygon, e.g. a city boundary or a buffered route; only tiles intersecting it are planned
+TILE_PLAN_AREA = os.getenv('TILE_PLAN_AREA', '')
+#Distance (m) from a street within which a tile is still needed, with TILE_PLAN=ways
+TILE_PLAN_BUFFER = float(os.getenv('TILE_PLAN_BUFFER', 20))
+
+#Grid cells crossed by (buffered) streets which compute_slope_static uses; ST_SquareGrid is aligned to 0,0 like the tiles
+NEAR_WAYS_SQL = """
+SELECT DISTINCT g.i, g.j
+FROM ways w
+CROSS JOIN LATERAL ST_SquareGrid(%(size)s, ST_Buffer(ST_Transform(w.geom, 2180), %(buffer)s)) g
+WHERE
+    w.geom && ST_Transform(ST_MakeEnvelope(%(lon_min)s, %(lat_min)s, %(lon_max)s, %(lat_max)s, 4326), Find_SRID('public', 'ways', 'geom'))
+    AND w.name IS NOT NULL
+    AND w.kind IN (
+        'primary', 'secondary', 'tertiary',
+        'residential', 'living_street',
+        'unclassified', 'service'
+    )
+    AND ST_DWithin(g.geom, ST_Transform(w.geom, 2180), %(buffer)s)
+"""
+
+
+def wgs84_to_2180():
+    """osr transformation EPSG:4326 => EPSG:2180, both in x=lon/easting, y=lat/northing order"""
+    from osgeo import osr
+    src = osr.SpatialReference()
+    src.ImportFromEPSG(4326)
+    src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst = osr.SpatialReference()
+    dst.ImportFromEPSG(2180)
+    dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(src, dst)
+
+
+def bbox_to_2180(lat_min, lat_max, lon_min, lon_max, log=print):
+    """Upper left and lower right corner (ulx, uly, lrx, lry) of the WGS84 bbox in EPSG:2180"""
+    log("Creating coordinate transformation EPSG:4326 => EPSG:2180")
+    transform = wgs84_to_2180()
+
+    #both corners in one call
+    (ulx, uly, _), (lrx, lry, _) = transform.TransformPoints([(lon_min, lat_max), (lon_max, lat_min)])
+
+    log(f"Raw transformed bbox:")
+    log(f"  ULX={ulx}, ULY={uly}")
+    log(f"  LRX={lrx}, LRY={lry}")
+
+    if uly<0 or ulx<0 or lrx<0 or lry<0:
+        raise Exception("Incorrect bbox (negatove coords)")
+    return ulx, uly, lrx, lry
+
+
+def tile_generator(ulx, uly, lrx, lry, TILE_SIZE=TILE_SIZE, log=print):
+    # SNAP TO TILE GRID
+
+    def snap_down(val, size):
+        return math.floor(val / size) * size
+
+    def snap_up(val, size):
+        return math.ceil(val / size) * size
+
+    ulx_s = snap_down(ulx, TILE_SIZE)
+    uly_s = snap_up(uly, TILE_SIZE)
+    lrx_s = snap_up(lrx, TILE_SIZE)
+    lry_s = snap_down(lry, TILE_SIZE)
+
+    log("Snapped bbox to 1000m grid:")
+    log(f"  ULX={ulx_s}, ULY={uly_s}")
+    log(f"  LRX={lrx_s}, LRY={lry_s}")
+
+    # =========================
+    # TILE GRID
+    # =========================
+
+    x_tiles = int((lrx_s - ulx_s) / TILE_SIZE)
+    y_tiles = int((uly_s - lry_s) / TILE_SIZE)
+
+    log(f"Tile grid size:")
+    log(f"  x_tiles={x_tiles}")
+    log(f"  y_tiles={y_tiles}")
+
+    tile_index = 0
+
+    for ix in range(x_tiles):
+        for iy in range(y_tiles):
+
+            tile_index += 1
+
+            xmin = ulx_s + ix * TILE_SIZE
+            xmax = xmin + TILE_SIZE
+            ymax = uly_s - iy * TILE_SIZE
+            ymin = ymax - TILE_SIZE
+
+            log(f"Tile {tile_index}:")
+            log(f"  ix={ix}, iy={iy}")
+            log(f"  xmin={xmin}, xmax={xmax}")
+            log(f"  ymin={ymin}, ymax={ymax}")
+            yield xmin, xmax, ymin, ymax
+    return
+
+
+def neighbour_paths(out_dir, xmin, ymin, TILE_SIZE=TILE_SIZE, SCALE_FACTOR=SCALE_FACTOR, exists=None):
+    """
+    {(dx, dy): path} of the 8 tiles around (xmin, ymin), dx=1 is east, dy=1 is north.
+    exists(path) decides which of them are there, by default the file has to be on disk.
+    """
+    exists = exists or os.path.exists
+    neighbours = {}
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour_path = tif_path_of(out_dir, TILE_SIZE, SCALE_FACTOR, xmin + dx*TILE_SIZE, ymin + dy*TILE_SIZE)
+            if (dx, dy) != (0, 0) and exists(neighbour_path):
+                neighbours[(dx, dy)] = neighbour_path
+    return neighbours
+
+
+def read_area(path, buffer=TILE_PLAN_BUFFER):
+    """
+    Area (ogr geometry, EPSG:2180) of the GeoJSON file: a geometry, Feature or FeatureCollection (union of features).
+    Lines and points (e.g. a route) are buffered by buffer meters.
+    """
+    import json
+    from osgeo import ogr
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in data['features']]
+    elif data.get('type') == 'Feature':
+        geometries = [data['geometry']]
+    else:
+        geometries = [data]
+    area = ogr.Geometry(ogr.wkbGeometryCollection)
+    for geometry in geometries:
+        area.AddGeometry(ogr.CreateGeometryFromJson(json.dumps(geometry)))
+    #all vertices are transformed in one call
+    area.Transform(wgs84_to_2180())
+    union = None
+    for i in range(area.GetGeometryCount()):
+        geometry = area.GetGeometryRef(i)
+        if geometry.GetDimension() < 2:
+            geometry = geometry.Buffer(buffer)
+        union = geometry.Clone() if union is None else union.Union(geometry)
+    return union
+
+
+def cells_near_ways(conn, lat_min, lat_max, lon_min, lon_max, buffer=TILE_PLAN_BUFFER, TILE_SIZE=TILE_SIZE):
+    """{(xmin, ymin)} of the grid cells within buffer meters from streets in the bbox"""
+    with conn.cursor() as cur:
+        cur.execute(NEAR_WAYS_SQL, dict(size=TILE_SIZE, buffer=buffer,
+                                        lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max))
+        cells = {(i * TILE_SIZE, j * TILE_SIZE) for i, j in cur}
+    conn.commit()
+    return cells
+
+
+def plan_tiles(lat_min, lat_max, lon_min, lon_max, plan=TILE_PLAN, area=TILE_PLAN_AREA, buffer=TILE_PLAN_BUFFER, conn=None, log=print):
+    """
+    (xmin, xmax, ymin, ymax) of the tiles to download for the WGS84 bbox.
+    Tiles of the bbox are narrowed down to the ones intersecting the area polygon (GeoJSON file)
+    and, with plan='ways', to the ones near streets (ways have to be imported first).
+    """
+    ulx, uly, lrx, lry = bbox_to_2180(lat_min, lat_max, lon_min, lon_max, log=log)
+    tiles = list(tile_generator(ulx, uly, lrx, lry, log=lambda *a, **k: None))
+    n_bbox = len(tiles)
+    if area:
+        from osgeo import ogr
+        area_geom = read_area(area, buffer) if isinstance(area, str) else area
+        min_x, max_x, min_y, max_y = area_geom.GetEnvelope()
+        def intersects(xmin, xmax, ymin, ymax):
+            if xmax < min_x or xmin > max_x or ymax < min_y or ymin > max_y:
+                return False
+            cell = ogr.CreateGeometryFromWkt(f"POLYGON (({xmin} {ymin}, {xmax} {ymin}, {xmax} {ymax}, {xmin} {ymax}, {xmin} {ymin}))")
+            return area_geom.Intersects(cell)
+        tiles = [t for t in tiles if intersects(*t)]
+    if plan == 'ways':
+        from db import get_connection
+        #the process-wide connection is shared, not closed here
+        cells = cells_near_ways(conn or get_connection(), lat_min, lat_max, lon_min, lon_max, buffer)
+        tiles = [t for t in tiles if (t[0], t[2]) in cells]
+    elif plan != 'bbox':
+        raise Exception(f"Unknown TILE_PLAN: {plan}")
+    log(f"Planned {len(tiles)} of {n_bbox} tiles of the bbox")
+    return tiles
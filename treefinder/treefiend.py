@@ -1,3 +1,4 @@
+import os
 import rasterio
 import numpy as np
 import matplotlib.pyplot as plt
@@ -57,8 +58,11 @@ def save_array_as_geotiff_with_meta_from_other_file(src_path, out_path, data, dt
 
     meta.update(dtype='float32', count=1, compress='deflate')
 
-    with rasterio.open(out_path, 'w', **meta) as dst:
+    #write under temporary name and rename, so an interrupted run never leaves half-written output
+    tmp_path = out_path + '.tmp'
+    with rasterio.open(tmp_path, 'w', **meta) as dst:
         dst.write(data.astype('float32'), 1)
+    os.replace(tmp_path, out_path)
 
 def save_aux_pngs(out_path, img, img_bin1, img_bin2):
     from PIL import Image
@@ -91,30 +95,117 @@ def n_erode_dilate(mask, khalf=1, n_iter=2):
 
     return out.astype(np.uint8)
 
-def generate_roughness(in_path , out_path, save_also_png=False, binarize_and_postprocess=True):
+#Work buffers of drz_mask, kept between calls so a worker processing many tiles allocates them once
+_work_buffers = {}
+
+def drz_mask(im, thresh=1.0, khalf=1, n_iter=2):
     """
-    in_path: must be GeoTiff, metadata will be copied
+    Memory-lean equivalent of drz followed by thresholding and n_erode_dilate, gives identical masks.
+    Everything is computed in float32 in two reused buffers:
+      - fm_fast: local max and min go straight into the buffers, differences are taken in-place
+      - f_fast and clip write into the buffer freed by the min
+      - n_iter erosions + n_iter dilations with (2*khalf+1)^2 square = one opening with a square
+        of side 2*khalf*n_iter+1, done as separable min/max filters on uint8
+    Returns (img_trans, mask); img_trans is a work buffer, valid until the next call with the same shape.
     """
-    THRESH = 1.0
+    im = np.asarray(im, dtype=np.float32)
+    if im.shape not in _work_buffers:
+        _work_buffers.clear()
+        _work_buffers[im.shape] = (np.empty(im.shape, np.float32), np.empty(im.shape, np.float32))
+    fm, tmp = _work_buffers[im.shape]
+
+    size = 2 * khalf + 1
+    ndimage.maximum_filter(im, size=size, mode='nearest', output=fm)
+    ndimage.minimum_filter(im, size=size, mode='nearest', output=tmp)
+    np.subtract(fm, im, out=fm)
+    np.subtract(im, tmp, out=tmp)
+    np.maximum(fm, tmp, out=fm)
+
+    img_trans = tmp
+    ndimage.uniform_filter(fm, size=size, mode='nearest', output=img_trans)
+    np.clip(img_trans, 0, 1.0, out=img_trans)
+
+    mask = (img_trans >= thresh).view(np.uint8)
+    opening_size = 2 * khalf * n_iter + 1
+    eroded = ndimage.minimum_filter(mask, size=opening_size, mode='constant', cval=0)
+    ndimage.maximum_filter(eroded, size=opening_size, mode='constant', cval=0, output=mask)
+    return img_trans, mask
+
+#How far (in pixels) a value of the input influences the doubt map:
+#fm_fast (1) + f_fast (1) + 2 erosions (2) + 2 dilations (2)
+HALO = 6
+
+def read_with_halo(in_path, neighbours, halo=HALO):
+    """
+    Reads tile together with a frame of `halo` pixels taken from the surrounding tiles.
+    neighbours: {(dx, dy): path} of adjacent tiles of the same size, dx=1 is east, dy=1 is north.
+                Missing neighbours are padded with the nearest edge value (like mode='nearest').
+    Only the needed strips of the neighbours are read (windowed reads).
+    """
+    from rasterio.windows import Window
     f,img = read_tiff(in_path)
     f.close()
-    img_trans = drz(img)
-    img_bin = img_trans>=THRESH
-    img_bin_morph = n_erode_dilate(img_bin, khalf=1, n_iter=2)
+    h, w = img.shape
+    padded = np.pad(img, halo, mode='edge')
+    #(source offset, length, destination offset) along one axis for: before, same, after
+    cols = {-1: (w - halo, halo, 0), 0: (0, w, halo), 1: (0, halo, halo + w)}
+    rows = {1: (h - halo, halo, 0), 0: (0, h, halo), -1: (0, halo, halo + h)}
+    for (dx, dy), path in neighbours.items():
+        if path is None or (dx, dy) == (0, 0):
+            continue
+        col_off, width, dst_col = cols[dx]
+        row_off, height, dst_row = rows[dy]
+        with rasterio.open(path) as src:
+            if src.shape != img.shape:
+                raise Exception(f'Neighbour {path} has shape {src.shape}, expected {img.shape}')
+            padded[dst_row:dst_row + height, dst_col:dst_col + width] = src.read(1, window=Window(col_off, row_off, width, height))
+    return padded
+
+def generate_roughness(in_path , out_path, save_also_png=False, binarize_and_postprocess=True, neighbours=None, halo=HALO):
+    """
+    in_path: must be GeoTiff, metadata will be copied
+    neighbours: optional {(dx, dy): path} of adjacent tiles (see read_with_halo);
+                with them the result has no seams along the tile edges
+    """
+    THRESH = 1.0
+    if neighbours:
+        img = read_with_halo(in_path, neighbours, halo)
+    else:
+        f,img = read_tiff(in_path)
+        f.close()
+    img_trans, img_bin_morph = drz_mask(img, thresh=THRESH, khalf=1, n_iter=2)
+    if neighbours:
+        crop = np.s_[halo:-halo, halo:-halo]
+        img_trans, img_bin_morph = img_trans[crop], img_bin_morph[crop]
 
     if binarize_and_postprocess:
-        img_out = img_bin_morph.astype(np.uint8)
+        img_out = img_bin_morph
     else:
-        img_out = img_trans
+        img_out = img_trans.copy()
     save_array_as_geotiff_with_meta_from_other_file(in_path, out_path, img_out,
                                     dtype=img_out.dtype)
     if save_also_png:
-        save_aux_pngs(out_path, img_trans, img_bin, img_bin_morph)
+        save_aux_pngs(out_path, img_trans, img_trans>=THRESH, img_bin_morph)
     return img_out
 
+def check_drz_mask_equivalence(in_path, thresh=1.0):
+    """Compares drz_mask with the original drz + n_erode_dilate chain on a real tile"""
+    f,img = read_tiff(in_path)
+    f.close()
+    expected = n_erode_dilate(drz(img) >= thresh, khalf=1, n_iter=2)
+    _, mask = drz_mask(img, thresh=thresh, khalf=1, n_iter=2)
+    differing = int(np.count_nonzero(expected != mask))
+    print(f'{in_path}: {differing} of {mask.size} pixels differ between drz_mask and drz + n_erode_dilate')
+    return differing == 0
+
+def generate_roughness_job(in_path, out_path, neighbours=None):
+    """Entry point for worker processes, returns out_path so results can be matched to tiles"""
+    generate_roughness(in_path, out_path, save_also_png=False, neighbours=neighbours)
+    return out_path
+
 if __name__ == '__main__':
     help = 'Usage: treefiend.py <input-path.tif> <output-path.tif>'
-    import sys, os
+    import sys
     from os.path import join
     if len(sys.argv) == 3:
         generate_roughness(sys.argv[1], sys.argv[2], save_also_png = True)
@@ -123,6 +214,9 @@ if __name__ == '__main__':
             prefix = os.path.dirname(__file__)
             generate_roughness(join(prefix,'tile_example1.tif'), join(prefix,'tile_example1.doubt.tif'), save_also_png = True)
             generate_roughness(join(prefix, 'zoo.tif'), join(prefix,'zoo.doubt.tif'), save_also_png = True)
+            equivalent = [check_drz_mask_equivalence(join(prefix, name)) for name in ('tile_example1.tif', 'zoo.tif')]
+            if not all(equivalent):
+                exit(1)
     else:
         print(help, file=sys.stderr)
         exit(1)
\ No newline at end of file
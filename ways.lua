@@ -1,3 +1,15 @@
+-- Highway kinds to import (comma separated, 'all' for every highway), set by download_ways.sh.
+-- Only named ways of these kinds are used by compute_slope_static, skipping the rest
+-- keeps the import fast and the table small.
+local kinds_env = os.getenv('WAYS_KINDS') or 'primary,secondary,tertiary,residential,living_street,unclassified,service'
+local kinds = nil
+if kinds_env ~= 'all' then
+    kinds = {}
+    for kind in string.gmatch(kinds_env, '[^,]+') do
+        kinds[kind] = true
+    end
+end
+
 local ways = osm2pgsql.define_way_table('ways', {
     { column = 'kind', type = 'text' },
     { column = 'name', type = 'text' },
@@ -7,13 +19,18 @@ local ways = osm2pgsql.define_way_table('ways', {
 })
 
 function osm2pgsql.process_way(object)
-    if object.tags.highway then
-        ways:add_row({
-            kind = object.tags.highway,
-            name = object.tags.name,
-            bridge = object.tags.bridge,
-            layer = object.tags.layer,
-            geom = { create = 'line' }
-        })
+    local highway = object.tags.highway
+    if not highway then
+        return
+    end
+    if kinds and not (kinds[highway] and object.tags.name) then
+        return
     end
+    ways:add_row({
+        kind = highway,
+        name = object.tags.name,
+        bridge = object.tags.bridge,
+        layer = object.tags.layer,
+        geom = { create = 'line' }
+    })
 end